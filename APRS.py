@@ -1,33 +1,52 @@
 import config as cf
+from PollScheduler import PollScheduler
+from PositionHistory import PositionHistory
+from Clock import clock
 import os
 import threading
 import time
-import requests
+from HTTPSessionPool import pool
 import json
 import numpy as np
 
 class APRS():
 
-    def __init__(self, newDataHandler):
-        """ Constructor for the APRS API Object. It reads the key and Call from the .env file an tries to test the connection. """
+    def __init__(self, newDataHandler, roundHandler=None):
+        """ Constructor for the APRS API Object. It reads the key and Call from the .env file an tries to test the connection. The optional roundHandler is called after all new positions of a poll have been handed out. """
 
         # As this is a child class, execute the parent constructor
         super().__init__()
 
         self.newDataHandler = newDataHandler
+        self.roundHandler = roundHandler
         self._stop_event = True
         self._running = False
 
         # Define the APRS URL
         self.APRS_ENDPOINT = "https://api.aprs.fi/api/get"
+        self.MAX_NAMES_PER_QUERY = 20 # aprs.fi accepts up to 20 comma separated names in one query
 
         # read the .env Data
         self.key = os.getenv('APRS_API_KEY')
         self.call = os.getenv('APRS_FOLLOW_CALL')
-        
 
-        self.coord = [0.0, 0.0]
-        self.lastTimestamp = 0
+        # every tracked callsign has its own handler, position and timestamp. They are all fetched in the same batched queries
+        self.handlers = {}
+        self.coords = {}
+        self.lastTimestamps = {}
+        self.histories = {} # call -> PositionHistory of the last fixes
+        try:
+            self.HISTORY_SIZE = int(os.getenv('APRS_HISTORY_SIZE', 256))
+        except:
+            self.HISTORY_SIZE = 256
+            cf.log.error('[APRS] Could not read APRS_HISTORY_SIZE. Default: 256')
+        self.scheduler = PollScheduler() # decides when to poll next
+
+        # statistics
+        self.packets = 0
+        self.totalDelay = 0.0
+        if self.call != None and self.call != '':
+            self.track(self.call, newDataHandler)
 
         # check the correctness of the set data
         self.validated = False
@@ -36,8 +55,8 @@ class APRS():
             if data != None:
                 self.validated = True
                 cf.log.info('[APRS] APRS Validated! Response: ' + str(data))
-                self.coord = data[0]
-                self.lastTimestamp = data[1]
+                self.coords[self.call.upper()] = data[0]
+                self.lastTimestamps[self.call.upper()] = data[1]
             else:
                 cf.log.critical('[APRS] Unable to validate APRS API!')
 
@@ -53,6 +72,33 @@ class APRS():
         self._stop_event = False
         if self._running == False:
             threading.Thread(target=self.run).start()
+
+    def track(self, call, newDataHandler):
+        """Adds a callsign to the batched queries. The handler is called with the coordinates of each new packet of this station. Only packets newer than now are seen as new."""
+        call = call.strip().upper()
+        self.handlers[call] = newDataHandler
+        self.lastTimestamps[call] = int(clock.time())
+        if self.histories.get(call) == None:
+            self.histories[call] = PositionHistory(self.HISTORY_SIZE)
+        cf.log.debug('[APRS] Now tracking ' + call + '. Tracked stations: ' + str(len(self.handlers)))
+
+    def untrack(self, call):
+        """Removes a callsign from the batched queries."""
+        call = call.strip().upper()
+        self.handlers.pop(call, None)
+        self.coords.pop(call, None)
+        self.lastTimestamps.pop(call, None)
+        self.histories.pop(call, None)
+        self.scheduler.forget(call)
+        cf.log.debug('[APRS] Stopped tracking ' + call + '. Tracked stations: ' + str(len(self.handlers)))
+
+    def getHistory(self, call):
+        """Returns the PositionHistory of a tracked station or None."""
+        return self.histories.get(call.strip().upper())
+
+    def updateETA(self, call, eta, nextAlert):
+        """Tells the poll scheduler the current ETA and the next alert threshold of a station, both in minutes. Use None to clear them."""
+        self.scheduler.updateETA(call, eta, nextAlert)
         
 
     def run(self): 
@@ -61,57 +107,154 @@ class APRS():
         self._running = True
         failCount = 0
         time.sleep(3) # Wait a sec, this relaxes the Telegram API a bit
-        self.lastTimestamp = int(time.time()) # the thread has started, wait for the next incoming packet to be seen as "new"
+        self.resetTimestamps()
         while self._stop_event == False: # loop, unless stopped
             cf.log.debug('[APRS] Querring APRS API...')
-            data = self.getPosition()
+            data = self.getPositions(list(self.handlers.keys()))
             if data != None:
-                newTimestamp = data[1]
-                newCoord = data[0]
-                if newTimestamp > self.lastTimestamp: # chek weather this data is duplicate or new
-                    self.coord = newCoord
-                    self.lastTimestamp = newTimestamp
-                    self.newDataHandler(newCoord) # Call the new Data Handler with the new coordinates
+                self.processPositions(data)
                 failCount = 0
-                time.sleep(90) # wait 90sec, aprs packets are not that frequent
+                time.sleep(self.nextPollInterval())
             else: 
                 failCount = failCount + 1
                 if failCount == 7:
-                    cf.log.critical('[APRS] Data fetching failed for 6 or more consecutive events!') # The last try was more than 1h ago, we're gonna shutoff
-                    self.validated = False
-                    self.stop()
-                    self._running = False
+                    self.giveUp()
                     return
-                time.sleep(int(86+np.power(4,failCount))) # implement the exponential backoff, The intervals are 90sec, 102sec, 150sec, etc.
+                time.sleep(self.backoffInterval(failCount))
         self._running = False
+        self.logStats()
         cf.log.debug('[APRS] Thread exit')
 
+    def resetTimestamps(self):
+        """ The poller has started, wait for the next incoming packet of every station to be seen as "new". """
+        for call in list(self.lastTimestamps.keys()):
+            self.lastTimestamps[call] = int(clock.time())
+
+    def processPositions(self, data):
+        """ Hands every new position in data {CALL: ([longitude, latitude], timestamp)} to the handler of its station. Duplicates are dropped. Afterwards the round handler is called once, so the work of all stations can be batched. """
+        handled = []
+        for call, (newCoord, newTimestamp) in data.items():
+            handler = self.handlers.get(call)
+            if handler != None and newTimestamp > self.lastTimestamps.get(call, 0): # chek weather this data is duplicate or new
+                self.coords[call] = newCoord
+                self.lastTimestamps[call] = newTimestamp
+                history = self.histories.get(call)
+                if history != None: # the station may have been untracked in the meantime
+                    history.append(newTimestamp, newCoord)
+                self.scheduler.updatePacket(call, newTimestamp)
+                handler(newCoord) # Call the new Data Handler of this station with the new coordinates
+                handled.append(newTimestamp)
+        if len(handled) > 0 and self.roundHandler != None:
+            self.roundHandler()
+        # the delay from the packet to the handled alert, it includes the lag of aprs.fi and the wait for the poll
+        now = clock.time()
+        self.packets += len(handled)
+        self.totalDelay += sum(now - timestamp for timestamp in handled)
+
+    def nextPollInterval(self):
+        """ Returns the seconds to wait until the next poll. Wait long if far away from the next alert, short if close. """
+        interval = self.scheduler.nextInterval(list(self.handlers.keys()))
+        self.scheduler.recordPoll(interval)
+        cf.log.debug('[APRS] Next poll in ' + str(round(interval)) + ' sec.')
+        return interval
+
+    def backoffInterval(self, failCount):
+        """ Implements the exponential backoff, The intervals are 90sec, 102sec, 150sec, etc. """
+        return int(86+np.power(4,failCount))
+
+    def giveUp(self):
+        """ Called if the data fetching failed too often. The poller is stopped and the API is marked as not validated. """
+        cf.log.critical('[APRS] Data fetching failed for 6 or more consecutive events!') # The last try was more than 1h ago, we're gonna shutoff
+        self.validated = False
+        self.stop()
+        self._running = False
+
+    def stats(self):
+        """ Returns the number of handled packets and the mean packet-to-alert delay in seconds, measured from the timestamps reported by aprs.fi. """
+        if self.packets == 0:
+            return {'packets' : 0, 'meanDelay' : None}
+        return {'packets' : self.packets, 'meanDelay' : self.totalDelay / self.packets}
+
+    def logStats(self):
+        """ Writes the scheduler and delay statistics to the log. """
+        cf.log.info('[APRS] Polls saved by the scheduler: ' + str(self.scheduler.pollsSaved()) + ' of ' + str(self.scheduler.polls + self.scheduler.pollsSaved()))
+        stats = self.stats()
+        if stats['packets'] > 0:
+            cf.log.info('[APRS] ' + str(stats['packets']) + ' packets handled, mean packet-to-alert delay ' + str(round(stats['meanDelay'], 1)) + ' sec.')
+
     def getPosition(self, tryAnyway=False):
-        """ This function calls the APRS API and querys the postion. It will return ([longitude, latitude], timestamp) or None, if the query fails."""
+        """ This function calls the APRS API and querys the postion of the followed call. It will return ([longitude, latitude], timestamp) or None, if the query fails."""
+        if self.call == None or self.call == '':
+            return None
+        data = self.getPositions([self.call], tryAnyway)
+        if data == None or data.get(self.call.upper()) == None:
+            return None
+        return data[self.call.upper()]
+
+    def getPositions(self, calls, tryAnyway=False):
+        """ This function querys the postions of all given calls, using as few API calls as possible. It will return a dict {CALL: ([longitude, latitude], timestamp)} or None, if all queries fail. Stations without a known position are missing in the dict."""
         if self.validated or tryAnyway: # Only query API once it has been tested to work
-            try:
-                params = {
-                        "name" : self.call,
-                        "what" : "loc",
-                        "apikey":self.key,
-                        "format": "json"
-                    }
-                response = requests.get(self.APRS_ENDPOINT, params, timeout=(3,5))
-                if response.status_code != 200: # check for the correct error code
-                    cf.log.error('[APRS] APRS could not fetch date! Server status code: ' + str(response.status_code))
-                    return None
-                data = json.loads(response.text)
-                if data['result'] != "ok":
-                    cf.log.error('[APRS] APRS.fi did not respond with ""ok""! Response: ' + data)
-                    return None
-                lat = float(data['entries'][0]['lat']) # if the conversion does not fail, we can be confident, that the response was valid
-                lng = float(data['entries'][0]['lng'])
-                timestamp = int(data['entries'][0]['time']) 
-                cf.log.debug('[APRS] Data received: '+ str(lng) + ' ' +str(lat) + ' Timestamp: ' + str(timestamp))
-                return [lng, lat], timestamp
-            except Exception as e:
-                cf.log.error('[APRS] Fetching APRS Data failed. Reason: ' + str(e))
-                return None
+            chunks = self.splitCalls(calls)
+            results = [self.queryEntries(chunk) for chunk in chunks]
+            return self.mergeEntries(chunks, results)
         else:
             cf.log.warn('[APRS] Tried getPosition, but APRS API is not validated!')
             return None
+
+    def splitCalls(self, calls):
+        """ Splits the calls into chunks of at most MAX_NAMES_PER_QUERY calls, one chunk per API call. """
+        calls = [call.strip().upper() for call in calls]
+        return [calls[i:i + self.MAX_NAMES_PER_QUERY] for i in range(0, len(calls), self.MAX_NAMES_PER_QUERY)]
+
+    def mergeEntries(self, chunks, results):
+        """ Merges the entries of the queries of every chunk into a dict {CALL: ([longitude, latitude], timestamp)}. Returns None, if all queries failed. """
+        positions = {}
+        failed = 0
+        for chunk, entries in zip(chunks, results):
+            if entries == None:
+                failed += 1
+                continue
+            for entry in entries:
+                try:
+                    call = str(entry['name']).upper()
+                    lat = float(entry['lat']) # if the conversion does not fail, we can be confident, that the response was valid
+                    lng = float(entry['lng'])
+                    timestamp = int(entry['time']) 
+                except Exception as e:
+                    cf.log.error('[APRS] Could not parse an APRS entry. Reason: ' + str(e))
+                    continue
+                if call in chunk and (positions.get(call) == None or positions[call][1] < timestamp): # keep only the newest position per station
+                    positions[call] = ([lng, lat], timestamp)
+                    cf.log.debug('[APRS] Data received for ' + call + ': ' + str(lng) + ' ' +str(lat) + ' Timestamp: ' + str(timestamp))
+        if len(chunks) > 0 and failed == len(chunks): 
+            return None
+        return positions
+
+    def queryParams(self, calls):
+        """ Returns the query parameters for a single API call. """
+        return {
+                "name" : ','.join(calls),
+                "what" : "loc",
+                "apikey":self.key,
+                "format": "json"
+            }
+
+    def parseResponse(self, status_code, text):
+        """ Checks the response of the API and returns the list of entries or None, if the query failed. """
+        if status_code != 200: # check for the correct error code
+            cf.log.error('[APRS] APRS could not fetch date! Server status code: ' + str(status_code))
+            return None
+        data = json.loads(text)
+        if data['result'] != "ok":
+            cf.log.error('[APRS] APRS.fi did not respond with ""ok""! Response: ' + str(data))
+            return None
+        return data['entries']
+
+    def queryEntries(self, calls):
+        """ Performs a single API call for up to MAX_NAMES_PER_QUERY calls. Returns the list of entries or None, if the query fails."""
+        try:
+            response = pool.get(self.APRS_ENDPOINT, self.queryParams(calls), timeout=(3,5))
+            return self.parseResponse(response.status_code, response.text)
+        except Exception as e:
+            cf.log.error('[APRS] Fetching APRS Data failed. Reason: ' + str(e))
+            return None
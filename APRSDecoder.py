@@ -0,0 +1,136 @@
+import calendar
+import time
+
+
+class APRSDecoder:
+    """ Decodes raw APRS packets in TNC2 format (SOURCE>DEST,PATH:INFO) into positions. Uncompressed, compressed (base-91) and Mic-E position reports are supported, with and without timestamp. The positions have the same shape as APRS.getPosition returns them: ([longitude, latitude], timestamp). """
+
+    # Mic-E destination characters -> latitude digit, the spaces of position ambiguity become 0
+    MIC_E_DIGITS = {c : str(i) for i, c in enumerate('0123456789')}
+    MIC_E_DIGITS.update({c : str(i) for i, c in enumerate('ABCDEFGHIJ')})
+    MIC_E_DIGITS.update({c : str(i) for i, c in enumerate('PQRSTUVWXY')})
+    MIC_E_DIGITS.update({'K' : '0', 'L' : '0', 'Z' : '0'})
+
+    @staticmethod
+    def decode(line, now=None):
+        """ Decodes a single packet. Returns ([longitude, latitude], timestamp) or None, if this is no position packet. Packets without timestamp get the current time. """
+        result = APRSDecoder.decodeWithSource(line, now)
+        if result == None:
+            return None
+        return result[1]
+
+    @staticmethod
+    def decodeWithSource(line, now=None):
+        """ Decodes a single packet. Returns (SOURCE, ([longitude, latitude], timestamp)) or None, if this is no position packet. """
+        header, sep, info = line.partition(':')
+        if sep == '' or info == '' or header.startswith('#'):
+            return None
+        source, sep, path = header.partition('>')
+        if sep == '':
+            return None
+        if now == None:
+            now = time.time()
+        try:
+            if info[0] == '}': # third party packet, the station is in the inner packet
+                return APRSDecoder.decodeWithSource(info[1:], now)
+            position = APRSDecoder.decodeInfo(info, path, now)
+        except (ValueError, IndexError, KeyError):
+            return None
+        if position == None:
+            return None
+        return source.upper(), position
+
+    @staticmethod
+    def decodeInfo(info, path, now):
+        """ Decodes the information field of a packet. The path (DEST,DIGI,...) is needed for Mic-E. Returns ([longitude, latitude], timestamp) or None. """
+        dti = info[0]
+        if dti == '!' or dti == '=': # position without timestamp
+            return APRSDecoder.decodePosition(info[1:]), int(now)
+        if dti == '/' or dti == '@': # position with timestamp
+            return APRSDecoder.decodePosition(info[8:]), APRSDecoder.decodeTimestamp(info[1:8], now)
+        if dti == '`' or dti == "'": # Mic-E, the latitude is in the destination address
+            return APRSDecoder.decodeMicE(info, path.split(',', 1)[0]), int(now)
+        return None
+
+    @staticmethod
+    def decodePosition(body):
+        """ Decodes the position of a position report, which is either compressed or uncompressed. Uncompressed positions start with a digit, compressed ones with the symbol table. """
+        if body[0] in '0123456789 ':
+            return APRSDecoder.decodeUncompressed(body)
+        return APRSDecoder.decodeCompressed(body)
+
+    @staticmethod
+    def decodeCompressed(body):
+        """ Decodes a compressed position like /5L!!<*e7>7P[ into [longitude, latitude]. The latitude and longitude are 4 base-91 digits each. """
+        y = (ord(body[1]) - 33) * 753571 + (ord(body[2]) - 33) * 8281 + (ord(body[3]) - 33) * 91 + (ord(body[4]) - 33)
+        x = (ord(body[5]) - 33) * 753571 + (ord(body[6]) - 33) * 8281 + (ord(body[7]) - 33) * 91 + (ord(body[8]) - 33)
+        latitude = 90 - y / 380926
+        longitude = -180 + x / 190463
+        if latitude > 90 or longitude > 180 or latitude < -90 or longitude < -180 or len(body) < 13:
+            raise ValueError('Position out of range')
+        return [longitude, latitude]
+
+    @staticmethod
+    def decodeMicE(info, dest):
+        """ Decodes a Mic-E position into [longitude, latitude]. The latitude and the hemispheres are encoded in the 6 characters of the destination, the longitude in the first 3 bytes after the data type. """
+        digits = APRSDecoder.MIC_E_DIGITS
+        lat = ''.join([digits[c] for c in dest[0:6]])
+        latitude = int(lat[0:2]) + (int(lat[2:4]) + int(lat[4:6]) / 100) / 60
+        if dest[3] < 'P': # south
+            latitude = -latitude
+        degrees = ord(info[1]) - 28
+        if dest[4] >= 'P': # longitude offset
+            degrees += 100
+        if 180 <= degrees <= 189:
+            degrees -= 80
+        elif 190 <= degrees <= 199:
+            degrees -= 190
+        minutes = ord(info[2]) - 28
+        if minutes >= 60:
+            minutes -= 60
+        hundredths = ord(info[3]) - 28
+        longitude = degrees + (minutes + hundredths / 100) / 60
+        if dest[5] >= 'P': # west
+            longitude = -longitude
+        if latitude > 90 or longitude > 180 or latitude < -90 or longitude < -180 or hundredths < 0 or hundredths > 99:
+            raise ValueError('Position out of range')
+        return [longitude, latitude]
+
+    @staticmethod
+    def decodeUncompressed(body):
+        """ Decodes an uncompressed position like 4903.50N/07201.75W> into [longitude, latitude]. Position ambiguity (spaces instead of digits) is resolved to the lowest value. """
+        lat = body[0:8].replace(' ', '0')
+        lng = body[9:18].replace(' ', '0')
+        latitude = int(lat[0:2]) + float(lat[2:7]) / 60
+        longitude = int(lng[0:3]) + float(lng[3:8]) / 60
+        if lat[7] in 'Ss':
+            latitude = -latitude
+        elif lat[7] not in 'Nn':
+            raise ValueError('Invalid latitude hemisphere')
+        if lng[8] in 'Ww':
+            longitude = -longitude
+        elif lng[8] not in 'Ee':
+            raise ValueError('Invalid longitude hemisphere')
+        if latitude > 90 or longitude > 180 or latitude < -90 or longitude < -180:
+            raise ValueError('Position out of range')
+        return [longitude, latitude]
+
+    @staticmethod
+    def decodeTimestamp(stamp, now):
+        """ Decodes a 7 character APRS timestamp (DDHHMMz, DDHHMM/ or HHMMSSh) into a unix timestamp. Local time stamps are treated as UTC. The date is completed with the most recent matching date not in the future. """
+        current = time.gmtime(now)
+        if stamp[6] == 'h':
+            seconds = calendar.timegm((current.tm_year, current.tm_mon, current.tm_mday, int(stamp[0:2]), int(stamp[2:4]), int(stamp[4:6])))
+            if seconds > now + 3600: # sent yesterday
+                seconds -= 86400
+            return seconds
+        if stamp[6] == 'z' or stamp[6] == '/':
+            year, month = current.tm_year, current.tm_mon
+            seconds = calendar.timegm((year, month, int(stamp[0:2]), int(stamp[2:4]), int(stamp[4:6]), 0))
+            if seconds > now + 86400: # sent last month
+                month -= 1
+                if month == 0:
+                    year, month = year - 1, 12
+                seconds = calendar.timegm((year, month, int(stamp[0:2]), int(stamp[2:4]), int(stamp[4:6]), 0))
+            return seconds
+        raise ValueError('Unknown timestamp format')
@@ -1,12 +1,24 @@
 import config as cf
 from OpenRouteService import OpenRouteService
 from APRS import APRS
+from AsyncAPRS import AsyncAPRS
+from APRSIS import APRSIS
 from tests.dummyAPRS import dummyAPRS
 from TelegramChatManager import TelegramChatManager
+from HTTPSessionPool import pool
+from Recorder import recorder
+from ETAEstimator import ETAEstimator
+from PositionHistory import PositionHistory
+from RouteBatch import RouteBatch
+from RequestLimiter import RequestLimiter
+from DestinationInference import DestinationInference
+from SessionManager import SessionManager
+import functools
 import logging
 import os
 import numpy as np
-from time import sleep
+import threading
+from time import sleep, strftime
 
 
 class APRSFriendAlert:
@@ -34,25 +46,44 @@ class APRSFriendAlert:
                     pass
     
 
-    def __init__(self, dummy=False):
-        """Constructor for the basic logic of this bot. This Object holds all subroutines/objects needed to work. """
+    def __init__(self, dummy=False, aprs=None, ors=None, tcm=None):
+        """Constructor for the basic logic of this bot. This Object holds all subroutines/objects needed to work. The subroutines can be replaced by stand-ins: aprs is called like APRS(newDataHandler, roundHandler), tcm like TelegramChatManager(newRouteCallback, geocodeCallback, arrivedCallback), ors is an object like OpenRouteService."""
 
         # Flags
-        self.following = False
-        self.dest = None
-        self.alertees = None
+        self.call = SessionManager.key(os.getenv('APRS_FOLLOW_CALL', '')) # the own station, followed when no other call is given
         self.ALERT_TIMES = [-1, 60, 30, 10, 5, 1] # the intervals during which the alertees are alerted. -1 means the inital away time, regardless of how far that is
-        self.alertState = [False for i in range(len(self.ALERT_TIMES))]
-        self.toStr = 'you'
+        self.sessions = SessionManager(len(self.ALERT_TIMES)) # one follow session per station, all share the poller and the route batch
+        self._roundLock = threading.RLock() # the poller and a manual /arrived in the thread pool of the TCM must not evaluate and notify at the same time
+        self.estimator = ETAEstimator() # skips the route requests far away from the next alert
+        self.isochroneMode = os.getenv('ALERT_MODE') == 'isochrone' # close to the destination, the alerts are decided by the isochrones of the thresholds
+        self.inference = DestinationInference() if os.getenv('PASSIVE_MODE') == 'True' else None # watch the station and suggest the destination
+        self.liveStatus = os.getenv('LIVE_STATUS') == 'True' # every alertee gets one status message per session, which is edited with every new ETA
 
         # Setup the API Bouncers 
-        self.ors = OpenRouteService()
-        if dummy:
-            self.aprs = dummyAPRS(self.newAPRSData)
+        self.ors = OpenRouteService() if ors == None else ors
+        self.routes = RouteBatch(self.ors) # the route requests of a polling round are sent together
+        if aprs != None:
+            self.aprs = aprs(self.newAPRSData, self.endOfRound)
+        elif dummy:
+            self.aprs = dummyAPRS(self.newAPRSData, self.endOfRound)
+        elif os.getenv('APRS_SOURCE') == 'async': # poll on the event loop of the telegram application
+            self.aprs = AsyncAPRS(self.newAPRSData, self.endOfRound)
+        elif os.getenv('APRS_SOURCE') == 'aprsis': # get the packets pushed by an APRS-IS server
+            self.aprs = APRSIS(self.newAPRSData, self.endOfRound)
         else:
-            self.aprs = APRS(self.newAPRSData)
-        self.tcm = TelegramChatManager(self.routeUpdate, self.ors.geocode, self.arrived)
+            self.aprs = APRS(self.newAPRSData, self.endOfRound)
+        if tcm == None:
+            tcm = TelegramChatManager
+        self.tcm = tcm(self.routeUpdate, functools.partial(self.ors.geocode, priority=RequestLimiter.IMMINENT), self.arrived) # a user waits for the answer, BULK is for the precomputation
         cf.log.addHandler(self.ErrorHandler(self.tcm.sendMessage, os.getenv('TELEGRAM_LOGGING_LEVEL'))) # now add the telegram error handler
+        if self.isochroneMode:
+            threading.Thread(target=self.precomputeIsochrones, daemon=True).start() # a follow to a saved address starts without waiting for ORS
+        if self.inference != None: # the station is watched all the time
+            if isinstance(self.aprs, AsyncAPRS):
+                self.tcm.atStartup(self.aprs.start) # the task needs the running event loop
+            else:
+                self.aprs.start()
+            cf.log.info('[AFA] Passive mode active, the destination is inferred from the APRS data.')
         
     def main(self):
         """This function starts the telegram conversation handler. This function will not return, as long as the bot is running."""
@@ -71,106 +102,225 @@ class APRSFriendAlert:
         return output_str
     
 
-    def newAPRSData(self, coords):
-        """This function gets called by the APRS Thread. New data is available and we can check the traveltime to the destionation and notiofy the users."""
-        if not self.following: # following stopped by someone, stop the aprs thread
-            self.aprs.stop() 
+    def newAPRSData(self, coords, call=None):
+        """This function gets called by the APRS Thread with the new position of a station, by default the own one. New data is available and we can check the traveltime to the destionation of its session and notiofy the users."""
+        call = self.call if call == None else call
+        session = self.sessions.get(call)
+        if session == None: # no follow process of this station
+            if call == self.call and self.inference != None:
+                self.inferDestination()
+            elif len(self.sessions) == 0: # following stopped by someone, stop the aprs thread
+                self.idle()
             return
-        cf.log.debug('[AFA] New APRS Data!')
+        cf.log.debug('[AFA] New APRS Data of ' + session.call + '!')
+        history = self.aprs.getHistory(session.call)
+        velocity = history.velocity() if history != None else None
+        if velocity != None:
+            cf.log.debug('[AFA] ' + session.call + ' moves with ' + str(round(velocity[0])) + ' km/h, heading ' + str(round(velocity[1])) + ' deg.')
         
-        if coords != self.dest:
-            response = self.ors.getRouteSummary(coords, self.dest) # now check how long it takes from the current position to the destination
+        if coords == session.dest:
+            self.evaluate(session, [0.0, 0.0])
+            return
+        response = self.getLocalSummary(session, coords) # now check how long it takes from the current position to the destination
+        if response != None:
+            self.evaluate(session, response)
+        else: # the route is requested together with those of all other stations at the end of the polling round
+            self.routes.add(coords, session.dest, lambda response: self.routeReady(session, coords, response), self.routePriority(session, coords))
+
+    def routeReady(self, session, coords, response):
+        """Called with the requested route [distance in km, time in min] or None at the end of the polling round. If the request failed or was refused by the rate limiter, the local estimate is used, so the update is not lost."""
+        if not self.sessions.isActive(session): # ended or replaced while the route was requested
+            return
+        if response != None:
+            self.estimator.calibrate(session.call, coords, session.dest, response[1])
         else:
-            response = [0.0, 0.0]
+            estimate = self.estimator.estimate([session.call], [coords], [session.dest])[0]
+            if not np.isnan(estimate):
+                cf.log.warn('[AFA] No route available for ' + session.call + ', using the local estimate of ' + str(round(estimate)) + ' min.')
+                response = [float(PositionHistory.haversine(coords[0], coords[1], session.dest[0], session.dest[1])), float(estimate)]
+        self.evaluate(session, response)
 
+    def evaluate(self, session, response):
+        """Hands the travel time [distance in km, time in min] of a session to the session manager. The alert thresholds of all sessions are evaluated together at the end of the polling round."""
         if response != None:
-            # extract the distance and time 
-            distance = np.round(response[0],1)
-            time = response[1]
-            timeStr = APRSFriendAlert.getTimeStr(time)
+            self.sessions.report(session, float(response[0]), float(response[1]))
 
-            # now check weather we have to alert somebody
-            if self.alertState[0] == False: # the initial alert. Notify master an the clients
-                self.alertState[0] = True # set the flag for inital alert
-                self.alertState[1:] = [round(time) <= alert_time for alert_time in self.ALERT_TIMES[1:]] # set all flags for longer times. This route will not need every alert
-
-                if all(self.alertState): # we've arrived at the desitination already!?
-                    self.tcm.sendMessage(cf.MASTER_CHATID, 'OOPS! \nIt seems you\'re already at your destination \U0001F3C1 \nI won\'t do anything further.')
-                    self.aprs.stop()
-                    self.following = False
-                    return
-                # Ok now send the messages
-                self.tcm.sendMessage(cf.MASTER_CHATID, '\U0001F698 EN-ROUTE \U0001F698 \n' + os.getenv('APRS_FOLLOW_CALL') + ' is now beeing followed. Your route is ' + str(distance) + ' km long and will take ' + timeStr + '.')
-                url = 'https://aprs.fi/#!mt=roadmap&z=11&call=a%2F{}&timerange=3600&tail=3600'.format( os.getenv('APRS_FOLLOW_CALL'))
-                for alertee in self.alertees:
-                    self.tcm.sendMessage(alertee, 'Great! \U0001F698\n'+ os.getenv('APRS_FOLLOW_CALL') + ' is on its way to '+ self.toStr +'!\n' + os.getenv('APRS_FOLLOW_CALL') + ' is currently ' + str(distance) + ' km and ' + timeStr + ' away.\n\nYou can see ' +   os.getenv('APRS_FOLLOW_CALL')+'\'s position here:\n' + url)
-                cf.log.info('[AFA] Follow Process is started, first packet arrived successfully!')
+    def endOfRound(self):
+        """Called by the poller after every polling round: the route requests of all sessions are sent, then the thresholds of all sessions are evaluated at once and the users notified."""
+        with self._roundLock:
+            self.routes.flush()
+            self.notify(*self.sessions.evaluate(self.ALERT_TIMES))
 
+    def notify(self, sessions, kinds, distances, times, nextAlerts):
+        """The notification stage: sends the messages for the thresholds crossed in this round, as found by SessionManager.evaluate, and tells the poller the new ETAs. The messages of all sessions are sent together, so a chat gets one message per round even if it follows several stations. In the live status mode, the alertees get the initial alert as status message and every new ETA updates it, only the thresholds and the arrival are sent as new messages."""
+        alerts = [] # (chatID, message)
+        statuses = [] # (chatID, key, message, final)
+        for ix in np.flatnonzero(kinds != SessionManager.QUIET).tolist():
+            session, kind, time = sessions[ix], kinds[ix], times[ix]
+            distance = np.round(distances[ix], 1)
+            timeStr = APRSFriendAlert.getTimeStr(time)
+            if kind == SessionManager.ALREADY_THERE: # we've arrived at the desitination already!?
+                alerts.append((session.owner, 'OOPS! \nIt seems you\'re already at your destination \U0001F3C1 \nI won\'t do anything further.'))
+                self.finish(session, None) # no status message was sent yet
+            elif kind == SessionManager.STARTED: # the initial alert. Notify master an the clients
+                alerts.append((session.owner, '\U0001F698 EN-ROUTE \U0001F698 \n' + session.call + ' is now beeing followed. Your route is ' + str(distance) + ' km long and will take ' + timeStr + '.'))
+                url = 'https://aprs.fi/#!mt=roadmap&z=11&call=a%2F{}&timerange=3600&tail=3600'.format(session.call)
+                for alertee in session.alertees if not self.liveStatus else []: # the status message below is the initial alert
+                    alerts.append((alertee, 'Great! \U0001F698\n'+ session.call + ' is on its way to '+ session.toStr +'!\n' + session.call + ' is currently ' + str(distance) + ' km and ' + timeStr + ' away.\n\nYou can see ' + session.call +'\'s position here:\n' + url))
+                cf.log.info('[AFA] Follow Process of ' + session.call + ' is started, first packet arrived successfully!')
             else:
-                # now get the next index of the time we have to wait for. 
-                # if the self.alertState is [True, True, False, False, False] nextAlertIx will be 2
-                nextAlertIx = np.where(self.alertState)[0][-1] + 1 
-                # now check if the next time falls below the alert threshold
-                if round(time) <= self.ALERT_TIMES[nextAlertIx]:
-                    message = ''
-                    self.alertState[1:] = [round(time) <= alert_time for alert_time in self.ALERT_TIMES[1:]] # set the flag(s) if we skipped a alert
-                    if all(self.alertState): # are we there yet?
-                        message = '\U0001F6A8 ' + os.getenv('APRS_FOLLOW_CALL') + ' arrived! \U0001F3C1'
-                        self.tcm.sendMessage(cf.MASTER_CHATID, 'You\'ve arrived at your destination! \U0001F3C1')
-                        self.aprs.stop()
-                        self.following = False
-                        cf.log.info('[AFA] You have arrived at your desitination. Stopping processes...')
-                    else:
-                        message = '\U0001F697 ' + os.getenv('APRS_FOLLOW_CALL') + ' is currently ' + str(distance) + ' km and ' + timeStr + ' away.'
-                    
-                    # message is built, send it 
-                    for alertee in self.alertees:
-                        self.tcm.sendMessage(alertee, message)
-                    cf.log.debug('[AFA] Messages have been set. Time to destination ' + timeStr)
+                if kind == SessionManager.ARRIVED: # are we there yet?
+                    message = '\U0001F6A8 ' + session.call + ' arrived! \U0001F3C1'
+                    alerts.append((session.owner, 'You\'ve arrived at your destination! \U0001F3C1'))
+                    self.finish(session, '\U0001F3C1 ' + session.call + ' has arrived!')
+                    cf.log.info('[AFA] ' + session.call + ' has arrived at its desitination. Stopping processes...')
                 else:
-                    cf.log.debug('[AFA] Nobody to notify. Time to destination ' + timeStr)
+                    message = '\U0001F697 ' + session.call + ' is currently ' + str(distance) + ' km and ' + timeStr + ' away.'
+                # message is built, send it 
+                for alertee in session.alertees:
+                    alerts.append((alertee, message))
+                cf.log.debug('[AFA] Messages have been set. Time to destination ' + timeStr)
+        for session, distance, time in zip(sessions, distances.tolist(), times.tolist()) if self.liveStatus else []:
+            if self.sessions.isActive(session):
+                statuses += self.statusUpdate(session, '\U0001F698 ' + session.call + ' is on its way to ' + session.toStr + '!\n' + session.call + ' is currently ' + str(round(distance, 1)) + ' km and ' + APRSFriendAlert.getTimeStr(time) + ' away.')
+        self.tcm.sendAlerts(alerts)
+        if len(statuses) > 0:
+            self.tcm.sendStatus(statuses)
+        for session, time, nextAlert in zip(sessions, times.tolist(), nextAlerts.tolist()):
+            if self.sessions.isActive(session): # let the poller know how urgent the next packet is
+                self.aprs.updateETA(session.call, time, None if np.isnan(nextAlert) else nextAlert)
 
+    def routePriority(self, session, coords):
+        """Returns the priority of a route request for the rate limiter. The first route is awaited by the owner and a route needed although the local estimate is calibrated is close to an alert threshold. Everything else can wait."""
+        if self.sessions.nextThreshold(session) == 0:
+            return RequestLimiter.IMMINENT
+        estimate = self.estimator.estimate([session.call], [coords], [session.dest])[0]
+        return RequestLimiter.BACKGROUND if np.isnan(estimate) else RequestLimiter.IMMINENT
 
+    def precomputeIsochrones(self):
+        """Requests the isochrones of all saved addresses, so they are cached before the first follow process."""
+        for user in list(cf.USER_DATA.values()):
+            if not user.get('VALID'):
+                continue
+            for address in user.get('ADDRESSES', []):
+                self.ors.getIsochrones(address['COORDS'], self.ALERT_TIMES[1:], priority=RequestLimiter.BULK)
+        cf.log.info('[AFA] Isochrones of the saved addresses precomputed.')
 
-    def routeUpdate(self, dest, alertees, toStr = None):
-        """This function is to be called by the TelegramChatManager and tells the main logic where the new route is going. It initiates or terminates the process. The desitination is None if the follow process is to be terminated, otherwise the desitnation coordinates. Alerts is a list of chatIDs which are to be alerted."""
-        if dest == None:
+    def getLocalSummary(self, session, coords):
+        """Returns [distance in km, time in min] from coords to the destination of the session, if it can be told without a route request, None otherwise. In the isochrone mode, a position within the isochrones is classified locally and the time is the smallest threshold whose isochrone contains it. While the local estimate is far away from the next alert threshold, the estimate is returned."""
+        nextIx = self.sessions.nextThreshold(session)
+        following = nextIx > 0 and nextIx < len(self.ALERT_TIMES) # the initial alert always needs the real route
+        if self.isochroneMode and following:
+            isochrones = self.ors.getIsochrones(session.dest, self.ALERT_TIMES[1:])
+            if isochrones != None:
+                threshold = isochrones.classify(coords)
+                if threshold != None:
+                    cf.log.debug('[AFA] ' + session.call + ' is within the ' + str(round(threshold)) + ' min isochrone.')
+                    return [float(PositionHistory.haversine(coords[0], coords[1], session.dest[0], session.dest[1])), float(threshold)]
+        if following:
+            nextAlert = self.ALERT_TIMES[nextIx]
+            needed, estimates = self.estimator.needsRoute([session.call], [coords], [session.dest], [nextAlert])
+            if not needed[0]:
+                cf.log.debug('[AFA] Local estimate ' + str(round(estimates[0])) + ' min is far from the next alert, no route requested.')
+                if not self.estimator.audit:
+                    return [float(PositionHistory.haversine(coords[0], coords[1], session.dest[0], session.dest[1])), float(estimates[0])]
+                response = self.ors.getRouteSummary(coords, session.dest)
+                if response != None:
+                    self.estimator.check(estimates[0], response[1], nextAlert)
+                    self.estimator.calibrate(session.call, coords, session.dest, response[1])
+                return response
+        return None
+
+    def inferDestination(self):
+        """Called with every packet of the own station while it is not followed in the passive mode. Once the inference is sure where the station is heading to, the owner is asked to start the follow process to that address."""
+        history = self.aprs.getHistory(self.call)
+        if history == None:
+            return
+        key = self.inference.update(history)
+        if key == None:
+            return
+        chatid, ix = key
+        try:
+            user = cf.USER_DATA[chatid]
+            address = user['ADDRESSES'][ix]
+        except (KeyError, IndexError): # removed since the index was updated
+            return
+        cf.log.info('[AFA] Destination inferred: ' + user['NAME'] + '\'s address ' + address['ADDR_NAME'])
+        message = '\U0001F9ED ' + self.call + ' seems to be on its way to ' + user['NAME'] + '\'s address ' + address['ADDR_NAME'] + ', ' + address['ADDR'] + '.\nReply \'yes\' to start the following process and alert ' + user['NAME'] + ', or \'no\' to ignore it.'
+        self.tcm.proposeRoute(address['COORDS'], [chatid], '', message)
+
+    def idle(self):
+        """Stops the APRS poller once no session is left, unless the passive mode keeps watching the station."""
+        if self.inference != None:
+            self.inference.reset()
+        else:
             self.aprs.stop()
-            self.following = False
-            self.dest = None
-            self.alertees = None
-            self.alertState = [False, False, False, False, False, False]
-            self.toStr = 'you'
-            cf.log.info('[AFA] Quitting following process.')    
+
+    def statusUpdate(self, session, message, final=False):
+        """Returns the updates of the live status messages of the alertees of a session, with the time of the update and the link to the position."""
+        url = 'https://aprs.fi/#!mt=roadmap&z=11&call=a%2F{}&timerange=3600&tail=3600'.format(session.call)
+        message += '\nLast update: ' + strftime('%H:%M') + '\n\nYou can see ' + session.call + '\'s position here:\n' + url
+        return [(alertee, (session.call, session.started), message, final) for alertee in session.alertees]
+
+    def finish(self, session, status='\u23F9 The follow process was ended.'):
+        """Ends a session: the station is no longer polled for it and its route and estimate are forgotten. The poller is stopped, if it was the last one. In the live status mode, the status messages of the session are set to the final status, if they were sent."""
+        if not self.sessions.isActive(session):
+            return
+        if self.liveStatus and status != None and self.sessions.nextThreshold(session) > 0:
+            self.tcm.sendStatus(self.statusUpdate(session, status, True))
+        self.sessions.stop(session.call)
+        self.aprs.updateETA(session.call, None, None)
+        self.estimator.forget(session.call)
+        if len(self.sessions.headingTo(session.dest)) == 0:
+            self.ors.forgetRoute(session.dest) # the next trip gets a fresh route
+        if session.call != self.call:
+            self.aprs.untrack(session.call)
+        if len(self.sessions) == 0:
+            self.idle()
+
+    def routeUpdate(self, dest, alertees, toStr = None, call = None):
+        """This function is to be called by the TelegramChatManager and tells the main logic where the new route is going. It initiates or terminates the follow session of the station call, by default the own one. The desitination is None if the follow process is to be terminated, otherwise the desitnation coordinates. Alerts is a list of chatIDs which are to be alerted."""
+        call = self.call if call == None else call
+        recorder.recordRoute(dest, alertees, toStr, None if call == self.call else call)
+        session = self.sessions.get(call)
+        if session != None:
+            self.finish(session)
+        if dest == None:
+            cf.log.info('[AFA] Quitting following process of ' + call + '.')    
         else:
-            self.dest = dest
-            self.alertees = alertees
-            self.following = True
-            self.alertState = [False, False, False, False, False, False]
-            if toStr == None or toStr == '':
-                self.toStr = 'you'
-            else:
-                self.toStr = toStr
+            session = self.sessions.start(call, dest, alertees, 'you' if toStr == None or toStr == '' else toStr)
+            if session.call != self.call:
+                self.aprs.track(session.call, lambda coords: self.newAPRSData(coords, session.call))
+            self.aprs.updateETA(session.call, None, None) # nothing known about the new route yet
+            self.estimator.forget(session.call)
             self.aprs.start()
-            cf.log.info('[AFA] New following process initiated.')
+            cf.log.info('[AFA] New following process of ' + session.call + ' initiated. Active sessions: ' + str(len(self.sessions)))
 
-    def arrived(self):
-        """  This function may be called from the TCM. It is used to manually trigger the arrival. It returns false, if there is no routing active. Otherwise true."""
-        if self.following == False:
+    def arrived(self, call = None):
+        """  This function may be called from the TCM, from a thread of its pool. It is used to manually trigger the arrival of the station call, by default the own one. It returns false, if there is no routing active. Otherwise true."""
+        session = self.sessions.get(self.call if call == None else call)
+        if session == None:
             return False
-        cf.log.info('[AFA] Manual arrival triggered.')
-        self.newAPRSData(self.dest)
+        cf.log.info('[AFA] Manual arrival of ' + session.call + ' triggered.')
+        with self._roundLock:
+            self.newAPRSData(session.dest, session.call)
+            self.endOfRound()
         return True
 
 
     
-
-
-
 if __name__ == '__main__':
     afa = APRSFriendAlert(dummy=False) # change to true for testing
     afa.main()
     afa.aprs.stop()
+    afa.ors.logStats()
+    afa.estimator.logStats()
+    afa.routes.logStats()
+    if afa.inference != None:
+        afa.inference.logStats()
+    afa.tcm.outbox.logStats()
+    afa.tcm.loopMonitor.logStats()
+    pool.logStats()
     cf.log.info('[AFA] System shutting down.')
     #tcm = TelegramChatManager(None, None)
     #distance = 2300
@@ -0,0 +1,274 @@
+import config as cf
+from APRSDecoder import APRSDecoder
+from PositionHistory import PositionHistory
+from Recorder import recorder
+import os
+import socket
+import threading
+import time
+
+
+class APRSIS():
+    """ A push based position source. It connects to an APRS-IS server with a budlist filter for all tracked stations and hands each position packet to the handler of its station as soon as it arrives. It has the same interface as the APRS poller. """
+
+    def __init__(self, newDataHandler, roundHandler=None):
+        """ Constructor for the APRS-IS stream. It reads the server and the call from the .env file. The connection is opened once the stream is started. The optional roundHandler is called once for the packets of a short time window or once enough packets came in, a stream has no polling rounds of its own. """
+        self.newDataHandler = newDataHandler
+        self.roundHandler = roundHandler
+        self._stop_event = True
+        self._running = False
+        self._socket = None
+        self._lock = threading.Lock()
+
+        self.SOFTWARE = 'APRSFriendAlert 1.0'
+        self.KEEPALIVE_INTERVAL = 120 # seconds between two keepalive comments sent to the server
+        self.READ_TIMEOUT = 60 # the server sends a comment every 20 sec, if nothing arrives for this long, the connection is dead
+        self.MAX_BACKOFF = 300 # the longest wait between two reconnects
+        # the packets are handed out at once, but the round handler batches the work of several packets
+        try:
+            self.ROUND_INTERVAL = float(os.getenv('APRSIS_ROUND_INTERVAL', 1)) # sec after the first packet of a round
+            self.ROUND_PACKETS = int(os.getenv('APRSIS_ROUND_PACKETS', 50)) # or this many packets, whatever comes first
+        except:
+            self.ROUND_INTERVAL = 1.0
+            self.ROUND_PACKETS = 50
+            cf.log.error('[APRSIS] Could not read APRSIS_ROUND_INTERVAL or APRSIS_ROUND_PACKETS. Default: 1 sec, 50 packets')
+        self.roundStarted = None # time of the first packet of the current round
+        self.roundPackets = [] # packet times of the current round, for the delay statistics
+
+        self.server = os.getenv('APRSIS_SERVER', 'rotate.aprs2.net')
+        try:
+            self.port = int(os.getenv('APRSIS_PORT', 14580))
+        except:
+            self.port = 14580
+            cf.log.error('[APRSIS] Could not read APRSIS_PORT. Default: 14580')
+        self.call = os.getenv('APRS_FOLLOW_CALL')
+        self.loginCall = os.getenv('APRSIS_LOGIN_CALL', self.call)
+        self.passcode = os.getenv('APRSIS_PASSCODE', '-1') # -1 is a receive only login
+
+        self.handlers = {}
+        self.coords = {}
+        self.lastTimestamps = {}
+        self.histories = {} # call -> PositionHistory of the last fixes
+        try:
+            self.HISTORY_SIZE = int(os.getenv('APRS_HISTORY_SIZE', 256))
+        except:
+            self.HISTORY_SIZE = 256
+            cf.log.error('[APRSIS] Could not read APRS_HISTORY_SIZE. Default: 256')
+        if self.call != None and self.call != '':
+            self.track(self.call, newDataHandler)
+
+        # statistics
+        self.packets = 0
+        self.totalDelay = 0.0
+
+        self.validated = self.loginCall != None and self.loginCall != ''
+        if not self.validated:
+            cf.log.critical('[APRSIS] APRS Call is not set, cannot use APRS-IS!')
+
+    def stop(self):
+        """ Stops the stream and closes the connection. """
+        self._stop_event = True
+        with self._lock:
+            if self._socket != None:
+                try:
+                    self._socket.shutdown(socket.SHUT_RDWR) # wakes up the reading thread
+                except OSError:
+                    pass
+
+    def start(self):
+        """Creates a new thread using the run function and starts it, if we cannot use the previous/still running thread"""
+        self._stop_event = False
+        if self._running == False:
+            self._running = True
+            threading.Thread(target=self.run).start()
+
+    def track(self, call, newDataHandler):
+        """Adds a callsign to the budlist filter. The handler is called with the coordinates of each new packet of this station."""
+        call = call.strip().upper()
+        self.handlers[call] = newDataHandler
+        self.lastTimestamps[call] = int(time.time())
+        if self.histories.get(call) == None:
+            self.histories[call] = PositionHistory(self.HISTORY_SIZE)
+        self.sendFilter()
+        cf.log.debug('[APRSIS] Now tracking ' + call + '. Tracked stations: ' + str(len(self.handlers)))
+
+    def untrack(self, call):
+        """Removes a callsign from the budlist filter."""
+        call = call.strip().upper()
+        self.handlers.pop(call, None)
+        self.coords.pop(call, None)
+        self.lastTimestamps.pop(call, None)
+        self.histories.pop(call, None)
+        self.sendFilter()
+        cf.log.debug('[APRSIS] Stopped tracking ' + call + '. Tracked stations: ' + str(len(self.handlers)))
+
+    def getHistory(self, call):
+        """Returns the PositionHistory of a tracked station or None."""
+        return self.histories.get(call.strip().upper())
+
+    def updateETA(self, call, eta, nextAlert):
+        """The stream gets every packet right away, there is nothing to schedule."""
+        pass
+
+    def getFilter(self):
+        """ Returns the server side budlist filter for all tracked stations. """
+        return 'b/' + '/'.join(self.handlers.keys())
+
+    def sendFilter(self):
+        """ Sends the current filter to the server, if connected. """
+        self.send('#filter ' + self.getFilter())
+
+    def send(self, line):
+        """ Sends a single line to the server. Returns False, if that was not possible. """
+        with self._lock:
+            if self._socket == None:
+                return False
+            try:
+                self._socket.sendall((line + '\r\n').encode('ascii', 'replace'))
+                return True
+            except OSError as e:
+                cf.log.warn('[APRSIS] Could not send to the server. Reason: ' + str(e))
+                return False
+
+    def connect(self):
+        """ Opens the connection and logs in with the budlist filter. Returns the socket or None, if this failed. """
+        try:
+            sock = socket.create_connection((self.server, self.port), timeout=10)
+            sock.settimeout(self.READ_TIMEOUT)
+            login = 'user ' + self.loginCall + ' pass ' + self.passcode + ' vers ' + self.SOFTWARE + ' filter ' + self.getFilter()
+            sock.sendall((login + '\r\n').encode('ascii', 'replace'))
+            cf.log.info('[APRSIS] Connected to ' + self.server + ':' + str(self.port) + ' with filter ' + self.getFilter())
+            return sock
+        except OSError as e:
+            cf.log.error('[APRSIS] Connecting to ' + self.server + ' failed. Reason: ' + str(e))
+            return None
+
+    def run(self):
+        """ This is the entry point for the thread. It keeps the connection open and reconnects with an exponential backoff, if the connection is lost."""
+        cf.log.debug('[APRSIS] New Thread entry')
+        self._running = True
+        failCount = 0
+        self.resetTimestamps()
+        while self._stop_event == False:
+            sock = self.connect()
+            if sock != None:
+                with self._lock:
+                    self._socket = sock
+                if self.readStream(sock):
+                    failCount = 0 # the connection has been working, reconnect right away
+                self.endRound() # the packets received so far
+                with self._lock:
+                    self._socket = None
+                try:
+                    sock.close()
+                except OSError:
+                    pass
+            if self._stop_event:
+                break
+            failCount += 1
+            wait = min(self.MAX_BACKOFF, 2 ** failCount)
+            cf.log.warn('[APRSIS] Connection lost, reconnecting in ' + str(wait) + ' sec.')
+            self.sleep(wait)
+        self._running = False
+        self.logStats()
+        cf.log.debug('[APRSIS] Thread exit')
+
+    def sleep(self, seconds):
+        """ Sleeps, but wakes up early if the stream is stopped. """
+        end = time.time() + seconds
+        while self._stop_event == False and time.time() < end:
+            time.sleep(min(1, end - time.time()))
+
+    def readStream(self, sock):
+        """ Reads lines from the server until the connection breaks or the stream is stopped. Returns True, if at least one packet or server comment was received. """
+        received = False
+        buffer = b''
+        lastKeepalive = time.time()
+        lastData = time.time()
+        while self._stop_event == False:
+            if self.roundStarted != None: # wake up in time to end the round
+                sock.settimeout(max(0.01, min(self.READ_TIMEOUT - (time.time() - lastData), self.roundStarted + self.ROUND_INTERVAL - time.time())))
+            else:
+                sock.settimeout(max(0.01, self.READ_TIMEOUT - (time.time() - lastData)))
+            try:
+                data = sock.recv(4096)
+            except socket.timeout:
+                if time.time() - lastData < self.READ_TIMEOUT: # only the round is due
+                    self.endRound()
+                    continue
+                cf.log.warn('[APRSIS] Nothing received for ' + str(self.READ_TIMEOUT) + ' sec.')
+                return received
+            except OSError as e:
+                if not self._stop_event:
+                    cf.log.warn('[APRSIS] Reading from the server failed. Reason: ' + str(e))
+                return received
+            if data == b'': # server closed the connection
+                return received
+            received = True
+            lastData = time.time()
+            buffer += data
+            *lines, buffer = buffer.split(b'\n')
+            for line in lines:
+                self.handleLine(line.decode('latin-1').rstrip('\r'))
+            if self.roundStarted != None and time.time() - self.roundStarted >= self.ROUND_INTERVAL:
+                self.endRound()
+            if time.time() - lastKeepalive > self.KEEPALIVE_INTERVAL: # keep the login alive, even if the stations are quiet
+                self.send('#keepalive')
+                lastKeepalive = time.time()
+        return received
+
+    def resetTimestamps(self):
+        """ The stream has started, wait for the next incoming packet of every station to be seen as "new". """
+        for call in list(self.lastTimestamps.keys()):
+            self.lastTimestamps[call] = int(time.time())
+
+    def handleLine(self, line):
+        """ Handles a single line of the stream. Server comments are logged, position packets of tracked stations are handed to their handlers. """
+        if line.startswith('#'):
+            if 'logresp' in line:
+                cf.log.info('[APRSIS] ' + line[2:])
+            return
+        received = time.time()
+        result = APRSDecoder.decodeWithSource(line, received)
+        if result == None:
+            return
+        call, (coord, timestamp) = result
+        handler = self.handlers.get(call)
+        if handler == None or timestamp < self.lastTimestamps.get(call, 0): # not tracked or older than the last packet
+            return
+        recorder.recordPacket(line)
+        cf.log.debug('[APRSIS] Data received for ' + call + ': ' + str(coord[0]) + ' ' + str(coord[1]) + ' Timestamp: ' + str(timestamp))
+        self.coords[call] = coord
+        self.lastTimestamps[call] = timestamp
+        self.histories[call].append(timestamp, coord)
+        handler(coord)
+        if self.roundStarted == None:
+            self.roundStarted = time.time()
+        self.roundPackets.append(min(received, timestamp)) # packets without timestamp are only known since they arrived
+        if len(self.roundPackets) >= self.ROUND_PACKETS:
+            self.endRound()
+
+    def endRound(self):
+        """ Calls the round handler once for all packets handled since the last round. """
+        if self.roundStarted == None:
+            return
+        if self.roundHandler != None:
+            self.roundHandler()
+        # the delay from the packet to the handled alert
+        now = time.time()
+        self.packets += len(self.roundPackets)
+        self.totalDelay += sum(now - t for t in self.roundPackets)
+        self.roundStarted = None
+        self.roundPackets = []
+
+    def stats(self):
+        """ Returns the number of handled packets and the mean packet-to-alert delay in seconds. The poller measures the same, so both sources can be compared. """
+        if self.packets == 0:
+            return {'packets' : 0, 'meanDelay' : None}
+        return {'packets' : self.packets, 'meanDelay' : self.totalDelay / self.packets}
+
+    def logStats(self):
+        """ Writes the delay statistics to the log. """
+        stats = self.stats()
+        if stats['packets'] > 0:
+            cf.log.info('[APRSIS] ' + str(stats['packets']) + ' packets handled, mean packet-to-alert delay ' + str(round(stats['meanDelay'], 1)) + ' sec.')
@@ -0,0 +1,139 @@
+import config as cf
+from PositionHistory import PositionHistory
+import heapq
+import math
+import threading
+import numpy as np
+
+
+class AddressIndex:
+    """ A spatial index over the saved addresses of all users. It is a KD-tree over the unit vectors of the addresses: the straight chord between two unit vectors grows with their great-circle distance, so the tree can work in plain 3D without any trouble at the poles or the date line. The addresses are updated per user, the tree is rebuilt on the next query after a change. """
+
+    LEAF_SIZE = 8 # addresses per leaf, they are scanned one by one
+
+    def __init__(self, userData):
+        """ Builds the index over userData, which is structured like cf.USER_DATA. """
+        self._lock = threading.Lock()
+        self.entries = {} # chatid -> list of (x, y, z, chatid, index of the address)
+        self.tree = None
+        self.dirty = True
+        self.rebuilds = 0
+        self.version = 0 # counts the changes, for the cached arrays of points
+        self.snapshot = None # (version, keys, unit vectors)
+        for chatid in list(userData.keys()):
+            self.updateUser(chatid, userData)
+
+    @staticmethod
+    def unitVector(lng, lat):
+        """ Returns the unit vector (x, y, z) of a position. """
+        lng, lat = math.radians(lng), math.radians(lat)
+        return (math.cos(lat) * math.cos(lng), math.cos(lat) * math.sin(lng), math.sin(lat))
+
+    @staticmethod
+    def toKm(chord):
+        """ Converts the chord between two unit vectors into the great-circle distance in km. """
+        return 2 * PositionHistory.EARTH_RADIUS * math.asin(min(1.0, chord / 2))
+
+    def updateUser(self, chatid, userData=None):
+        """ Re-indexes all addresses of a user, e.g. after one was added or removed. """
+        userData = cf.USER_DATA if userData == None else userData
+        with self._lock:
+            user = userData.get(chatid)
+            if user == None:
+                self.entries.pop(chatid, None)
+            else:
+                self.entries[chatid] = [self.unitVector(float(a['COORDS'][0]), float(a['COORDS'][1])) + (chatid, ix) for ix, a in enumerate(user.get('ADDRESSES', []))]
+            self.dirty = True
+            self.version += 1
+
+    def removeUser(self, chatid):
+        """ Removes all addresses of a deleted user. """
+        with self._lock:
+            self.entries.pop(chatid, None)
+            self.dirty = True
+            self.version += 1
+
+    def build(self, entries):
+        """ Builds a (sub)tree. A node is (axis, split, lower, upper), a leaf is a list of entries. """
+        if len(entries) <= self.LEAF_SIZE:
+            return entries
+        points = np.array([e[:3] for e in entries])
+        axis = int(np.argmax(points.max(axis=0) - points.min(axis=0))) # split the widest dimension
+        order = np.argsort(points[:, axis], kind='stable')
+        middle = len(entries) // 2
+        split = float(points[order[middle], axis])
+        return (axis, split, self.build([entries[i] for i in order[:middle]]), self.build([entries[i] for i in order[middle:]]))
+
+    def getTree(self):
+        """ Returns the tree, rebuilt if the addresses changed. The lock must be held. """
+        if self.dirty:
+            self.tree = self.build([e for entries in self.entries.values() for e in entries])
+            self.dirty = False
+            self.rebuilds += 1
+        return self.tree
+
+    def nearest(self, point, k=1, maxDistance=None):
+        """ Returns the k nearest addresses to the point [lng, lat] as list of (distance in km, chatid, index of the address), closest first. Only addresses within maxDistance km are returned, if it is given. """
+        q = self.unitVector(point[0], point[1])
+        limit = math.inf if maxDistance == None else (2 * math.sin(min(maxDistance / PositionHistory.EARTH_RADIUS, math.pi) / 2)) ** 2
+        best = [] # heap of (-squared chord, chatid, index) of the k best so far
+        with self._lock:
+            stack = [self.getTree()]
+            while len(stack) > 0:
+                node = stack.pop()
+                worst = -best[0][0] if len(best) == k else limit
+                if isinstance(node, list):
+                    for x, y, z, chatid, ix in node:
+                        d = (x - q[0]) ** 2 + (y - q[1]) ** 2 + (z - q[2]) ** 2
+                        if d <= worst:
+                            if len(best) == k:
+                                heapq.heapreplace(best, (-d, chatid, ix))
+                            else:
+                                heapq.heappush(best, (-d, chatid, ix))
+                            worst = -best[0][0] if len(best) == k else limit
+                    continue
+                axis, split, lower, upper = node
+                diff = q[axis] - split
+                near, far = (lower, upper) if diff < 0 else (upper, lower)
+                if diff * diff <= worst: # the other side can hold a closer address
+                    stack.append(far)
+                stack.append(near) # searched first
+        return sorted((self.toKm(math.sqrt(-d)), chatid, ix) for d, chatid, ix in best)
+
+    def within(self, point, radius):
+        """ Returns all addresses within radius km of the point [lng, lat] as list of (distance in km, chatid, index of the address), closest first. """
+        q = self.unitVector(point[0], point[1])
+        limit = (2 * math.sin(min(radius / PositionHistory.EARTH_RADIUS, math.pi) / 2)) ** 2 # squared chord of the radius
+        found = []
+        with self._lock:
+            stack = [self.getTree()]
+            while len(stack) > 0:
+                node = stack.pop()
+                if isinstance(node, list):
+                    for x, y, z, chatid, ix in node:
+                        d = (x - q[0]) ** 2 + (y - q[1]) ** 2 + (z - q[2]) ** 2
+                        if d <= limit:
+                            found.append((self.toKm(math.sqrt(d)), chatid, ix))
+                    continue
+                axis, split, lower, upper = node
+                diff = q[axis] - split
+                if diff < 0 or diff * diff <= limit:
+                    stack.append(lower)
+                if diff >= 0 or diff * diff <= limit:
+                    stack.append(upper)
+        found.sort()
+        return found
+
+    def points(self):
+        """ Returns all addresses as (list of (chatid, index of the address), array of their unit vectors), for vectorized scans over every address. The array is cached until the addresses change. """
+        with self._lock:
+            if self.snapshot == None or self.snapshot[0] != self.version:
+                entries = [e for entries in self.entries.values() for e in entries]
+                self.snapshot = (self.version, [e[3:] for e in entries], np.array([e[:3] for e in entries], dtype=float).reshape(-1, 3))
+            return self.snapshot[1:]
+
+    def __len__(self):
+        return sum(len(entries) for entries in self.entries.values())
+
+
+addressIndex = AddressIndex(cf.USER_DATA) # the shared index, kept up to date by the TelegramChatManager
@@ -0,0 +1,100 @@
+import config as cf
+from APRS import APRS
+from HTTPSessionPool import pool
+import asyncio
+
+
+class AsyncAPRS(APRS):
+    """ The asyncio version of the APRS poller. It runs as a task on the event loop of the Telegram application instead of its own thread, so it can be cancelled right away and polls all chunks of stations concurrently. Only the requests to aprs.fi run on the loop, the new positions are processed in a worker thread, as the routing requests and the rate limiter block. """
+
+    def __init__(self, newDataHandler, roundHandler=None):
+        """ Constructor for the async APRS API Object. The validation on startup is done with a blocking request, as the event loop is not running yet. """
+        super().__init__(newDataHandler, roundHandler)
+        self._task = None
+        self._loop = None # the loop of the task, known after the first start
+
+    def onLoop(self):
+        """ True, if called from within the event loop of the task (or if there is none yet). """
+        try:
+            return self._loop == None or asyncio.get_running_loop() is self._loop
+        except RuntimeError: # no loop running in this thread
+            return False
+
+    def stop(self):
+        """ Stops the polling task. The task is cancelled immediately, even if it is waiting for the next poll. Can be called from any thread, e.g. by the handlers running in the thread pool. """
+        self._stop_event = True
+        if not self.onLoop(): # a task may only be cancelled on its own loop
+            try:
+                self._loop.call_soon_threadsafe(self.stop)
+            except RuntimeError: # the event loop is already closed, the task is gone anyways
+                pass
+            return
+        if self._task != None and not self._task.done():
+            try:
+                self._task.cancel()
+            except RuntimeError: # the event loop is already closed, the task is gone anyways
+                pass
+        self._task = None # a cancelled task is not done before it ran once more, a start right after must create a new one
+
+    def start(self):
+        """ Creates a new polling task on the running event loop, if there is no task running yet. Must be called from within the event loop, once it ran the first time it can be called from any thread. """
+        self._stop_event = False
+        if not self.onLoop():
+            try:
+                self._loop.call_soon_threadsafe(self.start)
+            except RuntimeError:
+                pass
+            return
+        if self._task == None or self._task.done():
+            try:
+                self._loop = asyncio.get_running_loop()
+                self._task = self._loop.create_task(self.run())
+            except RuntimeError:
+                cf.log.critical('[APRS] The async APRS poller can only be started from within the event loop!')
+
+    async def run(self):
+        """ This is the entry point for the polling task. It will query APRS.fi for all tracked stations. It implemenmts an exponential backoff algorithm, if aprs.fi is offline."""
+        cf.log.debug('[APRS] New task entry')
+        self._running = True
+        failCount = 0
+        try:
+            await asyncio.sleep(3) # Wait a sec, this relaxes the Telegram API a bit
+            self.resetTimestamps()
+            while self._stop_event == False: # loop, unless stopped
+                cf.log.debug('[APRS] Querring APRS API...')
+                data = await self.getPositionsAsync(list(self.handlers.keys()))
+                if data != None:
+                    await asyncio.to_thread(self.processPositions, data) # the handlers request routes, this must not block the conversations
+                    failCount = 0
+                    await asyncio.sleep(self.nextPollInterval())
+                else:
+                    failCount = failCount + 1
+                    if failCount == 7:
+                        self.giveUp()
+                        return
+                    await asyncio.sleep(self.backoffInterval(failCount))
+        except asyncio.CancelledError:
+            cf.log.debug('[APRS] Task cancelled')
+        finally:
+            self._running = False
+            self.logStats()
+            cf.log.debug('[APRS] Task exit')
+
+    async def getPositionsAsync(self, calls, tryAnyway=False):
+        """ The async version of getPositions. All chunks are queried concurrently. Returns a dict {CALL: ([longitude, latitude], timestamp)} or None, if all queries fail. """
+        if self.validated or tryAnyway: # Only query API once it has been tested to work
+            chunks = self.splitCalls(calls)
+            results = await asyncio.gather(*[self.queryEntriesAsync(chunk) for chunk in chunks])
+            return self.mergeEntries(chunks, results)
+        else:
+            cf.log.warn('[APRS] Tried getPosition, but APRS API is not validated!')
+            return None
+
+    async def queryEntriesAsync(self, calls):
+        """ The async version of queryEntries. Returns the list of entries or None, if the query fails. """
+        try:
+            response = await pool.getAsync(self.APRS_ENDPOINT, self.queryParams(calls), timeout=(3,5))
+            return self.parseResponse(response.status_code, response.text)
+        except Exception as e:
+            cf.log.error('[APRS] Fetching APRS Data failed. Reason: ' + str(e))
+            return None
@@ -0,0 +1,20 @@
+import time
+
+
+class Clock:
+    """ The time the bot works with. It is the wall clock, but the replay sets it to the time of the recording, so the ages of the reused routes, the retries and the poll schedule are measured like in the recorded run. """
+
+    def __init__(self):
+        """ Constructor of the clock, it starts as the wall clock. """
+        self.fixed = None
+
+    def time(self):
+        """ Returns the current time in sec since the epoch, like time.time(). """
+        return time.time() if self.fixed == None else self.fixed
+
+    def set(self, t):
+        """ Fixes the clock to the time t, e.g. the time of a recorded event. None returns to the wall clock. """
+        self.fixed = t
+
+
+clock = Clock() # the shared instance
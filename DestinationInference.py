@@ -0,0 +1,123 @@
+import config as cf
+from AddressIndex import addressIndex
+from PositionHistory import PositionHistory
+import os
+import numpy as np
+
+
+class DestinationInference:
+    """ Guesses the destination of a station from its last fixes, for the passive mode. Every saved address within the radius is scored by how well the driven segments point towards it. An address is only suggested, if the station also got closer to it over the window. Once one address clearly dominates the others for a few packets in a row, it is suggested. The scoring is one vectorized pass over the cached arrays of all addresses and the fixes, so it can run on every packet. """
+
+    def __init__(self, index=addressIndex):
+        """ Constructor of the inference. index is the AddressIndex the candidates are taken from. The settings are read from the .env file. """
+        self.index = index
+        try:
+            self.window = max(3, int(os.getenv('INFERENCE_WINDOW', 10))) # fixes
+            self.radius = float(os.getenv('INFERENCE_RADIUS', 150)) # km
+            self.dominance = float(os.getenv('INFERENCE_DOMINANCE', 10)) # odds of the best address against the second best
+        except:
+            self.window = 10
+            self.radius = 150
+            self.dominance = 10
+            cf.log.error('[INFER] Could not read INFERENCE_WINDOW, INFERENCE_RADIUS or INFERENCE_DOMINANCE. Default: 10, 150 km, 10')
+        self.MIN_FIXES = 4 # less fixes tell nothing about the direction
+        self.MIN_TRAVELLED = 0.5 # km within the window, otherwise the station is parked and the fixes are just jitter
+        self.MIN_ALIGNMENT = 0.8 # of 1, a perfectly straight approach. Less means the station is heading somewhere else
+        self.KAPPA = 4 # concentration of the headings around the bearing to the destination, roughly 1 / (30 degrees)^2
+        self.MIN_DISTANCE = 1 # km, addresses closer than this are where the station is, not where it is going
+        self.MAX_AGE = 1800 # sec, older fixes of the window belong to an earlier trip
+        self.CONFIRMATIONS = 3 # packets in a row the same address has to dominate
+        self.SNOOZE = 3600 # sec an address is not suggested again
+
+        self.leader = None # (chatid, index of the address) which dominated the last packets
+        self.streak = 0
+        self.suggested = {} # (chatid, index of the address) -> time of the fix it was suggested at
+
+        # statistics
+        self.updates = 0
+        self.candidates = 0
+        self.suggestions = 0
+
+    def reset(self):
+        """ Forgets the current leader, e.g. after a follow process ended. The snoozed addresses are kept. """
+        self.leader = None
+        self.streak = 0
+
+    def score(self, fixes, vectors):
+        """ Scores the addresses, given as array of unit vectors, for the fixes (array of t, lng, lat in chronological order). Returns the alignment, the mean cosine between the driven segments and the directions from their starts to the address weighted by the segment length, and the distance gained on the address per km driven. Both are 1 for a straight approach. The last distances to the addresses in km are returned as well.
+        The cosines are taken in the tangent plane at the start P of each segment PQ: for an address A it is (A.Q - A.P P.Q) / sqrt((1 - (A.P)^2) (1 - (P.Q)^2)). So the whole score is two matrix products, without any trigonometry per address. """
+        lng, lat = np.radians(fixes[:, 1]), np.radians(fixes[:, 2])
+        points = np.column_stack((np.cos(lat) * np.cos(lng), np.cos(lat) * np.sin(lng), np.sin(lat)))
+        starts, ends = points[:-1], points[1:]
+        pq = np.clip(np.sum(starts * ends, axis=1), -1, 1)
+        segments = 2 * PositionHistory.EARTH_RADIUS * np.arcsin(np.minimum(np.linalg.norm(ends - starts, axis=1) / 2, 1)) # the chord is exact for short segments, unlike the dot product
+        travelled = np.sum(segments)
+        ap = np.clip(vectors @ starts.T, -1, 1) # addresses x segments
+        aq = vectors @ ends.T
+        cosines = (aq - ap * pq) / np.sqrt(np.maximum((1 - ap ** 2) * (1 - pq ** 2), 1e-30))
+        alignment = cosines @ segments / travelled
+        first = 2 * PositionHistory.EARTH_RADIUS * np.arcsin(np.minimum(np.linalg.norm(vectors - points[0], axis=1) / 2, 1))
+        last = 2 * PositionHistory.EARTH_RADIUS * np.arcsin(np.minimum(np.linalg.norm(vectors - points[-1], axis=1) / 2, 1))
+        return alignment, (first - last) / travelled, last
+
+    def update(self, history):
+        """ Scores the saved addresses with the last fixes of the PositionHistory. Returns (chatid, index of the address) once an address dominates, None otherwise. Every address is suggested once per SNOOZE.
+        The headings are taken as von Mises distributed around the bearing to the destination, so the odds of the best address against the second best are exp(KAPPA * segments * difference of their alignments). """
+        self.updates += 1
+        fixes = history.asArray(self.window)
+        if len(fixes) > 0:
+            fixes = fixes[fixes[:, 0] >= fixes[-1, 0] - self.MAX_AGE]
+        if len(fixes) < self.MIN_FIXES:
+            return None
+        if np.sum(PositionHistory.haversine(fixes[:-1, 1], fixes[:-1, 2], fixes[1:, 1], fixes[1:, 2])) < self.MIN_TRAVELLED:
+            self.reset()
+            return None
+
+        keys, vectors = self.index.points()
+        if len(keys) == 0:
+            return None
+        alignment, approach, distances = self.score(fixes, vectors)
+        now = fixes[-1, 0]
+        candidates = (distances >= self.MIN_DISTANCE) & (distances <= self.radius)
+        for key, t in list(self.suggested.items()):
+            if now - t >= self.SNOOZE:
+                self.suggested.pop(key)
+            elif key in keys:
+                candidates[keys.index(key)] = False
+        self.candidates += int(np.count_nonzero(candidates))
+        if not np.any(candidates):
+            self.reset()
+            return None
+
+        alignment = np.where(candidates, alignment, -np.inf)
+        order = np.argsort(alignment)[::-1]
+        best = alignment[order[0]]
+        second = alignment[order[1]] if len(order) > 1 else -np.inf
+        odds = np.exp(min(self.KAPPA * (len(fixes) - 1) * (best - second), 50)) # capped, a single candidate has infinite odds
+        if best < self.MIN_ALIGNMENT or approach[order[0]] <= 0 or odds < self.dominance:
+            self.reset()
+            return None
+
+        key = keys[order[0]]
+        self.streak = self.streak + 1 if key == self.leader else 1
+        self.leader = key
+        cf.log.debug('[INFER] Address ' + str(key[1]) + ' of ' + str(key[0]) + ' leads with alignment ' + str(round(float(best), 2)) + ' and odds ' + str(round(float(odds))) + ', ' + str(self.streak) + ' packet(s) in a row.')
+        if self.streak < self.CONFIRMATIONS:
+            return None
+        self.suggested[key] = now
+        self.suggestions += 1
+        self.reset()
+        return key
+
+    def stats(self):
+        """ Returns the statistics of the inference. """
+        return {
+            'updates' : self.updates,
+            'candidatesPerUpdate' : round(self.candidates / self.updates, 1) if self.updates > 0 else 0.0,
+            'suggestions' : self.suggestions
+        }
+
+    def logStats(self):
+        """ Writes the statistics to the log. """
+        stats = self.stats()
+        cf.log.info('[INFER] ' + str(stats['suggestions']) + ' destinations suggested in ' + str(stats['updates']) + ' packets, ' + str(stats['candidatesPerUpdate']) + ' candidate addresses per packet.')
@@ -0,0 +1,73 @@
+import config as cf
+from PositionHistory import PositionHistory
+import os
+import numpy as np
+
+
+class ETAEstimator:
+    """ A local ETA estimator. It estimates the travel time from the great-circle distance and a per-trip factor (minutes per great-circle km), calibrated against the last real ORS answer of the trip. This factor covers both the detour of the roads and the speed. It is used to skip the ORS request while a station is far away from its next alert threshold. All queries are vectorized, so every tracked station can be screened in one pass. """
+
+    def __init__(self):
+        """ Constructor of the estimator. The safety margins are read from the .env file. """
+        try:
+            self.relativeMargin = float(os.getenv('ETA_SAFETY_MARGIN', 0.3)) # the estimate must be 30% above the threshold ...
+            self.absoluteMargin = float(os.getenv('ETA_SAFETY_MINUTES', 3)) # ... plus 3 min, to skip the route request
+        except:
+            self.relativeMargin = 0.3
+            self.absoluteMargin = 3
+            cf.log.error('[ETA] Could not read ETA_SAFETY_MARGIN or ETA_SAFETY_MINUTES. Default: 0.3, 3 min')
+        self.audit = os.getenv('ETA_PREFILTER_AUDIT') == 'True' # request the route anyways, to measure the false negatives
+        self.MIN_DISTANCE = 0.5 # km, closer than this the factor is not calibrated, the distance is dominated by the last few streets
+
+        self.factors = {} # trip key -> minutes per great-circle km
+
+        # statistics
+        self.screened = 0
+        self.skipped = 0
+        self.audited = 0
+        self.falseNegatives = 0
+
+    def calibrate(self, key, start, dest, time):
+        """ Calibrates the factor of a trip with a real travel time in minutes from start to dest. """
+        distance = PositionHistory.haversine(start[0], start[1], dest[0], dest[1])
+        if distance >= self.MIN_DISTANCE and time > 0:
+            self.factors[key] = time / distance
+
+    def forget(self, key):
+        """ Forgets the factor of a finished trip. """
+        self.factors.pop(key, None)
+
+    def estimate(self, keys, starts, dests):
+        """ Returns the estimated travel times in minutes for all trips as array. Uncalibrated trips are NaN. starts and dests are sequences of [lng, lat]. """
+        starts = np.asarray(starts, dtype=float).reshape(-1, 2)
+        dests = np.asarray(dests, dtype=float).reshape(-1, 2)
+        factors = np.array([self.factors.get(key, np.nan) for key in keys], dtype=float)
+        return PositionHistory.haversine(starts[:, 0], starts[:, 1], dests[:, 0], dests[:, 1]) * factors
+
+    def needsRoute(self, keys, starts, dests, nextAlerts):
+        """ Returns a boolean array which trips need a real route request: the uncalibrated ones and those whose estimate is within the safety margin of their next alert threshold (in minutes). Also returns the estimates. """
+        estimates = self.estimate(keys, starts, dests)
+        limits = np.asarray(nextAlerts, dtype=float) * (1 + self.relativeMargin) + self.absoluteMargin
+        needed = np.isnan(estimates) | (estimates <= limits)
+        self.screened += len(needed)
+        self.skipped += int(np.count_nonzero(~needed))
+        return needed, estimates
+
+    def check(self, estimate, actual, nextAlert):
+        """ Compares a skipped estimate with the real travel time (audit mode). A false negative is a skipped request although the threshold was crossed. """
+        self.audited += 1
+        if actual <= nextAlert:
+            self.falseNegatives += 1
+            cf.log.warn('[ETA] Missed threshold: estimated ' + str(round(estimate)) + ' min, actually ' + str(round(actual)) + ' min, threshold ' + str(nextAlert) + ' min.')
+
+    def stats(self):
+        """ Returns the counters and the false negative rate of the audited skips. """
+        return {'screened' : self.screened, 'skipped' : self.skipped, 'audited' : self.audited, 'falseNegatives' : self.falseNegatives, 'falseNegativeRate' : self.falseNegatives / self.audited if self.audited > 0 else None}
+
+    def logStats(self):
+        """ Writes the counters to the log. """
+        stats = self.stats()
+        message = '[ETA] ' + str(stats['skipped']) + ' of ' + str(stats['screened']) + ' route requests skipped by the local estimate.'
+        if stats['audited'] > 0:
+            message += ' False negatives: ' + str(stats['falseNegatives']) + ' of ' + str(stats['audited']) + ' audited skips.'
+        cf.log.info(message)
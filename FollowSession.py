@@ -0,0 +1,20 @@
+import time
+
+
+class FollowSession:
+    """ One follow process: a station on its way to a destination and the users to alert. The alert state is a row of the matrix of the SessionManager. The attributes are kept in __slots__ instead of a dict, so hundreds of sessions only take a few hundred bytes each. """
+
+    __slots__ = ('call', 'dest', 'alertees', 'toStr', 'owner', 'row', 'started')
+
+    def __init__(self, call, dest, alertees, toStr, owner, row):
+        """ Creates the session of the station call to dest [lng, lat]. alertees is the list of chat IDs to alert, owner the chat ID which gets the control messages and row the row of its alert state in the SessionManager. """
+        self.call = call
+        self.dest = dest
+        self.alertees = alertees
+        self.toStr = toStr
+        self.owner = owner
+        self.row = row
+        self.started = time.time()
+
+    def __repr__(self):
+        return 'FollowSession(' + self.call + ' to ' + str(self.dest) + ', row ' + str(self.row) + ')'
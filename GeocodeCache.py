@@ -0,0 +1,97 @@
+import config as cf
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+class GeocodeCache:
+    """ A persistent cache for geocoding results. The results are stored in a small SQLite file, keyed on the normalized query text, with an in-memory LRU in front of it. Entries expire after a TTL. """
+
+    def __init__(self):
+        """ Constructor of the cache. Path, TTL and LRU size are read from the .env file. Without GEOCODE_CACHE_PATH the cache only lives in memory. """
+        self.path = os.getenv('GEOCODE_CACHE_PATH')
+        try:
+            self.ttl = float(os.getenv('GEOCODE_CACHE_TTL', 30)) * 86400 # configured in days
+            self.size = int(os.getenv('GEOCODE_CACHE_SIZE', 256))
+        except:
+            self.ttl = 30 * 86400
+            self.size = 256
+            cf.log.error('[GEO] Could not read GEOCODE_CACHE_TTL or GEOCODE_CACHE_SIZE. Default: 30 days, 256 entries')
+
+        self._lock = threading.Lock()
+        self.memory = OrderedDict() # normalized text -> (coords, time of the lookup)
+        self.memoryHits = 0
+        self.diskHits = 0
+        self.misses = 0
+
+        self.db = None
+        if self.path != None and self.path != '':
+            try:
+                self.db = sqlite3.connect(self.path, check_same_thread=False)
+                self.db.execute('CREATE TABLE IF NOT EXISTS geocode (query TEXT PRIMARY KEY, lng REAL, lat REAL, created REAL)')
+                self.db.execute('DELETE FROM geocode WHERE created < ?', (time.time() - self.ttl,)) # drop the expired entries
+                self.db.commit()
+            except Exception as e:
+                cf.log.error('[GEO] Could not open the geocode cache ' + self.path + '. Reason: ' + str(e))
+                self.db = None
+
+    @staticmethod
+    def normalize(text):
+        """ Returns the cache key of a query: lower case, without surrounding punctuation and with single spaces. """
+        return ' '.join(text.lower().replace(',', ' , ').split()).strip(' ,.;')
+
+    def get(self, text):
+        """ Returns the cached coordinates [longitude, latitude] of a query or None. """
+        key = self.normalize(text)
+        now = time.time()
+        with self._lock:
+            entry = self.memory.get(key)
+            if entry != None and now - entry[1] < self.ttl:
+                self.memory.move_to_end(key)
+                self.memoryHits += 1
+                return entry[0]
+            if entry != None: # expired
+                del self.memory[key]
+            if self.db != None:
+                try:
+                    row = self.db.execute('SELECT lng, lat, created FROM geocode WHERE query = ?', (key,)).fetchone()
+                except Exception as e:
+                    cf.log.error('[GEO] Reading the geocode cache failed. Reason: ' + str(e))
+                    row = None
+                if row != None and now - row[2] < self.ttl:
+                    coords = [row[0], row[1]]
+                    self.remember(key, coords, row[2])
+                    self.diskHits += 1
+                    return coords
+            self.misses += 1
+            return None
+
+    def put(self, text, coords):
+        """ Stores the coordinates [longitude, latitude] of a query in memory and on disk. """
+        key = self.normalize(text)
+        now = time.time()
+        with self._lock:
+            self.remember(key, coords, now)
+            if self.db != None:
+                try:
+                    self.db.execute('INSERT OR REPLACE INTO geocode VALUES (?, ?, ?, ?)', (key, coords[0], coords[1], now))
+                    self.db.commit()
+                except Exception as e:
+                    cf.log.error('[GEO] Writing the geocode cache failed. Reason: ' + str(e))
+
+    def remember(self, key, coords, created):
+        """ Puts an entry into the LRU and evicts the least recently used one, if it is full. The lock must be held. """
+        self.memory[key] = (coords, created)
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.size:
+            self.memory.popitem(last=False)
+
+    def stats(self):
+        """ Returns the hit and miss counters. """
+        return {'memoryHits' : self.memoryHits, 'diskHits' : self.diskHits, 'misses' : self.misses}
+
+    def logStats(self):
+        """ Writes the hit and miss counters to the log. """
+        cf.log.info('[GEO] Geocode cache: ' + str(self.memoryHits) + ' memory hits, ' + str(self.diskHits) + ' disk hits, ' + str(self.misses) + ' misses')
@@ -0,0 +1,142 @@
+import config as cf
+from Recorder import recorder
+import os
+import threading
+import time
+import requests
+import httpx
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from urllib.parse import urlsplit
+
+
+class HTTPSessionPool:
+    """ A shared keep-alive HTTP session for all API clients. Each host gets its own connection pool, so the TCP and TLS handshakes are only paid once per host. It also counts the requests, new connections and latency per endpoint. """
+
+    def __init__(self):
+        """ Constructor of the pool. The number of retries is read from the .env file. """
+        # the number of connections kept alive per host
+        self.POOL_SIZES = {
+            "api.aprs.fi" : 2,
+            "api.openrouteservice.org" : 4
+        }
+        self.DEFAULT_POOL_SIZE = 2
+
+        try:
+            retries = int(os.getenv('HTTP_RETRIES', 2))
+        except:
+            retries = 2
+            cf.log.error('[HTTP] Could not read HTTP_RETRIES. Default: 2')
+        # retry on connection problems and gateway errors only, everything else is handled by the clients
+        self.retry = Retry(total=retries, connect=retries, read=retries, status=retries, backoff_factor=0.5, status_forcelist=[502, 503, 504], allowed_methods=['GET', 'POST'], raise_on_status=False)
+
+        self.retries = retries
+        self.session = requests.Session()
+        self.session.mount('https://', HTTPAdapter(pool_connections=len(self.POOL_SIZES) + 1, pool_maxsize=self.DEFAULT_POOL_SIZE, max_retries=self.retry))
+        for host, size in self.POOL_SIZES.items():
+            self.session.mount('https://' + host + '/', HTTPAdapter(pool_connections=1, pool_maxsize=size, max_retries=self.retry))
+
+        self._lock = threading.Lock()
+        self.endpointStats = {} # endpoint -> counters
+        self.connectionsSeen = {} # id of the urllib3 pool -> number of connections it had opened at the last request
+
+        self.asyncClient = None # the async client is created on first use, inside the event loop that uses it
+        self.streamsSeen = set() # ids of the network streams the async client has used so far
+
+    def get(self, url, params=None, timeout=None):
+        """ Sends a GET request over the shared session. Behaves like requests.get. """
+        return self.request('GET', url, params=params, timeout=timeout)
+
+    def post(self, url, json=None, headers=None, timeout=None):
+        """ Sends a POST request over the shared session. Behaves like requests.post. """
+        return self.request('POST', url, json=json, headers=headers, timeout=timeout)
+
+    def request(self, method, url, **kwargs):
+        """ Sends a request over the shared session and updates the endpoint counters. Exceptions are passed on to the caller. """
+        start = time.perf_counter()
+        try:
+            response = self.session.request(method, url, **kwargs)
+        except Exception:
+            self.record(url, time.perf_counter() - start, False, failed=True)
+            raise
+        self.record(url, time.perf_counter() - start, self.openedConnection(response))
+        recorder.recordHTTP(method, url, kwargs.get('params'), kwargs.get('json'), response.status_code, response.text)
+        return response
+
+    async def getAsync(self, url, params=None, timeout=None):
+        """ Sends a GET request over the shared async client. The timeout is given like for requests, (connect, read) or a single number. """
+        return await self.requestAsync('GET', url, params=params, timeout=timeout)
+
+    async def postAsync(self, url, json=None, headers=None, timeout=None):
+        """ Sends a POST request over the shared async client. """
+        return await self.requestAsync('POST', url, json=json, headers=headers, timeout=timeout)
+
+    async def requestAsync(self, method, url, timeout=None, **kwargs):
+        """ Sends a request over the shared async client and updates the endpoint counters. Exceptions are passed on to the caller. """
+        if self.asyncClient == None:
+            limits = httpx.Limits(max_connections=sum(self.POOL_SIZES.values()) + self.DEFAULT_POOL_SIZE, max_keepalive_connections=sum(self.POOL_SIZES.values()) + self.DEFAULT_POOL_SIZE)
+            self.asyncClient = httpx.AsyncClient(limits=limits, transport=httpx.AsyncHTTPTransport(retries=self.retries, limits=limits))
+        if isinstance(timeout, tuple):
+            timeout = httpx.Timeout(timeout[1], connect=timeout[0])
+        start = time.perf_counter()
+        try:
+            response = await self.asyncClient.request(method, url, timeout=timeout, **kwargs)
+        except Exception:
+            self.record(url, time.perf_counter() - start, False, failed=True)
+            raise
+        stream = response.extensions.get('network_stream')
+        newConnection = stream != None and id(stream) not in self.streamsSeen
+        if stream != None:
+            self.streamsSeen.add(id(stream))
+        self.record(url, time.perf_counter() - start, newConnection)
+        recorder.recordHTTP(method, url, kwargs.get('params'), kwargs.get('json'), response.status_code, response.text)
+        return response
+
+    async def closeAsync(self):
+        """ Closes the async client and its connections. """
+        if self.asyncClient != None:
+            await self.asyncClient.aclose()
+            self.asyncClient = None
+
+    def openedConnection(self, response):
+        """ Returns True, if a new connection had to be opened for this response. This is the case if the connection pool of the response opened more connections than seen so far. """
+        pool = getattr(response.raw, '_pool', None)
+        if pool == None:
+            return False
+        with self._lock:
+            seen = self.connectionsSeen.get(id(pool), 0)
+            self.connectionsSeen[id(pool)] = pool.num_connections
+        return pool.num_connections > seen
+
+    def record(self, url, latency, newConnection, failed=False):
+        """ Updates the counters of the endpoint of this url. """
+        parts = urlsplit(url)
+        endpoint = parts.netloc + parts.path
+        with self._lock:
+            stats = self.endpointStats.setdefault(endpoint, {'requests' : 0, 'failed' : 0, 'newConnections' : 0, 'reusedConnections' : 0, 'totalLatency' : 0.0, 'maxLatency' : 0.0})
+            stats['requests'] += 1
+            if failed:
+                stats['failed'] += 1
+            elif newConnection:
+                stats['newConnections'] += 1
+            else:
+                stats['reusedConnections'] += 1
+            stats['totalLatency'] += latency
+            stats['maxLatency'] = max(stats['maxLatency'], latency)
+
+    def stats(self):
+        """ Returns a copy of the counters per endpoint, including the mean latency in seconds. """
+        with self._lock:
+            result = {}
+            for endpoint, stats in self.endpointStats.items():
+                result[endpoint] = dict(stats)
+                result[endpoint]['meanLatency'] = stats['totalLatency'] / stats['requests']
+            return result
+
+    def logStats(self):
+        """ Writes the counters of every endpoint to the log. """
+        for endpoint, stats in self.stats().items():
+            cf.log.info('[HTTP] ' + endpoint + ': ' + str(stats['requests']) + ' requests, ' + str(stats['reusedConnections']) + ' reused connections, ' + str(stats['newConnections']) + ' new connections, ' + str(stats['failed']) + ' failed, mean latency ' + str(round(stats['meanLatency'] * 1000)) + ' ms')
+
+
+pool = HTTPSessionPool() # the shared instance, used by all API clients
@@ -0,0 +1,71 @@
+import numpy as np
+
+
+class Isochrones:
+    """ The isochrones around a destination: for every alert threshold the area from which the destination is reached within that time. A position is classified by local point-in-polygon tests, a bounding box check in front of every polygon skips most of them. """
+
+    def __init__(self, rings):
+        """ Creates the isochrones from a dict threshold in min -> list of polygons. A polygon is a list of rings [[lng, lat], ...], the first is the outline, the others are holes. """
+        self.thresholds = sorted(rings.keys()) # the smallest area first
+        self.polygons = {} # threshold -> list of (bbox, list of ring arrays)
+        for threshold in self.thresholds:
+            self.polygons[threshold] = []
+            for polygon in rings[threshold]:
+                arrays = [np.asarray(ring, dtype=float)[:, :2] for ring in polygon if len(ring) >= 3]
+                if len(arrays) == 0:
+                    continue
+                outline = arrays[0]
+                bbox = (outline[:, 0].min(), outline[:, 1].min(), outline[:, 0].max(), outline[:, 1].max())
+                self.polygons[threshold].append((bbox, arrays))
+
+    @staticmethod
+    def fromFeatures(features):
+        """ Builds the isochrones of the GeoJSON features of the ORS isochrones endpoint. Returns None, if there is no usable feature. """
+        rings = {}
+        try:
+            for feature in features:
+                threshold = float(feature['properties']['value']) / 60 # sec -> min
+                geometry = feature['geometry']
+                if geometry['type'] == 'Polygon':
+                    polygons = [geometry['coordinates']]
+                elif geometry['type'] == 'MultiPolygon':
+                    polygons = geometry['coordinates']
+                else:
+                    continue
+                rings.setdefault(threshold, []).extend(polygons)
+        except (KeyError, TypeError, ValueError):
+            return None
+        if len(rings) == 0:
+            return None
+        return Isochrones(rings)
+
+    @staticmethod
+    def inside(point, rings):
+        """ Even-odd ray casting of the point [lng, lat] against all rings of a polygon, so holes are excluded. """
+        crossings = 0
+        for ring in rings:
+            xi, yi = ring[:, 0], ring[:, 1]
+            xj, yj = np.roll(xi, 1), np.roll(yi, 1)
+            spans = (yi > point[1]) != (yj > point[1])
+            with np.errstate(divide='ignore', invalid='ignore'):
+                xs = (xj - xi) * (point[1] - yi) / (yj - yi) + xi
+            crossings += int(np.count_nonzero(spans & (point[0] < xs)))
+        return crossings % 2 == 1
+
+    def contains(self, threshold, point):
+        """ Returns True, if the point [lng, lat] lies within the isochrone of the threshold. """
+        for bbox, rings in self.polygons.get(threshold, []):
+            if point[0] < bbox[0] or point[1] < bbox[1] or point[0] > bbox[2] or point[1] > bbox[3]:
+                continue # bounding box prefilter
+            if self.inside(point, rings):
+                return True
+        return False
+
+    def classify(self, point):
+        """ Returns the smallest threshold in min whose isochrone contains the point [lng, lat], or None if the point is outside all of them. """
+        if not self.contains(self.thresholds[-1], point): # nearly every fix far away ends here
+            return None
+        for threshold in self.thresholds:
+            if self.contains(threshold, point):
+                return threshold
+        return self.thresholds[-1]
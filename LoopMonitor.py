@@ -0,0 +1,57 @@
+import config as cf
+import asyncio
+import time
+import numpy as np
+
+
+class LoopMonitor:
+    """ Measures how long the event loop stalls. A task sleeps for a short interval again and again, the time it wakes up late is the time the loop was blocked by something else, e.g. a blocking request in a handler. The stalls are counted in a histogram. """
+
+    def __init__(self, interval=0.05):
+        """ Constructor of the monitor. interval is the sleep in sec between two measurements. """
+        self.INTERVAL = interval
+        self.BUCKETS = [0.005, 0.01, 0.05, 0.1, 0.5, 1, 5] # upper limits in sec, the last bucket is above
+        self.counts = np.zeros(len(self.BUCKETS) + 1, dtype=int)
+        self.longest = 0.0
+        self.stalled = 0.0 # sec in total
+        self._task = None
+
+    def start(self):
+        """ Starts the measurement. Must be called from within the running event loop. """
+        if self._task == None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self.run())
+
+    async def stop(self):
+        """ Stops the measurement. """
+        if self._task != None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def run(self):
+        """ The measurement task. """
+        while True:
+            before = time.perf_counter()
+            await asyncio.sleep(self.INTERVAL)
+            self.add(time.perf_counter() - before - self.INTERVAL)
+
+    def add(self, stall):
+        """ Counts a single stall in sec. """
+        stall = max(stall, 0.0)
+        self.counts[np.searchsorted(self.BUCKETS, stall)] += 1
+        self.longest = max(self.longest, stall)
+        self.stalled += stall
+
+    def stats(self):
+        """ Returns the histogram {'<5 ms' : count, ...}, the longest stall and the total time stalled in sec. """
+        labels = ['<' + str(round(b * 1000)) + ' ms' for b in self.BUCKETS] + ['>=' + str(round(self.BUCKETS[-1] * 1000)) + ' ms']
+        return {
+            'histogram' : dict(zip(labels, self.counts.tolist())),
+            'longest' : round(self.longest, 3),
+            'stalled' : round(self.stalled, 3)
+        }
+
+    def logStats(self):
+        """ Writes the stall histogram to the log. """
+        stats = self.stats()
+        cf.log.info('[LOOP] Event loop stalls: ' + str(stats['histogram']) + ', longest ' + str(stats['longest']) + ' sec, ' + str(stats['stalled']) + ' sec in total.')
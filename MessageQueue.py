@@ -0,0 +1,283 @@
+import config as cf
+import asyncio
+import collections
+import os
+import queue
+import threading
+import time
+import numpy as np
+import telegram
+
+
+class MessageQueue:
+    """ The outbound pipeline of the Telegram messages. Any thread can put a message, it is handed over through a thread-safe queue and the event loop is woken up. One consumer task on the loop of the Telegram application sends them: every chat in order and with its own rate limit, all chats together within the global rate limit and with a limited number of concurrent requests. A RetryAfter of Telegram pauses the whole queue for the requested time, network errors are retried with a backoff. Alerts waiting for the same chat are merged into one message, so a chat which follows several stations does not get a burst of messages. A status message is sent once and edited afterwards, a newer text replaces the one still waiting. """
+
+    def __init__(self, send, edit=None):
+        """ Constructor of the queue. send is the coroutine function send(chatID, text) which delivers a single message and returns its message ID, edit the coroutine function edit(chatID, messageID, text) which changes a sent message. The limits are read from the .env file. """
+        self.send = send
+        self.edit = edit
+        try:
+            self.MAX_CONCURRENT = int(os.getenv('TELEGRAM_MAX_CONCURRENT', 8)) # requests in flight
+            self.GLOBAL_RATE = float(os.getenv('TELEGRAM_GLOBAL_RATE', 25)) # messages per sec to all chats, Telegram allows about 30
+            self.CHAT_RATE = float(os.getenv('TELEGRAM_CHAT_RATE', 1)) # messages per sec to a single chat
+            self.COALESCE_WINDOW = float(os.getenv('TELEGRAM_COALESCE_WINDOW', 0.5)) # sec an alert waits for further alerts to the same chat
+        except:
+            self.MAX_CONCURRENT = 8
+            self.GLOBAL_RATE = 25
+            self.CHAT_RATE = 1
+            self.COALESCE_WINDOW = 0.5
+            cf.log.error('[QUEUE] Could not read TELEGRAM_MAX_CONCURRENT, TELEGRAM_GLOBAL_RATE, TELEGRAM_CHAT_RATE or TELEGRAM_COALESCE_WINDOW. Default: 8, 25/sec, 1/sec, 0.5 sec')
+        self.MAX_RETRIES = 3
+        self.MAX_LENGTH = 4096 # characters of a Telegram message, merged messages stay below
+        self.SEPARATOR = '\n\n' # between merged messages
+        self.MAX_PENDING = 1000 # messages waiting, further ones are dropped instead of blocking the producer
+
+        self._incoming = queue.SimpleQueue() # (chatID, text, time it was put, mergeable, fan-out or None, [status key, final] or None)
+        self._lock = threading.Lock() # guards the counters shared with the producers
+        self._loop = None
+        self._wakeup = None
+        self._slots = None
+        self._task = None
+        self._workers = set() # the running tasks of deliverChat
+        self.chats = {} # chatID -> deque of the messages waiting for this chat, only used on the loop
+        self.nextGlobal = 0.0 # loop time the next message may be sent at
+        self.nextChat = {} # chatID -> loop time the next message to this chat may be sent at
+        self.pausedUntil = 0.0 # loop time until which Telegram asked us to wait
+        self.statuses = {} # (chatID, status key) -> [message ID, text] of the sent status messages, only used on the loop
+
+        # statistics
+        self.pending = 0
+        self.queued = 0
+        self.sent = 0
+        self.retried = 0
+        self.failed = 0
+        self.dropped = 0
+        self.merged = 0 # messages sent as part of another one
+        self.edited = 0 # status messages edited instead of sent
+        self.superseded = 0 # status texts replaced by a newer one before they were sent
+        self.latencies = collections.deque(maxlen=1000) # sec from put to delivery of the last messages
+        self.fanOutLatencies = collections.deque(maxlen=1000) # sec from putAll to the delivery of its last message
+
+    def put(self, chatID, text, merge=False):
+        """ Queues a message. It never blocks and can be called from any thread. Messages with merge set are merged with the following mergeable messages to the same chat, which are waiting at the same time. Returns False, if the message was dropped because the queue is full. """
+        ok = self.enqueue(chatID, text, merge, None)
+        self.wakeUp()
+        return ok
+
+    def putAll(self, messages, merge=True):
+        """ Queues the list of messages [(chatID, text), ...] of one fan-out, e.g. the alerts of a polling round, and wakes the consumer once. The time until the last of them is delivered is measured as fan-out latency. Never blocks. Returns the number of dropped messages. """
+        if len(messages) == 0:
+            return 0
+        fanOut = [len(messages), time.monotonic()] # messages left, start
+        dropped = 0
+        for chatID, text in messages:
+            if not self.enqueue(chatID, text, merge, fanOut):
+                self.done([fanOut])
+                dropped += 1
+        self.wakeUp()
+        return dropped
+
+    def putStatus(self, chatID, key, text, final=False):
+        """ Sets the text of the status message key of a chat. The first text is sent as a new message, the following ones edit it. Only the latest text waiting is sent. With final set, the message is left as it is afterwards and the next text of the key starts a new one. Never blocks. """
+        ok = self.enqueue(chatID, text, False, None, [key, final])
+        self.wakeUp()
+        return ok
+
+    def enqueue(self, chatID, text, merge, fanOut, status=None):
+        """ Hands a message over to the consumer, unless the queue is full. """
+        with self._lock:
+            if self.pending >= self.MAX_PENDING:
+                self.dropped += 1
+                return False
+            self.pending += 1
+            self.queued += 1
+        self._incoming.put((chatID, text, time.monotonic(), merge, fanOut, status))
+        return True
+
+    def done(self, fanOuts):
+        """ Counts a message of each of the fan-outs as handled and measures the fan-outs which are complete. """
+        with self._lock:
+            for fanOut in fanOuts:
+                if fanOut == None:
+                    continue
+                fanOut[0] -= 1
+                if fanOut[0] == 0:
+                    self.fanOutLatencies.append(time.monotonic() - fanOut[1])
+
+    def wakeUp(self):
+        """ Wakes the consumer up, if it is running. Thread-safe. """
+        loop = self._loop
+        if loop != None:
+            try:
+                loop.call_soon_threadsafe(self._wakeup.set)
+            except RuntimeError: # the loop is closed, the bot is shutting down
+                pass
+
+    def start(self):
+        """ Starts the consumer task. Must be called from within the running event loop of the Telegram application. Messages put before are sent now. """
+        if self._task != None and not self._task.done():
+            return
+        self._loop = asyncio.get_running_loop()
+        self._wakeup = asyncio.Event()
+        self._slots = asyncio.Semaphore(self.MAX_CONCURRENT)
+        self._task = self._loop.create_task(self.run())
+        self._wakeup.set()
+
+    async def stop(self):
+        """ Stops the consumer and the workers. Must be called from within the event loop, before it is closed. The messages still waiting are lost. """
+        tasks = list(self._workers) + ([self._task] if self._task != None else [])
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._task = None
+        self._loop = None
+        if self.pending > 0:
+            cf.log.warn('[QUEUE] Stopped with ' + str(self.pending) + ' messages not sent.')
+
+    async def run(self):
+        """ The consumer: hands every incoming message to the worker of its chat. A worker runs as long as its chat has messages waiting. """
+        while True:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+            while True:
+                try:
+                    chatID, *message = self._incoming.get_nowait()
+                except queue.Empty:
+                    break
+                if chatID in self.chats:
+                    if message[4] != None and self.supersede(self.chats[chatID], message):
+                        continue
+                    self.chats[chatID].append(message)
+                else:
+                    self.chats[chatID] = collections.deque([message])
+                    worker = self._loop.create_task(self.deliverChat(chatID))
+                    self._workers.add(worker)
+                    worker.add_done_callback(self._workers.discard)
+
+    def supersede(self, waiting, message):
+        """ Replaces the text of a waiting update of the same status message by the newer one. Returns False, if there is none. """
+        for other in waiting:
+            if other[4] != None and other[4][0] == message[4][0]:
+                other[0] = message[0]
+                other[4][1] = other[4][1] or message[4][1]
+                with self._lock:
+                    self.pending -= 1
+                    self.superseded += 1
+                return True
+        return False
+
+    async def deliverChat(self, chatID):
+        """ Sends the waiting messages of a chat one after another, so they arrive in order. A mergeable message waits for the coalescing window, then it is sent together with the mergeable messages right behind it. """
+        waiting = self.chats[chatID]
+        while len(waiting) > 0:
+            text, queued, merge, fanOut, status = waiting.popleft()
+            if status != None:
+                await self.deliverStatus(chatID, text, queued, *status)
+                with self._lock:
+                    self.pending -= 1
+                continue
+            if merge and queued + self.COALESCE_WINDOW > time.monotonic():
+                await asyncio.sleep(queued + self.COALESCE_WINDOW - time.monotonic())
+            await self.reserve(chatID)
+            texts, fanOuts = [text], [fanOut]
+            length = len(text)
+            while merge and len(waiting) > 0 and waiting[0][2] and length + len(self.SEPARATOR) + len(waiting[0][0]) <= self.MAX_LENGTH:
+                text, _, _, fanOut, _ = waiting.popleft()
+                texts.append(text)
+                fanOuts.append(fanOut)
+                length += len(self.SEPARATOR) + len(text)
+            async with self._slots:
+                await self.deliver(chatID, self.SEPARATOR.join(texts), queued)
+            with self._lock:
+                self.pending -= len(texts)
+                self.merged += len(texts) - 1
+            self.done(fanOuts)
+        del self.chats[chatID]
+
+    async def deliverStatus(self, chatID, text, queued, key, final):
+        """ Sends or edits the status message key of a chat. An unchanged text is not sent again. """
+        sent = self.statuses.get((chatID, key))
+        if sent == None or sent[1] != text:
+            await self.reserve(chatID)
+            async with self._slots:
+                messageID = await self.deliver(chatID, text, queued, None if sent == None else sent[0])
+            if messageID != None:
+                self.statuses[(chatID, key)] = [messageID, text]
+        if final:
+            self.statuses.pop((chatID, key), None)
+
+    async def reserve(self, chatID):
+        """ Waits until the rate limits allow the next message to the chat. The slot is reserved before waiting, so the waiting messages are spaced evenly. """
+        now = self._loop.time()
+        chatAt = max(now, self.nextChat.get(chatID, 0.0))
+        self.nextChat[chatID] = chatAt + 1 / self.CHAT_RATE
+        at = max(chatAt, self.nextGlobal, self.pausedUntil)
+        self.nextGlobal = at + 1 / self.GLOBAL_RATE
+        if at > now:
+            await asyncio.sleep(at - now)
+
+    async def deliver(self, chatID, text, queued, messageID=None):
+        """ Sends a single message, or edits the message messageID. Returns the ID of the message, None if it failed. A RetryAfter pauses the whole queue and the message is retried afterwards, as are network errors. A rejected message (e.g. bad markdown, a blocked bot) is dropped. If the message to edit is gone, it is sent as a new one. """
+        for attempt in range(self.MAX_RETRIES + 1):
+            while self.pausedUntil > self._loop.time(): # another message got a RetryAfter meanwhile
+                await asyncio.sleep(self.pausedUntil - self._loop.time())
+            try:
+                if messageID == None:
+                    messageID = await self.send(chatID, text)
+                else:
+                    await self.edit(chatID, messageID, text)
+                    self.edited += 1
+                self.sent += 1
+                self.latencies.append(time.monotonic() - queued)
+                return messageID
+            except telegram.error.RetryAfter as e:
+                wait = e.retry_after.total_seconds() if hasattr(e.retry_after, 'total_seconds') else float(e.retry_after)
+                self.pausedUntil = max(self.pausedUntil, self._loop.time() + wait)
+                self.retried += 1
+                cf.log.info('[QUEUE] Telegram asked to wait ' + str(wait) + ' sec.')
+            except telegram.error.BadRequest as e:
+                if messageID == None:
+                    cf.log.warn('[TCM] The message could not be sent. Reason: ' + str(e))
+                    break
+                if 'not modified' in str(e):
+                    return messageID
+                messageID = None # e.g. the user deleted the status message
+            except telegram.error.Forbidden as e:
+                cf.log.warn('[TCM] The message could not be sent. Reason: ' + str(e))
+                break
+            except (telegram.error.NetworkError, telegram.error.TimedOut) as e:
+                self.retried += 1
+                cf.log.info('[QUEUE] Sending failed, retrying. Reason: ' + str(e))
+                await asyncio.sleep(2 ** attempt)
+            except Exception as e:
+                cf.log.warn('[QUEUE] The message could not be sent. Reason: ' + str(e))
+                break
+        self.failed += 1
+        return None
+
+    def stats(self):
+        """ Returns the delivery statistics: counts (sent are the API calls, merged the messages sent as part of another one), the messages waiting, the latency from put to delivery and of the complete fan-outs in sec. """
+        latencies = np.array(self.latencies)
+        fanOuts = np.array(self.fanOutLatencies)
+        return {
+            'queued' : self.queued,
+            'sent' : self.sent,
+            'merged' : self.merged,
+            'edited' : self.edited,
+            'superseded' : self.superseded,
+            'retried' : self.retried,
+            'failed' : self.failed,
+            'dropped' : self.dropped,
+            'pending' : self.pending,
+            'latencyMean' : round(float(np.mean(latencies)), 3) if len(latencies) > 0 else None,
+            'latencyP95' : round(float(np.percentile(latencies, 95)), 3) if len(latencies) > 0 else None,
+            'latencyMax' : round(float(np.max(latencies)), 3) if len(latencies) > 0 else None,
+            'fanOuts' : len(fanOuts),
+            'fanOutMean' : round(float(np.mean(fanOuts)), 3) if len(fanOuts) > 0 else None,
+            'fanOutMax' : round(float(np.max(fanOuts)), 3) if len(fanOuts) > 0 else None
+        }
+
+    def logStats(self):
+        """ Writes the delivery statistics to the log. """
+        stats = self.stats()
+        cf.log.info('[QUEUE] ' + str(stats['queued']) + ' messages queued, ' + str(stats['sent']) + ' sent, ' + str(stats['merged']) + ' merged into others, ' + str(stats['edited']) + ' edits, ' + str(stats['superseded']) + ' superseded, ' + str(stats['retried']) + ' retries, ' + str(stats['failed']) + ' failed, ' + str(stats['dropped']) + ' dropped. Latency: mean ' + str(stats['latencyMean']) + ' sec, 95% ' + str(stats['latencyP95']) + ' sec, max ' + str(stats['latencyMax']) + ' sec. Fan-out of the alerts: mean ' + str(stats['fanOutMean']) + ' sec, max ' + str(stats['fanOutMax']) + ' sec.')
@@ -0,0 +1,233 @@
+import config as cf
+from PositionHistory import PositionHistory
+from RouteGeometry import RouteGeometry
+import heapq
+import json
+import math
+import os
+import numpy as np
+
+
+class OfflineRouter:
+    """ A routing backend without network. It answers getRouteSummary like OpenRouteService, but from a local road graph. The graph is kept in compact arrays (CSR: the edges of node i are offsets[i] to offsets[i+1]) which are memory-mapped, so loading is fast even for large extracts. Queries are answered by a bidirectional A* search on the travel time. Everything derived from the nodes (unit vectors, highest speed, a KD-tree to snap positions to the closest node) is computed by the conversion, so nothing is read in full at load time. """
+
+    FILES = ['coords', 'offsets', 'targets', 'times', 'lengths', 'reverseOffsets', 'reverseSources', 'reverseEdges', 'units', 'treeOrder', 'treeNodes', 'treeSplits']
+    LEAF_SIZE = 16 # nodes per leaf of the KD-tree, they are scanned together
+
+    def __init__(self, path):
+        """ Loads the graph directory written by OfflineRouter.build. """
+        self.ACCESS_SPEED = 30 # km/h from the position to the closest node of the graph
+        self.path = path
+        self.loaded = False
+        self.queries = 0
+        self.settled = 0 # nodes settled by all queries
+        try:
+            for name in self.FILES:
+                setattr(self, name, np.asarray(np.load(os.path.join(path, name + '.npy'), mmap_mode='r'))) # a plain view of the mapped file, without the slow memmap indexing
+            with open(os.path.join(path, 'meta.json')) as f:
+                self.maxSpeed = json.load(f)['maxSpeed'] # m/s, keeps the A* potential admissible
+            self.nodeCount = len(self.offsets) - 1
+            self.lngs = self.coords[:, 0] # views, not copies
+            self.lats = self.coords[:, 1]
+            self.unit = memoryview(self.units.reshape(-1)) # x, y, z of every node, read one by one as plain floats without numpy scalars
+            self.loaded = True
+            cf.log.info('[OFFLINE] Road graph loaded from ' + path + ': ' + str(self.nodeCount) + ' nodes, ' + str(len(self.targets)) + ' edges.')
+        except Exception as e:
+            cf.log.critical('[OFFLINE] Could not load the road graph ' + str(path) + ', a graph converted by an older version must be converted again. Reason: ' + str(e))
+
+    @staticmethod
+    def build(source, path):
+        """ Converts a road graph in text form into the array files in the directory path. The text has a line 'N lng lat' for every node (numbered in order) and a line 'E from to length_m speed_kmh [oneway]' for every road. Roads are both ways unless oneway is 1. """
+        coords = []
+        edges = [] # (from, to, time in sec, length in m)
+        with open(source) as f:
+            for line in f:
+                parts = line.split()
+                if len(parts) == 0 or parts[0].startswith('#'):
+                    continue
+                if parts[0] == 'N':
+                    coords.append([float(parts[1]), float(parts[2])])
+                elif parts[0] == 'E':
+                    u, v, length, speed = int(parts[1]), int(parts[2]), float(parts[3]), float(parts[4])
+                    time = length / (speed / 3.6)
+                    edges.append((u, v, time, length))
+                    if len(parts) < 6 or parts[5] != '1':
+                        edges.append((v, u, time, length))
+        coords = np.asarray(coords, dtype=np.float64).reshape(-1, 2)
+        edges = np.asarray(edges, dtype=np.float64).reshape(-1, 4)
+        order = np.lexsort((edges[:, 1], edges[:, 0])) # group the edges by their start node
+        edges = edges[order]
+        sources = edges[:, 0].astype(np.int32)
+        offsets = np.searchsorted(sources, np.arange(len(coords) + 1)).astype(np.int64)
+        reverse = np.argsort(edges[:, 1], kind='stable') # the same edges grouped by their end node, for the backward search
+        reverseOffsets = np.searchsorted(edges[reverse, 1].astype(np.int32), np.arange(len(coords) + 1)).astype(np.int64)
+        # unit vectors of the nodes for the potential: the chord is never longer than the road, so the bound stays consistent
+        lng, lat = np.radians(coords[:, 0]), np.radians(coords[:, 1])
+        units = np.column_stack((np.cos(lat) * np.cos(lng), np.cos(lat) * np.sin(lng), np.sin(lat)))
+        treeOrder, treeNodes, treeSplits = OfflineRouter.buildTree(units)
+        os.makedirs(path, exist_ok=True)
+        arrays = {
+            'coords' : coords,
+            'offsets' : offsets,
+            'targets' : edges[:, 1].astype(np.int32),
+            'times' : edges[:, 2].astype(np.float32),
+            'lengths' : edges[:, 3].astype(np.float32),
+            'reverseOffsets' : reverseOffsets,
+            'reverseSources' : sources[reverse],
+            'reverseEdges' : reverse.astype(np.int32), # index of the forward edge, for its time and length
+            'units' : units,
+            'treeOrder' : treeOrder,
+            'treeNodes' : treeNodes,
+            'treeSplits' : treeSplits
+        }
+        for name, array in arrays.items():
+            np.save(os.path.join(path, name + '.npy'), array)
+        maxSpeed = float(np.max(arrays['lengths'] / np.maximum(arrays['times'], 1e-9))) if len(edges) > 0 else 1.0 # m/s, of the stored values
+        with open(os.path.join(path, 'meta.json'), 'w') as f:
+            json.dump({'maxSpeed' : maxSpeed}, f)
+        return len(coords), len(edges)
+
+    @staticmethod
+    def buildTree(units):
+        """ Builds a KD-tree over the unit vectors of the nodes, like AddressIndex does for the addresses. The tree is stored in arrays: treeOrder lists the nodes so that every tree node covers a contiguous range of it, treeNodes holds (axis, first, last, lower child, upper child) per tree node, the root first, with axis -1 for a leaf, and treeSplits the split value of each. """
+        order = np.arange(len(units), dtype=np.int32)
+        nodes = []
+        splits = []
+
+        def build(first, last):
+            index = len(nodes)
+            nodes.append([-1, first, last, -1, -1])
+            splits.append(0.0)
+            if last - first <= OfflineRouter.LEAF_SIZE:
+                return index
+            points = units[order[first:last]]
+            axis = int(np.argmax(points.max(axis=0) - points.min(axis=0))) # split the widest dimension
+            order[first:last] = order[first:last][np.argsort(points[:, axis], kind='stable')]
+            middle = (first + last) // 2
+            nodes[index][0] = axis
+            splits[index] = float(units[order[middle], axis])
+            nodes[index][3] = build(first, middle)
+            nodes[index][4] = build(middle, last)
+            return index
+
+        build(0, len(units))
+        return order, np.asarray(nodes, dtype=np.int64).reshape(-1, 5), np.asarray(splits, dtype=np.float64)
+
+    def closestNode(self, point):
+        """ Returns the index of the node closest to the point [lng, lat] and its distance in km. The KD-tree is searched for the smallest chord between the unit vectors, which is also the smallest great-circle distance. """
+        lng, lat = math.radians(point[0]), math.radians(point[1])
+        q = np.array([math.cos(lat) * math.cos(lng), math.cos(lat) * math.sin(lng), math.sin(lat)])
+        best, bestNode = math.inf, -1
+        stack = [(0, 0.0)] # tree node and the squared distance of its side of the split, a lower bound
+        while len(stack) > 0:
+            index, bound = stack.pop()
+            if bound >= best:
+                continue
+            axis, first, last, lower, upper = self.treeNodes[index].tolist()
+            if axis == -1: # a leaf, scan its nodes together
+                nodes = self.treeOrder[first:last]
+                d = np.sum((self.units[nodes] - q) ** 2, axis=1)
+                i = int(np.argmin(d))
+                if d[i] < best:
+                    best, bestNode = float(d[i]), int(nodes[i])
+                continue
+            diff = q[axis] - float(self.treeSplits[index])
+            near, far = (lower, upper) if diff < 0 else (upper, lower)
+            stack.append((far, diff * diff))
+            stack.append((near, bound)) # searched first
+        return bestNode, float(PositionHistory.haversine(point[0], point[1], float(self.lngs[bestNode]), float(self.lats[bestNode])))
+
+    def potential(self, node, target):
+        """ A lower bound of the travel time in sec from node to target: the straight chord through the earth at the highest speed of the graph. """
+        u, i, j = self.unit, 3 * node, 3 * target
+        return 1000 * PositionHistory.EARTH_RADIUS * math.sqrt((u[i] - u[j]) ** 2 + (u[i + 1] - u[j + 1]) ** 2 + (u[i + 2] - u[j + 2]) ** 2) / self.maxSpeed
+
+    def search(self, source, target):
+        """ Bidirectional A* from source to target with the average potential, which is consistent for both directions. Returns the nodes and the edges of the path, or None, None if the target cannot be reached. """
+        if source == target:
+            return [source], []
+        potential = lambda v: (self.potential(v, target) - self.potential(v, source)) / 2 # forward, the backward one is its negative
+        dist = [{source : 0.0}, {target : 0.0}]
+        parent = [{source : None}, {target : None}] # node -> (previous node, edge)
+        heaps = [[(potential(source), source)], [(-potential(target), target)]]
+        done = [set(), set()]
+        best = math.inf
+        meet = None
+        graphs = [(self.offsets, self.targets, None), (self.reverseOffsets, self.reverseSources, self.reverseEdges)]
+        while len(heaps[0]) > 0 and len(heaps[1]) > 0:
+            if heaps[0][0][0] + heaps[1][0][0] >= best: # no shorter path can be found any more
+                break
+            side = 0 if len(heaps[0]) <= len(heaps[1]) else 1 # expand the smaller frontier
+            key, u = heapq.heappop(heaps[side])
+            if u in done[side]:
+                continue
+            done[side].add(u)
+            self.settled += 1
+            offsets, neighbours, edgeMap = graphs[side]
+            first, last = int(offsets[u]), int(offsets[u + 1])
+            nodes = neighbours[first:last]
+            edges = range(first, last) if edgeMap is None else edgeMap[first:last].tolist()
+            times = self.times[first:last] if edgeMap is None else self.times[edges]
+            sign = 1 if side == 0 else -1
+            for v, e, t in zip(nodes.tolist(), edges, times.tolist()):
+                d = dist[side][u] + t
+                if d < dist[side].get(v, math.inf):
+                    dist[side][v] = d
+                    parent[side][v] = (u, e)
+                    heapq.heappush(heaps[side], (d + sign * potential(v), v))
+                    if v in dist[1 - side] and d + dist[1 - side][v] < best:
+                        best = d + dist[1 - side][v]
+                        meet = v
+        if meet == None:
+            return None, None
+        path, edges = [meet], []
+        v = meet
+        while parent[0][v] != None:
+            v, e = parent[0][v]
+            path.insert(0, v)
+            edges.insert(0, e)
+        v = meet
+        while parent[1][v] != None:
+            v, e = parent[1][v]
+            path.append(v)
+            edges.append(e)
+        return path, edges
+
+    def route(self, start, dest):
+        """ Returns [distance in km, travel time in min] from start to dest and the RouteGeometry of the route, or None, None if there is no route. The way from the positions to the graph is added at ACCESS_SPEED. """
+        if not self.loaded:
+            return None, None
+        self.queries += 1
+        source, accessStart = self.closestNode(start)
+        target, accessDest = self.closestNode(dest)
+        path, edges = self.search(source, target)
+        if path == None:
+            cf.log.warn('[OFFLINE] No route found from ' + str(start) + ' to ' + str(dest))
+            return None, None
+        edges = np.asarray(edges, dtype=np.int64)
+        times = np.concatenate(([0.0], np.cumsum(self.times[edges].astype(float)))) / 60 # min
+        access = accessStart + accessDest
+        distance = float(np.sum(self.lengths[edges].astype(float))) / 1000 + access
+        time = float(times[-1]) + access / self.ACCESS_SPEED * 60
+        geometry = None
+        if len(path) > 1:
+            coords = np.column_stack((self.lngs[path], self.lats[path]))
+            geometry = RouteGeometry(coords, times)
+        cf.log.debug('[OFFLINE] Route computed, it takes ' + str(int(np.round(time))) + ' min to travel ' + str(np.round(distance, 1)) + ' km.')
+        return [distance, time], geometry
+
+    def getRouteSummary(self, start, dest, tryAnyway = False):
+        """ Same contract as OpenRouteService.getRouteSummary: returns [distance in km, travel time in min] from start to dest or None. """
+        return self.route(start, dest)[0]
+
+    def logStats(self):
+        """ Writes the number of queries and the mean search space to the log. """
+        if self.queries > 0:
+            cf.log.info('[OFFLINE] ' + str(self.queries) + ' routes computed, ' + str(round(self.settled / self.queries)) + ' nodes settled per query.')
+
+
+if __name__ == '__main__':
+    # Usage: python OfflineRouter.py GRAPH.txt DIRECTORY, converts a road graph in text form for ROUTING_GRAPH_PATH
+    import sys
+    nodes, edges = OfflineRouter.build(sys.argv[1], sys.argv[2])
+    cf.log.info('[OFFLINE] Road graph written to ' + sys.argv[2] + ': ' + str(nodes) + ' nodes, ' + str(edges) + ' edges.')
@@ -1,8 +1,16 @@
 import config as cf
 import os
-import requests
+from HTTPSessionPool import pool
+from RequestLimiter import RequestLimiter, limiter
+from Clock import clock
+from GeocodeCache import GeocodeCache
+from PositionHistory import PositionHistory
+from RouteGeometry import RouteGeometry
+from Isochrones import Isochrones
+from OfflineRouter import OfflineRouter
 import json
 import numpy as np
+import threading
 
 
 class OpenRouteService:
@@ -13,12 +21,58 @@ class OpenRouteService:
         # Define the URL Endpoints we need 
         self.ROUTE_CAR_ENDPOINT = "https://api.openrouteservice.org/v2/directions/driving-car"
         self.GEOCODE_ENDPOINT = "https://api.openrouteservice.org/geocode/search"
+        self.ISOCHRONE_ENDPOINT = "https://api.openrouteservice.org/v2/isochrones/driving-car"
+        self.MATRIX_ENDPOINT = "https://api.openrouteservice.org/v2/matrix/driving-car"
+
+        self.geocodeCache = GeocodeCache() # repeated lookups cost no request
+
+        # the last route of every destination is reused while the station has not moved much
+        try:
+            self.rerouteDistance = float(os.getenv('ORS_REROUTE_DISTANCE', 250)) / 1000 # configured in m, used in km
+            self.rerouteMaxAge = float(os.getenv('ORS_REROUTE_MAX_AGE', 600)) # sec
+        except:
+            self.rerouteDistance = 0.25
+            self.rerouteMaxAge = 600
+            cf.log.error('[ORS] Could not read ORS_REROUTE_DISTANCE or ORS_REROUTE_MAX_AGE. Default: 250 m, 600 sec')
+        self.lastRoutes = {} # (lng, lat) of the destination -> (start, [distance, time], time of the query)
+
+        # with the geometry of the route, the progress is projected locally until the station leaves the corridor
+        try:
+            self.corridor = float(os.getenv('ORS_CORRIDOR_DISTANCE', 300)) / 1000 # configured in m, used in km
+        except:
+            self.corridor = 0.3
+            cf.log.error('[ORS] Could not read ORS_CORRIDOR_DISTANCE. Default: 300 m')
+        self.routeGeometries = {} # (lng, lat) of the destination -> RouteGeometry
+        self.isochrones = {} # ((lng, lat) of the destination, thresholds) -> Isochrones
+        self._isochroneLock = threading.Lock() # the precomputation runs in its own thread
+        self.isochronesPending = {} # key -> Event, set once the request in flight is done
+        self.isochroneFailures = {} # key -> time of the last failed request, it is not repeated for every fix
+        self.ISOCHRONE_RETRY = 600 # sec
+        self.isochroneCalls = 0
+
+        # many pairs of the same polling round are sent to the matrix endpoint together
+        try:
+            self.matrixMaxLocations = int(os.getenv('ORS_MATRIX_MAX_LOCATIONS', 50)) # sources + destinations per request
+            self.matrixMaxRoutes = int(os.getenv('ORS_MATRIX_MAX_ROUTES', 2500)) # sources x destinations per request
+        except:
+            self.matrixMaxLocations = 50
+            self.matrixMaxRoutes = 2500
+            cf.log.error('[ORS] Could not read ORS_MATRIX_MAX_LOCATIONS or ORS_MATRIX_MAX_ROUTES. Default: 50, 2500')
+        self.matrixCalls = 0
+        self.matrixRoutes = 0
+        self.routeCalls = 0
+        self.routeCallsAvoided = 0
+
+        # the routes can be computed locally instead, geocoding and isochrones still use ORS
+        self.router = None
+        if os.getenv('ROUTING_BACKEND') == 'offline':
+            self.router = OfflineRouter(os.getenv('ROUTING_GRAPH_PATH'))
 
         self.validated = False
         self.key = os.getenv('OPEN_ROUTE_SERVICE_KEY')
         if self.key != None and self.key != '': # demo bounce the API to check if it is working
-            # Simply try to geocode "Berlin, Germany"
-            coord = self.geocode("Berlin, Germany", tryAnyway = True)
+            # Simply try to geocode "Berlin, Germany", past the cache, an answer from there says nothing about the key
+            coord = self.geocode("Berlin, Germany", tryAnyway = True, useCache = False)
             if coord != None:
                 self.validated = True
                 cf.log.info('[ORS] ORS validated.')
@@ -28,22 +82,38 @@ class OpenRouteService:
             cf.log.critical('[ORS] ORS Key is not set, cannot use ORS.')
 
     
-    def geocode(self, text, tryAnyway = False):
-        """ Function to geocode a text to coordinates, returns a list of the coordinates [longitude, latitude], if valid, None otherwise. It will not run, if the startup validation failed. This can be overridden by setting tryAnyway = True. """
+    def request(self, endpoint, priority, method, url, **kwargs):
+        """ Sends a request over the shared pool once the rate limiter allows it. Returns the response, or None if the quota did not allow the request. """
+        if not limiter.acquire(endpoint, priority):
+            return None
+        response = pool.request(method, url, **kwargs)
+        if response.status_code == 429: # the server counts differently, wait for a full refill
+            limiter.drain(endpoint)
+        return response
+
+    def geocode(self, text, tryAnyway = False, priority = RequestLimiter.BULK, useCache = True):
+        """ Function to geocode a text to coordinates, returns a list of the coordinates [longitude, latitude], if valid, None otherwise. It will not run, if the startup validation failed. This can be overridden by setting tryAnyway = True. The priority is used by the rate limiter. With useCache = False the request is always sent to ORS. """
         if self.validated or tryAnyway: # check if the demo bounce was successfull
+            coord = self.geocodeCache.get(text) if useCache else None
+            if coord != None:
+                cf.log.debug("[ORS] Geocoding of " + text + " found in the cache: " + str(coord))
+                return coord
             params = {
                 "api_key":self.key,
                 "text": text,
                 "size" : 1
             }
             try:
-                response = requests.get(self.GEOCODE_ENDPOINT, params, timeout=(5,15))
+                response = self.request('geocode', priority, 'GET', self.GEOCODE_ENDPOINT, params=params, timeout=(5,15))
+                if response == None:
+                    return None
                 if response.status_code != 200:
                     cf.log.error('[ORS] Geocoding could failed! Server status code: ' + str(response.status_code))
                     return None
                 data = json.loads(response.text)
                 coord = data['features'][0]['geometry']['coordinates'] # extract the coordinates from the json response
                 cf.log.debug("[ORS] Geocoding of " + text + " resulted in these coordinates: " + str(coord))
+                self.geocodeCache.put(text, coord)
                 return coord
             except Exception as e:
                 cf.log.error('[ORS] Geocoding failed! Reason: ' + str(e))
@@ -54,8 +124,123 @@ class OpenRouteService:
             return None
 
 
-    def getRouteSummary(self, start, dest, tryAnyway = False):
-        """Function to get the travel time between the coordinates start, dest. Returns a list of two numbers. The first is the distance in km the second the travel time in minutes. It will not run, if the startup validation failed. This can be overridden by setting tryAnyway = True. """
+    def getRouteSummary(self, start, dest, tryAnyway = False, priority = RequestLimiter.BACKGROUND):
+        """Function to get the travel time between the coordinates start, dest. Returns a list of two numbers. The first is the distance in km the second the travel time in minutes. If the geometry of a route to this destination is known and the start lies within the corridor around it, the remaining distance and time are projected locally. Otherwise, if the start is close to the start of the last route to this destination, that route and its travel time are reused, a station standing (parked, in a jam) is not getting closer. It will not run, if the startup validation failed. This can be overridden by setting tryAnyway = True. The priority is used by the rate limiter. """
+        result = self.localRouteSummary(start, dest)
+        if result != None:
+            return result
+        key = (dest[0], dest[1])
+        if self.router != None:
+            result, geometry = self.router.route(start, dest)
+        else:
+            result, geometry = self.queryRouteSummary(start, dest, tryAnyway, priority)
+        if geometry != None:
+            self.routeGeometries[key] = geometry
+        if result != None:
+            self.lastRoutes[key] = (start, result, clock.time())
+        return result
+
+    def localRouteSummary(self, start, dest):
+        """Answers getRouteSummary from the stored geometry or the last route to this destination, without a request. Returns [distance in km, travel time in min] or None, if a request is needed."""
+        key = (dest[0], dest[1])
+        geometry = self.routeGeometries.get(key)
+        if geometry != None:
+            offset, distance, duration = geometry.project(start)
+            if offset < self.corridor:
+                self.routeCallsAvoided += 1
+                cf.log.debug('[ORS] Station is ' + str(round(offset * 1000)) + ' m off the route, progress projected. It takes ' + str(int(np.round(duration))) + ' min.')
+                return [distance, duration]
+            cf.log.info('[ORS] Station left the route corridor (' + str(round(offset * 1000)) + ' m off), requesting a new route.')
+        last = self.lastRoutes.get(key)
+        if last != None:
+            lastStart, lastResult, queried = last
+            elapsed = clock.time() - queried
+            if elapsed < self.rerouteMaxAge and PositionHistory.haversine(lastStart[0], lastStart[1], start[0], start[1]) < self.rerouteDistance:
+                self.routeCallsAvoided += 1
+                result = list(lastResult) # the station hardly moved (parked, in a jam), so it is as far away as before
+                cf.log.debug('[ORS] Station moved less than ' + str(round(self.rerouteDistance * 1000)) + ' m, route reused. It takes ' + str(int(np.round(result[1]))) + ' min.')
+                return result
+        return None
+
+    def getRouteSummaries(self, starts, dests, tryAnyway = False, priority = RequestLimiter.BACKGROUND):
+        """Batched version of getRouteSummary for the pairs starts[i], dests[i]. Returns a list with [distance in km, travel time in min] or None for every pair. A destination without a stored route geometry gets one directions request first, as its geometry lets the other pairs to it and the following fixes be projected locally. The pairs which still cannot be answered locally are sent to the matrix endpoint, chunked to its location limits, a single one uses the directions endpoint. With the offline router, every pair is computed locally."""
+        results = [self.localRouteSummary(start, dest) for start, dest in zip(starts, dests)]
+        pending = [i for i in range(len(results)) if results[i] == None]
+        if self.router != None: # the offline router has no matrix, but no quota either
+            for i in pending:
+                results[i] = self.getRouteSummary(starts[i], dests[i], tryAnyway, priority)
+            return results
+        requested = set()
+        for i in pending:
+            key = (dests[i][0], dests[i][1])
+            if key in requested:
+                results[i] = self.localRouteSummary(starts[i], dests[i]) # within the corridor of the new route
+            elif key not in self.routeGeometries:
+                requested.add(key)
+                results[i] = self.getRouteSummary(starts[i], dests[i], tryAnyway, priority)
+        pending = [i for i in pending if results[i] == None]
+        if len(pending) == 1:
+            results[pending[0]] = self.getRouteSummary(starts[pending[0]], dests[pending[0]], tryAnyway, priority)
+        elif len(pending) > 1:
+            sources = list(dict.fromkeys((starts[i][0], starts[i][1]) for i in pending)) # unique locations, in order
+            destinations = list(dict.fromkeys((dests[i][0], dests[i][1]) for i in pending))
+            matrix = {} # (source, destination) -> [distance, time]
+            for sourceChunk, destinationChunk in self.matrixChunks(sources, destinations):
+                matrix.update(self.queryMatrix(sourceChunk, destinationChunk, tryAnyway, priority))
+            for i in pending:
+                result = matrix.get(((starts[i][0], starts[i][1]), (dests[i][0], dests[i][1])))
+                if result != None:
+                    self.lastRoutes[(dests[i][0], dests[i][1])] = (starts[i], result, clock.time())
+                results[i] = result
+        return results
+
+    def matrixChunks(self, sources, destinations):
+        """Splits the sources and destinations into blocks which respect the location and route limits of the matrix endpoint. Yields (sources, destinations) of every request."""
+        if len(sources) + len(destinations) <= self.matrixMaxLocations and len(sources) * len(destinations) <= self.matrixMaxRoutes:
+            yield sources, destinations
+            return
+        destinationSize = max(1, min(len(destinations), self.matrixMaxLocations // 2))
+        sourceSize = max(1, min(len(sources), self.matrixMaxLocations - destinationSize, self.matrixMaxRoutes // destinationSize))
+        for d in range(0, len(destinations), destinationSize):
+            for s in range(0, len(sources), sourceSize):
+                yield sources[s:s + sourceSize], destinations[d:d + destinationSize]
+
+    def queryMatrix(self, sources, destinations, tryAnyway = False, priority = RequestLimiter.BACKGROUND):
+        """Asks ORS for the travel times from all sources to all destinations in one request. Returns a dict (source, destination) -> [distance in km, travel time in min] of the routable pairs."""
+        if not (self.validated or tryAnyway):
+            cf.log.warn('[ORS] Tried to queryMatrix but ORS is not validated!')
+            return {}
+        body = {
+            "locations" : [list(location) for location in sources] + [list(location) for location in destinations],
+            "sources" : list(range(len(sources))),
+            "destinations" : list(range(len(sources), len(sources) + len(destinations))),
+            "metrics" : ["distance", "duration"]
+        }
+        try:
+            response = self.request('matrix', priority, 'POST', self.MATRIX_ENDPOINT, json=body, headers={"Authorization" : self.key}, timeout=(5,30))
+            if response == None:
+                return {}
+            self.matrixCalls += 1
+            if response.status_code != 200:
+                cf.log.error('[ORS] Matrix computation failed! Server status code: ' + str(response.status_code))
+                return {}
+            data = json.loads(response.text)
+            result = {}
+            for i, source in enumerate(sources):
+                for j, destination in enumerate(destinations):
+                    distance = data['distances'][i][j]
+                    duration = data['durations'][i][j]
+                    if distance != None and duration != None: # None if not routable
+                        result[(source, destination)] = [float(distance) / 1000, float(duration) / 60] # change the units to km and min
+            self.matrixRoutes += len(result)
+            cf.log.debug('[ORS] Matrix of ' + str(len(sources)) + ' x ' + str(len(destinations)) + ' locations computed.')
+            return result
+        except Exception as e:
+            cf.log.error('[ORS] Matrix computation failed! Reason: ' + str(e))
+            return {}
+
+    def queryRouteSummary(self, start, dest, tryAnyway = False, priority = RequestLimiter.BACKGROUND):
+        """Asks ORS for the route between the coordinates start, dest. Returns [distance in km, travel time in min] or None, and the RouteGeometry of the route or None."""
         if self.validated or tryAnyway:
             try:
                 params = {
@@ -63,18 +248,91 @@ class OpenRouteService:
                     "start": str(start[0]) + ',' + str(start[1]),
                     "end" : str(dest[0]) + ',' + str(dest[1])
                 }
-                response = requests.get(self.ROUTE_CAR_ENDPOINT, params, timeout=(5,15))
+                response = self.request('directions', priority, 'GET', self.ROUTE_CAR_ENDPOINT, params=params, timeout=(5,15))
+                if response == None:
+                    return None, None
+                self.routeCalls += 1
                 if response.status_code != 200: # check server result
                     cf.log.error('[ORS] Route computation failed Server status code: ' + str(response.status_code))
-                    return None
+                    return None, None
                 data = json.loads(response.text)
                 distance = float(data['features'][0]['properties']['summary']['distance'])/1000 # extract data, change the unit to km
                 time = float(data['features'][0]['properties']['summary']['duration'])/60 # extract date, change the unit to min
                 cf.log.debug('[ORS] Route computed, it takes ' + str(int(np.round(time))) + ' min to travel ' + str(np.round(distance,1)) + ' km.') 
-                return [distance, time]
+                return [distance, time], RouteGeometry.fromFeature(data['features'][0])
             except Exception as e:
                 cf.log.error('[ORS] Route computation failed! Reason: ' + str(e))
-                return None
+                return None, None
         else:
             cf.log.warn('[ORS] Tried to getRouteSummary but ORS is not validated!')
+            return None, None
+
+    def getIsochrones(self, dest, thresholds, tryAnyway = False, priority = RequestLimiter.BACKGROUND):
+        """Returns the Isochrones around the destination for all thresholds in minutes. They are requested in a single call and cached per destination. A second caller of the same key waits for the request in flight instead of sending its own. Returns None, if the request failed. It will not run, if the startup validation failed. This can be overridden by setting tryAnyway = True."""
+        key = ((dest[0], dest[1]), tuple(thresholds))
+        with self._isochroneLock: # held only for the lookup, not for the request
+            if key in self.isochrones:
+                return self.isochrones[key]
+            if clock.time() - self.isochroneFailures.get(key, 0) < self.ISOCHRONE_RETRY:
+                return None
+            if not (self.validated or tryAnyway):
+                cf.log.warn('[ORS] Tried to getIsochrones but ORS is not validated!')
+                return None
+            pending = self.isochronesPending.get(key)
+            if pending == None:
+                self.isochronesPending[key] = threading.Event()
+        if pending != None:
+            pending.wait()
+            with self._isochroneLock:
+                return self.isochrones.get(key)
+        isochrones = None
+        try:
+            isochrones = self.queryIsochrones(dest, thresholds, priority)
+        finally:
+            with self._isochroneLock:
+                if isochrones != None:
+                    self.isochrones[key] = isochrones
+                self.isochronesPending.pop(key).set()
+        return isochrones
+
+    def queryIsochrones(self, dest, thresholds, priority):
+        """Requests the Isochrones around the destination for all thresholds in minutes from ORS. Returns None, if the request failed."""
+        key = ((dest[0], dest[1]), tuple(thresholds))
+        body = {
+            "locations" : [[dest[0], dest[1]]],
+            "range" : [int(threshold * 60) for threshold in thresholds], # in sec
+            "range_type" : "time"
+        }
+        try:
+            response = self.request('isochrones', priority, 'POST', self.ISOCHRONE_ENDPOINT, json=body, headers={"Authorization" : self.key}, timeout=(5,30))
+            if response == None:
+                return None
+            self.isochroneCalls += 1
+            if response.status_code != 200:
+                cf.log.error('[ORS] Isochrone computation failed! Server status code: ' + str(response.status_code))
+                self.isochroneFailures[key] = clock.time()
+                return None
+            isochrones = Isochrones.fromFeatures(json.loads(response.text)['features'])
+        except Exception as e:
+            cf.log.error('[ORS] Isochrone computation failed! Reason: ' + str(e))
+            self.isochroneFailures[key] = clock.time()
             return None
+        if isochrones == None:
+            self.isochroneFailures[key] = clock.time()
+        else:
+            cf.log.debug('[ORS] Isochrones of ' + str(list(thresholds)) + ' min around ' + str(dest) + ' computed.')
+        return isochrones
+
+    def forgetRoute(self, dest):
+        """Forgets the stored route and geometry to a destination, e.g. at the end of a follow process."""
+        key = (dest[0], dest[1])
+        self.lastRoutes.pop(key, None)
+        self.routeGeometries.pop(key, None)
+
+    def logStats(self):
+        """Writes the statistics of the caches to the log."""
+        self.geocodeCache.logStats()
+        limiter.logStats()
+        if self.router != None:
+            self.router.logStats()
+        cf.log.info('[ORS] Directions: ' + str(self.routeCalls) + ' requests, ' + str(self.routeCallsAvoided) + ' avoided by reusing the last route or projecting onto its geometry. Isochrones: ' + str(self.isochroneCalls) + ' requests for ' + str(len(self.isochrones)) + ' destinations. Matrix: ' + str(self.matrixCalls) + ' requests for ' + str(self.matrixRoutes) + ' routes')
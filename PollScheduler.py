@@ -0,0 +1,93 @@
+import config as cf
+from Clock import clock
+import os
+
+
+class PollScheduler:
+    """ Picks the time until the next aprs.fi poll. It polls rarely while a station is far away from its next alert threshold and often when a threshold is about to be crossed. """
+
+    def __init__(self):
+        """ Constructor of the scheduler. The interval limits are read from the .env file. """
+        self.FIXED_INTERVAL = 90 # the former fixed interval, only used to count how many polls were saved
+        self.LEAD_FACTOR = 0.5 # poll at least twice before the next threshold is expected to be crossed
+        self.PACKET_SLACK = 5 # seconds aprs.fi needs to show a new packet
+        self.PACKET_SMOOTHING = 0.3 # weight of the newest packet interval in the running average
+
+        try:
+            self.minInterval = float(os.getenv('APRS_MIN_POLL_INTERVAL', 20))
+            self.maxInterval = float(os.getenv('APRS_MAX_POLL_INTERVAL', 300))
+        except:
+            self.minInterval = 20
+            self.maxInterval = 300
+            cf.log.error('[SCHED] Could not read APRS_MIN_POLL_INTERVAL or APRS_MAX_POLL_INTERVAL. Default: 20, 300 sec')
+        if self.minInterval > self.maxInterval:
+            cf.log.error('[SCHED] APRS_MIN_POLL_INTERVAL is larger than APRS_MAX_POLL_INTERVAL. Using the fixed interval for both.')
+            self.minInterval = self.FIXED_INTERVAL
+            self.maxInterval = self.FIXED_INTERVAL
+
+        self.etas = {} # call -> (ETA in min, next alert threshold in min, time of the estimate)
+        self.lastPackets = {} # call -> timestamp of the last packet
+        self.packetIntervals = {} # call -> average interval between two packets in sec
+
+        # statistics
+        self.polls = 0
+        self.elapsed = 0.0
+
+    def updateETA(self, call, eta, nextAlert):
+        """ Stores the latest ETA and the next alert threshold (both in minutes) of a station. If either is None, the station is polled with the default interval. """
+        call = call.strip().upper()
+        if eta == None or nextAlert == None:
+            self.etas.pop(call, None)
+        else:
+            self.etas[call] = (eta, nextAlert, clock.time())
+
+    def updatePacket(self, call, timestamp):
+        """ Stores the timestamp of a new packet to learn how often the station beacons. """
+        call = call.strip().upper()
+        last = self.lastPackets.get(call)
+        self.lastPackets[call] = timestamp
+        if last == None or timestamp <= last:
+            return
+        interval = timestamp - last
+        if self.packetIntervals.get(call) == None:
+            self.packetIntervals[call] = interval
+        else:
+            self.packetIntervals[call] = (1 - self.PACKET_SMOOTHING) * self.packetIntervals[call] + self.PACKET_SMOOTHING * interval
+
+    def forget(self, call):
+        """ Removes all knowledge about a station. """
+        call = call.strip().upper()
+        self.etas.pop(call, None)
+        self.lastPackets.pop(call, None)
+        self.packetIntervals.pop(call, None)
+
+    def nextInterval(self, calls, now=None):
+        """ Returns the seconds to wait until the next poll of the given stations. The station needing the earliest poll decides. """
+        if now == None:
+            now = clock.time()
+        interval = self.maxInterval
+        for call in calls:
+            interval = min(interval, self.stationInterval(call.strip().upper(), now))
+        return max(self.minInterval, min(self.maxInterval, interval))
+
+    def stationInterval(self, call, now):
+        """ Returns the seconds to wait for a single station, not yet clamped to the limits. """
+        if self.etas.get(call) == None:
+            return self.FIXED_INTERVAL # nothing known yet, keep the old behaviour
+        eta, nextAlert, estimated = self.etas[call]
+        lead = (eta - nextAlert) * 60 - (now - estimated) # seconds until the threshold is expected to be crossed
+        interval = self.LEAD_FACTOR * lead
+        # there is no point in polling before the station is expected to send its next packet
+        if self.packetIntervals.get(call) != None:
+            expected = self.lastPackets[call] + self.packetIntervals[call] + self.PACKET_SLACK - now
+            interval = max(interval, expected)
+        return interval
+
+    def recordPoll(self, interval):
+        """ Counts a poll and the time waited after it. """
+        self.polls += 1
+        self.elapsed += interval
+
+    def pollsSaved(self):
+        """ Returns how many polls were saved compared with the fixed interval. This is negative if more polls were needed. """
+        return int(self.elapsed / self.FIXED_INTERVAL) - self.polls
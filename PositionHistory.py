@@ -0,0 +1,96 @@
+import numpy as np
+
+
+class PositionHistory:
+    """ A fixed-capacity ring buffer of the fixes (t, lng, lat) of a single station. It is backed by a preallocated NumPy array, so the memory stays bounded no matter how long a trip runs. All motion queries are vectorized. """
+
+    EARTH_RADIUS = 6371.0088 # mean earth radius in km
+
+    def __init__(self, capacity=256):
+        """ Creates an empty history which keeps the last capacity fixes. """
+        self.capacity = max(2, int(capacity))
+        self.data = np.zeros((self.capacity, 3)) # columns: unix time, longitude, latitude
+        self.count = 0
+        self.head = 0 # index of the next write
+
+    def __len__(self):
+        return self.count
+
+    def append(self, timestamp, coord):
+        """ Adds a fix. The oldest fix is overwritten once the buffer is full. Fixes not newer than the last one are ignored. """
+        if self.count > 0 and timestamp <= self.data[(self.head - 1) % self.capacity, 0]:
+            return
+        self.data[self.head] = (timestamp, coord[0], coord[1])
+        self.head = (self.head + 1) % self.capacity
+        self.count = min(self.count + 1, self.capacity)
+
+    def clear(self):
+        """ Forgets all fixes. """
+        self.count = 0
+        self.head = 0
+
+    def asArray(self, n=None):
+        """ Returns the last n (default: all) fixes in chronological order as an array of shape (n, 3) with the columns t, lng, lat. """
+        if n == None or n > self.count:
+            n = self.count
+        ix = (self.head - n + np.arange(n)) % self.capacity
+        return self.data[ix]
+
+    def last(self):
+        """ Returns the newest fix as (t, [lng, lat]) or None, if there is none. """
+        if self.count == 0:
+            return None
+        t, lng, lat = self.data[(self.head - 1) % self.capacity]
+        return float(t), [float(lng), float(lat)]
+
+    @staticmethod
+    def haversine(lng1, lat1, lng2, lat2):
+        """ Great-circle distance in km. Works on scalars and arrays. """
+        lng1, lat1, lng2, lat2 = map(np.radians, (lng1, lat1, lng2, lat2))
+        a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lng2 - lng1) / 2) ** 2
+        return 2 * PositionHistory.EARTH_RADIUS * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+
+    @staticmethod
+    def bearing(lng1, lat1, lng2, lat2):
+        """ Initial bearing in degrees (0 = north, 90 = east) from the first to the second point. Works on scalars and arrays. """
+        lng1, lat1, lng2, lat2 = map(np.radians, (lng1, lat1, lng2, lat2))
+        y = np.sin(lng2 - lng1) * np.cos(lat2)
+        x = np.cos(lat1) * np.sin(lat2) - np.sin(lat1) * np.cos(lat2) * np.cos(lng2 - lng1)
+        return np.degrees(np.arctan2(y, x)) % 360
+
+    def distances(self, n=None):
+        """ Returns the distances in km between successive fixes of the last n fixes. """
+        fixes = self.asArray(n)
+        return self.haversine(fixes[:-1, 1], fixes[:-1, 2], fixes[1:, 1], fixes[1:, 2])
+
+    def speeds(self, n=None):
+        """ Returns the speeds in km/h between successive fixes of the last n fixes. """
+        fixes = self.asArray(n)
+        dt = np.diff(fixes[:, 0]) / 3600
+        return self.haversine(fixes[:-1, 1], fixes[:-1, 2], fixes[1:, 1], fixes[1:, 2]) / dt
+
+    def headings(self, n=None):
+        """ Returns the headings in degrees between successive fixes of the last n fixes. """
+        fixes = self.asArray(n)
+        return self.bearing(fixes[:-1, 1], fixes[:-1, 2], fixes[1:, 1], fixes[1:, 2])
+
+    def velocity(self, window=5):
+        """ Returns the smoothed velocity over the last window fixes as (speed in km/h, heading in degrees), or None if there are less than two fixes. The segment vectors are summed, so zig-zagging and GPS jitter cancel out. """
+        fixes = self.asArray(window)
+        if len(fixes) < 2:
+            return None
+        d = self.haversine(fixes[:-1, 1], fixes[:-1, 2], fixes[1:, 1], fixes[1:, 2])
+        b = np.radians(self.bearing(fixes[:-1, 1], fixes[:-1, 2], fixes[1:, 1], fixes[1:, 2]))
+        east = np.sum(d * np.sin(b))
+        north = np.sum(d * np.cos(b))
+        hours = (fixes[-1, 0] - fixes[0, 0]) / 3600
+        speed = np.hypot(east, north) / hours
+        heading = np.degrees(np.arctan2(east, north)) % 360
+        return float(speed), float(heading)
+
+    def packetInterval(self, n=None):
+        """ Returns the median interval between two fixes in seconds, or None if there are less than two fixes. """
+        fixes = self.asArray(n)
+        if len(fixes) < 2:
+            return None
+        return float(np.median(np.diff(fixes[:, 0])))
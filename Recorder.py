@@ -0,0 +1,61 @@
+import config as cf
+import os
+import json
+import threading
+import time
+
+
+class Recorder:
+    """ Records the exchanges with aprs.fi, ORS and Telegram into a compact append-only file, one JSON object per line. Such a recording can be played back with tests/replay.py. Recording is enabled by setting RECORD_FILE_PATH in the .env file. """
+
+    def __init__(self, path):
+        """ Constructor of the recorder. If path is None or empty, nothing is recorded. """
+        self.SECRET_PARAMS = ['apikey', 'api_key'] # never written to the file
+        self.path = path
+        self.enabled = path != None and path != ''
+        self._lock = threading.Lock()
+        if self.enabled:
+            cf.log.info('[REC] Recording all API exchanges to ' + path)
+
+    def write(self, record):
+        """ Appends a single record to the file. Recording errors are logged but never passed on. """
+        if not self.enabled:
+            return
+        record['t'] = round(time.time(), 3)
+        try:
+            line = json.dumps(record, separators=(',', ':'))
+            with self._lock:
+                with open(self.path, 'a') as f:
+                    f.write(line + '\n')
+        except Exception as e:
+            cf.log.warn('[REC] Could not write the recording. Reason: ' + str(e))
+
+    def recordHTTP(self, method, url, params, body, status, text):
+        """ Records a HTTP exchange. Secret parameters are removed. """
+        if not self.enabled:
+            return
+        if params != None:
+            params = {k : v for k, v in params.items() if k not in self.SECRET_PARAMS}
+        self.write({'k' : 'http', 'm' : method, 'u' : url, 'p' : params, 'j' : body, 's' : status, 'b' : text})
+
+    def recordMessage(self, chatID, message):
+        """ Records a message sent to Telegram. """
+        self.write({'k' : 'tg', 'c' : chatID, 'x' : message})
+
+    def recordUpdate(self, update):
+        """ Records an update received from Telegram, as dict. """
+        self.write({'k' : 'update', 'u' : update})
+
+    def recordPacket(self, line):
+        """ Records a raw packet received from APRS-IS. """
+        self.write({'k' : 'aprsis', 'l' : line})
+
+    def recordRoute(self, dest, alertees, toStr, call=None):
+        """ Records the start (or the end, if dest is None) of a follow process. The call is only recorded for other stations than the own one. """
+        record = {'k' : 'route', 'd' : dest, 'a' : alertees, 'to' : toStr}
+        if call != None:
+            record['c'] = call
+        self.write(record)
+
+
+recorder = Recorder(os.getenv('RECORD_FILE_PATH')) # the shared instance
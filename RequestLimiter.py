@@ -0,0 +1,158 @@
+import config as cf
+import heapq
+import itertools
+import os
+import threading
+import time
+
+
+class RequestLimiter:
+    """ A quota-aware rate limiter for the ORS API. Every endpoint has a token bucket for its per-minute quota and a counter for its daily budget. Requests wait for a token in the order of their priority, so an imminent alert is never stuck behind a bulk geocoding job. """
+
+    IMMINENT = 0 # route checks close to an alert threshold
+    BACKGROUND = 1 # regular route updates and refreshes
+    BULK = 2 # geocoding and precomputations nobody waits for
+    PRIORITY_NAMES = ['imminent', 'background', 'bulk']
+
+    def __init__(self):
+        """ Constructor of the limiter. The quotas are those of the ORS free tier, the waiting time and the reserve are read from the .env file. """
+        self.QUOTAS = { # endpoint -> (requests per minute, requests per day)
+            'directions' : (40, 2000),
+            'geocode' : (100, 1000),
+            'matrix' : (40, 500),
+            'isochrones' : (20, 500)
+        }
+        self.BURST = 0.25 # share of the per-minute quota which may be sent at once, the refill rate is lowered by it, so no minute exceeds the quota
+        try:
+            self.maxWait = float(os.getenv('ORS_MAX_WAIT', 30)) # sec a request may wait for a token
+            self.bulkReserve = float(os.getenv('ORS_BULK_RESERVE', 0.2)) # share of the daily budget bulk requests may not use
+        except:
+            self.maxWait = 30
+            self.bulkReserve = 0.2
+            cf.log.error('[LIMIT] Could not read ORS_MAX_WAIT or ORS_BULK_RESERVE. Default: 30 sec, 0.2')
+
+        self.enabled = True
+        self._condition = threading.Condition()
+        self._sequence = itertools.count() # keeps the order within a priority
+        self.day = time.gmtime().tm_yday # the daily quotas are reset at midnight UTC
+        self.buckets = {}
+        for endpoint, (perMinute, perDay) in self.QUOTAS.items():
+            capacity = max(1.0, perMinute * self.BURST)
+            self.buckets[endpoint] = {
+                'capacity' : capacity,
+                'rate' : (perMinute - capacity) / 60, # tokens per sec
+                'tokens' : capacity,
+                'updated' : time.monotonic(),
+                'perDay' : perDay,
+                'used' : 0, # today
+                'queue' : [], # heap of (priority, sequence) of the waiting requests
+                'maxDepth' : 0,
+                'granted' : 0,
+                'refused' : 0,
+                'waited' : [0.0, 0.0, 0.0], # total waiting time per priority
+                'waits' : [0, 0, 0], # granted requests per priority
+                'maxWait' : 0.0
+            }
+
+    def refill(self, bucket):
+        """ Adds the tokens accumulated since the last update. The condition must be held. """
+        now = time.monotonic()
+        bucket['tokens'] = min(bucket['capacity'], bucket['tokens'] + (now - bucket['updated']) * bucket['rate'])
+        bucket['updated'] = now
+
+    def resetDay(self):
+        """ Resets the daily counters after midnight UTC. The condition must be held. """
+        day = time.gmtime().tm_yday
+        if day != self.day:
+            self.day = day
+            for bucket in self.buckets.values():
+                bucket['used'] = 0
+
+    def acquire(self, endpoint, priority=BACKGROUND):
+        """ Waits until a request to the endpoint may be sent. Returns True if it may, False if the daily budget is used up or no token became free within the maximum waiting time. Requests of higher priority are served first. """
+        bucket = self.buckets.get(endpoint)
+        if bucket == None:
+            return True
+        if not self.enabled: # nothing is sent, only counted
+            with self._condition:
+                bucket['used'] += 1
+                bucket['granted'] += 1
+            return True
+        with self._condition:
+            self.resetDay()
+            budget = bucket['perDay'] * (1 - self.bulkReserve) if priority == self.BULK else bucket['perDay']
+            if bucket['used'] >= budget:
+                bucket['refused'] += 1
+                cf.log.warn('[LIMIT] Daily budget of ' + endpoint + ' is used up for ' + self.PRIORITY_NAMES[priority] + ' requests.')
+                return False
+            entry = (priority, next(self._sequence))
+            heapq.heappush(bucket['queue'], entry)
+            bucket['maxDepth'] = max(bucket['maxDepth'], len(bucket['queue']))
+            start = time.monotonic()
+            while True:
+                self.refill(bucket)
+                first = bucket['queue'][0] == entry
+                if first and bucket['tokens'] >= 1:
+                    break
+                remaining = start + self.maxWait - time.monotonic()
+                if remaining <= 0:
+                    bucket['queue'].remove(entry)
+                    heapq.heapify(bucket['queue'])
+                    bucket['refused'] += 1
+                    self._condition.notify_all() # the next one may be first now
+                    cf.log.warn('[LIMIT] No ' + endpoint + ' token within ' + str(self.maxWait) + ' sec, ' + self.PRIORITY_NAMES[priority] + ' request dropped.')
+                    return False
+                if first:
+                    self._condition.wait(min(remaining, (1 - bucket['tokens']) / bucket['rate']))
+                else:
+                    self._condition.wait(remaining)
+            heapq.heappop(bucket['queue'])
+            bucket['tokens'] -= 1
+            bucket['used'] += 1
+            bucket['granted'] += 1
+            waited = time.monotonic() - start
+            bucket['waited'][priority] += waited
+            bucket['waits'][priority] += 1
+            bucket['maxWait'] = max(bucket['maxWait'], waited)
+            self._condition.notify_all()
+            return True
+
+    def disable(self):
+        """ Lets every request pass at once, without quotas. For the replay, which answers the requests locally and runs faster than the wall clock. """
+        self.enabled = False
+
+    def drain(self, endpoint):
+        """ Empties the bucket of an endpoint, e.g. after the server answered 429 Too Many Requests. """
+        bucket = self.buckets.get(endpoint)
+        if bucket == None:
+            return
+        with self._condition:
+            self.refill(bucket)
+            bucket['tokens'] = 0.0
+
+    def stats(self):
+        """ Returns the counters of every endpoint: usage of the daily budget, queue depth and the mean waiting time per priority. """
+        result = {}
+        with self._condition:
+            for endpoint, bucket in self.buckets.items():
+                result[endpoint] = {
+                    'used' : bucket['used'],
+                    'perDay' : bucket['perDay'],
+                    'granted' : bucket['granted'],
+                    'refused' : bucket['refused'],
+                    'queueDepth' : len(bucket['queue']),
+                    'maxQueueDepth' : bucket['maxDepth'],
+                    'meanWait' : {self.PRIORITY_NAMES[p] : round(bucket['waited'][p] / bucket['waits'][p], 3) for p in range(3) if bucket['waits'][p] > 0},
+                    'maxWait' : round(bucket['maxWait'], 3)
+                }
+        return result
+
+    def logStats(self):
+        """ Writes the counters of every used endpoint to the log. """
+        for endpoint, stats in self.stats().items():
+            if stats['granted'] == 0 and stats['refused'] == 0:
+                continue
+            cf.log.info('[LIMIT] ' + endpoint + ': ' + str(stats['used']) + '/' + str(stats['perDay']) + ' of the daily budget, ' + str(stats['refused']) + ' refused, max queue ' + str(stats['maxQueueDepth']) + ', mean wait ' + str(stats['meanWait']) + ' sec, max wait ' + str(stats['maxWait']) + ' sec')
+
+
+limiter = RequestLimiter() # the shared instance, the quotas belong to the API key
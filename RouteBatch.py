@@ -0,0 +1,42 @@
+import config as cf
+from RequestLimiter import RequestLimiter
+import threading
+
+
+class RouteBatch:
+    """ Collects the route requests of all sessions during one polling round and answers them together. The pending (start, destination) pairs are sent to ORS in as few requests as possible and every result is handed back to the callback of its session. """
+
+    def __init__(self, ors):
+        """ Constructor of the batch. ors is the OpenRouteService used for the requests. """
+        self.ors = ors
+        self._lock = threading.Lock()
+        self.pending = [] # (start, dest, callback, priority)
+        self.rounds = 0
+        self.pairs = 0
+
+    def add(self, start, dest, callback, priority=RequestLimiter.BACKGROUND):
+        """ Queues a route request. The callback is called with [distance in km, travel time in min] or None, once the round is flushed. The priority is used by the rate limiter. """
+        with self._lock:
+            self.pending.append((start, dest, callback, priority))
+
+    def flush(self):
+        """ Sends all pending requests and hands the results to their callbacks. Called at the end of every polling round. The requests are sent by priority, the most urgent ones first. """
+        with self._lock:
+            pending = self.pending
+            self.pending = []
+        if len(pending) == 0:
+            return
+        self.rounds += 1
+        self.pairs += len(pending)
+        for priority in sorted(set(p[3] for p in pending)):
+            group = [p for p in pending if p[3] == priority]
+            results = self.ors.getRouteSummaries([p[0] for p in group], [p[1] for p in group], priority=priority)
+            for (start, dest, callback, priority), result in zip(group, results):
+                try:
+                    callback(result)
+                except Exception as e:
+                    cf.log.error('[BATCH] Handling a route result failed. Reason: ' + str(e))
+
+    def logStats(self):
+        """ Writes the number of rounds and route requests to the log. """
+        cf.log.info('[BATCH] ' + str(self.pairs) + ' route requests in ' + str(self.rounds) + ' rounds.')
@@ -0,0 +1,62 @@
+from PositionHistory import PositionHistory
+import numpy as np
+
+
+class RouteGeometry:
+    """ The polyline of a route with the cumulative distance and travel time at every vertex. A position is projected onto the polyline locally, which gives the remaining distance and time without asking ORS again. All segment math is vectorized. """
+
+    def __init__(self, coords, times, distance=None):
+        """ Creates the geometry from the vertices [[lng, lat], ...] and the cumulative travel time in minutes at every vertex. If the total distance in km is given, the cumulative distances are scaled to it. """
+        self.coords = np.asarray(coords, dtype=float).reshape(-1, 2)
+        self.times = np.asarray(times, dtype=float)
+        lengths = PositionHistory.haversine(self.coords[:-1, 0], self.coords[:-1, 1], self.coords[1:, 0], self.coords[1:, 1])
+        self.distances = np.concatenate(([0.0], np.cumsum(lengths)))
+        if distance != None and self.distances[-1] > 0:
+            self.distances *= distance / self.distances[-1] # the road distance of ORS is more exact than the sum of the chords
+        self.totalDistance = float(self.distances[-1])
+        self.totalTime = float(self.times[-1])
+
+    @staticmethod
+    def fromFeature(feature):
+        """ Builds the geometry of a GeoJSON feature of the ORS directions endpoint. The duration of every step is spread over its vertices by distance. Returns None, if the feature has no usable geometry. """
+        try:
+            coords = np.asarray(feature['geometry']['coordinates'], dtype=float)[:, :2]
+            if len(coords) < 2:
+                return None
+            lengths = PositionHistory.haversine(coords[:-1, 0], coords[:-1, 1], coords[1:, 0], coords[1:, 1])
+            durations = np.zeros(len(lengths)) # minutes per polyline segment
+            for segment in feature['properties']['segments']:
+                for step in segment['steps']:
+                    first, last = step['way_points']
+                    if last <= first:
+                        continue
+                    share = lengths[first:last]
+                    if share.sum() > 0:
+                        durations[first:last] = float(step['duration']) / 60 * share / share.sum()
+                    else:
+                        durations[first:last] = float(step['duration']) / 60 / (last - first)
+            summary = feature['properties']['summary']
+            total = float(summary['duration']) / 60
+            if durations.sum() > 0:
+                durations *= total / durations.sum()
+            else: # no steps, assume a constant speed
+                durations = total * lengths / max(lengths.sum(), 1e-9)
+            return RouteGeometry(coords, np.concatenate(([0.0], np.cumsum(durations))), float(summary['distance']) / 1000)
+        except (KeyError, IndexError, TypeError, ValueError):
+            return None
+
+    def project(self, point):
+        """ Projects the position [lng, lat] onto the closest segment of the polyline. Returns (distance to the route in km, remaining distance in km, remaining time in min). """
+        # local equirectangular projection around the point, exact enough for the distance to a route nearby
+        scale = np.radians(1) * PositionHistory.EARTH_RADIUS
+        x = (self.coords[:, 0] - point[0]) * scale * np.cos(np.radians(point[1]))
+        y = (self.coords[:, 1] - point[1]) * scale
+        ax, ay = x[:-1], y[:-1]
+        dx, dy = x[1:] - ax, y[1:] - ay
+        lengths = dx ** 2 + dy ** 2
+        t = np.clip(-(ax * dx + ay * dy) / np.where(lengths > 0, lengths, 1), 0, 1) # the point is the origin
+        offsets = np.hypot(ax + t * dx, ay + t * dy)
+        i = int(np.argmin(offsets))
+        travelled = self.distances[i] + t[i] * (self.distances[i + 1] - self.distances[i])
+        elapsed = self.times[i] + t[i] * (self.times[i + 1] - self.times[i])
+        return float(offsets[i]), max(0.0, self.totalDistance - float(travelled)), max(0.0, self.totalTime - float(elapsed))
@@ -0,0 +1,144 @@
+import config as cf
+from FollowSession import FollowSession
+import threading
+import numpy as np
+
+
+class SessionManager:
+    """ Holds the follow sessions of all stations, indexed by callsign. Every station has at most one session, a new follow process of the same station replaces the old one. The alert state of all sessions is kept in one boolean matrix (a row per session, a column per alert threshold) next to vectors of their latest ETA and distance, so the thresholds of every session are evaluated in one batched operation per polling round. The sessions are started and stopped from the Telegram handlers and read by the poller, so the index is guarded by a lock. """
+
+    # what evaluate found for a session
+    QUIET = 0 # no threshold crossed
+    STARTED = 1 # the first travel time of the session, the initial alert
+    ALREADY_THERE = 2 # the first travel time is already below the last threshold
+    ALERT = 3 # the next threshold was crossed
+    ARRIVED = 4 # the last threshold was crossed
+
+    def __init__(self, thresholds):
+        """ Constructor of the manager. thresholds is the number of alert thresholds of every session. """
+        self.thresholds = thresholds
+        self._lock = threading.Lock()
+        self.sessions = {} # CALL -> FollowSession
+        self.started = 0
+        self.capacity = 0
+        self.alertStates = np.zeros((0, thresholds), dtype=bool) # row -> True for every alerted threshold
+        self.etas = np.zeros(0) # row -> latest travel time in min
+        self.distances = np.zeros(0) # row -> latest distance in km
+        self.updated = np.zeros(0, dtype=bool) # row -> a travel time was reported since the last evaluation
+        self.rows = [] # row -> FollowSession or None
+        self.free = [] # unused rows
+        self.grow(16)
+
+    @staticmethod
+    def key(call):
+        """ Normalizes a callsign to the key of the index. """
+        return call.strip().upper()
+
+    def grow(self, capacity):
+        """ Enlarges the matrix and the vectors to capacity rows. The lock must be held. """
+        added = capacity - self.capacity
+        self.alertStates = np.concatenate((self.alertStates, np.zeros((added, self.thresholds), dtype=bool)))
+        self.etas = np.concatenate((self.etas, np.full(added, np.nan)))
+        self.distances = np.concatenate((self.distances, np.full(added, np.nan)))
+        self.updated = np.concatenate((self.updated, np.zeros(added, dtype=bool)))
+        self.rows += [None] * added
+        self.free += list(range(capacity - 1, self.capacity - 1, -1)) # the lowest rows are used first
+        self.capacity = capacity
+
+    def start(self, call, dest, alertees, toStr='you', owner=None):
+        """ Starts the session of the station call to dest and returns it. The previous session of the station, if any, is replaced. """
+        with self._lock:
+            old = self.sessions.pop(self.key(call), None)
+            if old != None:
+                self.release(old)
+            if len(self.free) == 0:
+                self.grow(2 * self.capacity)
+            session = FollowSession(self.key(call), dest, alertees, toStr, cf.MASTER_CHATID if owner == None else owner, self.free.pop())
+            self.alertStates[session.row] = False
+            self.etas[session.row] = np.nan
+            self.distances[session.row] = np.nan
+            self.updated[session.row] = False
+            self.rows[session.row] = session
+            self.sessions[session.call] = session
+            self.started += 1
+        cf.log.debug('[SESSIONS] Session of ' + session.call + ' started. Active sessions: ' + str(len(self.sessions)))
+        return session
+
+    def release(self, session):
+        """ Frees the row of an ended session. The lock must be held. """
+        self.rows[session.row] = None
+        self.updated[session.row] = False
+        self.free.append(session.row)
+
+    def stop(self, call):
+        """ Ends the session of the station call and returns it, or None if there was none. """
+        with self._lock:
+            session = self.sessions.pop(self.key(call), None)
+            if session != None:
+                self.release(session)
+        if session != None:
+            cf.log.debug('[SESSIONS] Session of ' + session.call + ' ended. Active sessions: ' + str(len(self.sessions)))
+        return session
+
+    def get(self, call):
+        """ Returns the session of the station call or None. """
+        return self.sessions.get(self.key(call))
+
+    def isActive(self, session):
+        """ True, if the session was neither ended nor replaced. Results which arrive late are dropped this way. """
+        return self.sessions.get(session.call) is session
+
+    def all(self):
+        """ Returns a list of all active sessions. """
+        with self._lock:
+            return list(self.sessions.values())
+
+    def headingTo(self, dest):
+        """ Returns the active sessions with the destination dest. """
+        return [s for s in self.all() if s.dest[0] == dest[0] and s.dest[1] == dest[1]]
+
+    def nextThreshold(self, session):
+        """ Returns the index of the next alert threshold of a session: 0 before the initial alert, the number of thresholds once all were alerted. The alerted thresholds are always the first ones, as the thresholds are falling. """
+        return int(np.count_nonzero(self.alertStates[session.row]))
+
+    def report(self, session, distance, time):
+        """ Stores the latest distance in km and travel time in min of a session. The thresholds are evaluated for all sessions at once by evaluate. """
+        with self._lock:
+            if self.isActive(session):
+                self.distances[session.row] = distance
+                self.etas[session.row] = time
+                self.updated[session.row] = True
+
+    def evaluate(self, alertTimes):
+        """ Evaluates the alert thresholds alertTimes (the first one is the initial alert) of every session with a reported travel time since the last call, and marks the crossed thresholds as alerted. Returns the list of these sessions and arrays of what was found for each (QUIET, STARTED, ...), its distance, travel time and the next threshold (NaN if there is none).
+        Like a single session evaluated packet by packet: the first travel time gives the initial alert and passes all thresholds it is already below. Later, all thresholds the travel time is below are passed, once it crossed the next one. """
+        limits = np.asarray(alertTimes, dtype=float)
+        with self._lock: # the sessions cannot end in between
+            rows = np.flatnonzero(self.updated)
+            self.updated[rows] = False
+            times = self.etas[rows]
+            states = self.alertStates[rows]
+            minutes = np.round(times)
+            crossed = minutes[:, None] <= limits[None, 1:]
+            nextIx = np.count_nonzero(states, axis=1)
+            initial = nextIx == 0
+            following = np.append(limits, -np.inf)[nextIx] # -inf once every threshold was alerted
+            alerted = ~initial & (minutes <= following)
+            changed = initial | alerted
+            states[changed, 0] = True
+            states[changed, 1:] = crossed[changed]
+            self.alertStates[rows] = states
+            done = np.all(states, axis=1)
+            kinds = np.full(len(rows), self.QUIET, dtype=np.int8)
+            kinds[initial] = self.STARTED
+            kinds[initial & done] = self.ALREADY_THERE
+            kinds[alerted] = self.ALERT
+            kinds[alerted & done] = self.ARRIVED
+            nextAlerts = np.append(limits, np.nan)[np.count_nonzero(states, axis=1)]
+            return [self.rows[r] for r in rows.tolist()], kinds, self.distances[rows], times, nextAlerts
+
+    def __len__(self):
+        return len(self.sessions)
+
+    def __contains__(self, call):
+        return self.key(call) in self.sessions
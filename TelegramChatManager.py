@@ -1,4 +1,8 @@
 import config as cf
+from Recorder import recorder
+from AddressIndex import addressIndex
+from MessageQueue import MessageQueue
+from LoopMonitor import LoopMonitor
 import telegram
 import warnings
 import os
@@ -9,11 +13,15 @@ from telegram.ext import (
     ContextTypes,
     ConversationHandler,
     MessageHandler,
+    TypeHandler,
     filters,
 )
 from typing import Dict
 import asyncio
 import re
+import secrets
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
 
 CONFIG_BOT, GET_NAME = range(2)
 GET_ADDR_NAME, GET_ADDR, CHECK_ADDR = range(3)
@@ -24,10 +32,17 @@ class TelegramChatManager:
 
     def __init__(self, newRouteCallback, geocodeCallback, arrivedCallback):
         """Construct the chat manager object. It allows to handle conversations with multiple users"""
-        self.bot = telegram.Bot(token=os.getenv('TELEGRAM_TOKEN')) #simple object to send single messages without conversation control
-
         # Create the Application and pass it your bot's token.
-        self.app = Application.builder().token(os.getenv('TELEGRAM_TOKEN')).build()
+        builder = Application.builder().token(os.getenv('TELEGRAM_TOKEN'))
+        if os.getenv('TELEGRAM_API_URL', '') != '': # a local Bot API server, or the stand-in of tests/benchWebhook.py
+            builder = builder.base_url(os.getenv('TELEGRAM_API_URL'))
+        self.app = builder.build()
+        self.app.add_handler(TypeHandler(Update, self.recordUpdate), group=-1) # sees every update before the other handlers
+        self.outbox = MessageQueue(self.deliver, self.edit) # all messages are sent through this queue on the loop of the application
+        self.loopMonitor = LoopMonitor() # measures how long the handlers block the loop
+        self.startupCallbacks = [self.outbox.start, self.loopMonitor.start]
+        self.app.post_init = self.postInit
+        self.app.post_stop = self.postStop
 
         # on different commands start different conversaions
         convStartHandler = ConversationHandler( # /start conversation
@@ -42,7 +57,7 @@ class TelegramChatManager:
             entry_points=[CommandHandler("addaddress", self.handleAddAddress)],
             states={
             GET_ADDR_NAME:[MessageHandler(filters.TEXT & ~filters.COMMAND, self.handlerGetAddrName)], # get the name for the address
-            GET_ADDR:[MessageHandler(filters.TEXT & ~filters.COMMAND, self.handlerGetAddr)], # get the actual address
+            GET_ADDR:[MessageHandler(filters.TEXT & ~filters.COMMAND, self.handlerGetAddr, block=False)], # get the actual address, the geocoding must not hold back the /quit
             CHECK_ADDR:[MessageHandler(filters.TEXT & ~filters.COMMAND, self.handlerCheckAddr)], # ask weather geocoding was successfull
             },
             fallbacks=[CommandHandler("quit", self.handleQuit)]
@@ -56,7 +71,7 @@ class TelegramChatManager:
         self.app.add_handler(CommandHandler("takeover", self.handleTakeover))
         self.app.add_handler(CommandHandler("show", self.handleShAddress))
         self.app.add_handler(CommandHandler("quit", self.handleQuit))
-        self.app.add_handler(CommandHandler("arrived", self.handleArrived))
+        self.app.add_handler(CommandHandler("arrived", self.handleArrived, block=False))
         self.app.add_handler(CommandHandler("chname", self.handleChName))
         self.app.add_handler(CommandHandler("verify", self.handleVerify))
         self.app.add_handler(CommandHandler("rmuser", self.handleRMuser))
@@ -69,28 +84,119 @@ class TelegramChatManager:
         self.newRoute = newRouteCallback
         self.geocode = geocodeCallback
         self.arrived = arrivedCallback
-        self._loop = asyncio.new_event_loop()
+        self.proposedRoute = None # (coords, alertees, toStr) suggested in the passive mode, waiting for the owner
+        self._loop = asyncio.new_event_loop() # run_polling runs the event loop of the main thread
         asyncio.set_event_loop(self._loop)
 
+        # the updates are either polled from Telegram or Telegram posts them to our webhook
+        self.webhookMode = os.getenv('TELEGRAM_MODE', 'polling') == 'webhook'
+        self.webhookURL = os.getenv('TELEGRAM_WEBHOOK_URL', '') # the public URL Telegram posts the updates to
+        self.webhookListen = os.getenv('TELEGRAM_WEBHOOK_LISTEN', '0.0.0.0')
+        try:
+            self.webhookPort = int(os.getenv('TELEGRAM_WEBHOOK_PORT', 8443))
+        except:
+            self.webhookPort = 8443
+            cf.log.error('[TCM] Could not read TELEGRAM_WEBHOOK_PORT. Default: 8443')
+        self.webhookSecret = os.getenv('TELEGRAM_WEBHOOK_SECRET', '')
+        if self.webhookSecret == '': # without a secret, anyone knowing the URL could post updates
+            self.webhookSecret = secrets.token_urlsafe(32)
+        if self.webhookMode and self.webhookURL == '':
+            cf.log.error('[TCM] TELEGRAM_MODE is webhook, but TELEGRAM_WEBHOOK_URL is not set. Polling instead.')
+            self.webhookMode = False
+
+        # the blocking calls of the handlers (geocoding, routing) run in a few threads, so the loop keeps serving the other chats
+        try:
+            threads = int(os.getenv('TELEGRAM_BLOCKING_THREADS', 4))
+        except:
+            threads = 4
+            cf.log.error('[TCM] Could not read TELEGRAM_BLOCKING_THREADS. Default: 4')
+        self.executor = ThreadPoolExecutor(threads, thread_name_prefix='TCM') if threads > 0 else None # None calls them on the loop
+        self.blocking = {} # chatID -> set of the futures of its running blocking calls
+
     def execTCM(self):
-        """This function will start the polling process of the Telegram bot. This function will not return."""
-        self.app.run_polling()
+        """This function will start the Telegram bot, polling the updates or receiving them on the webhook. This function will not return."""
+        if self.webhookMode:
+            # the embedded server listens on the path of the public URL and rejects updates without the secret token
+            cf.log.info('[TCM] Receiving the updates on the webhook ' + self.webhookURL + ', listening on ' + self.webhookListen + ':' + str(self.webhookPort))
+            self.app.run_webhook(listen=self.webhookListen, port=self.webhookPort, url_path=urlsplit(self.webhookURL).path.lstrip('/'), webhook_url=self.webhookURL, secret_token=self.webhookSecret)
+        else:
+            self.app.run_polling() # removes a webhook set before
 
     def sendMessage(self, chatID, message):
-        """Basic function to send a message to a specific chat, this can be called from anywhere at anytime
+        """Basic function to send a message to a specific chat, this can be called from anywhere at anytime. The message is queued and sent by the outbox on the loop of the bot, so this never blocks.
         """
         if chatID == None or chatID == '':
             return
+        recorder.recordMessage(chatID, message)
         message = telegram.helpers.escape_markdown(message, version=2)
-        async def send_message(self, chatID, message):
-            try:
-                await self.bot.send_message(chat_id=chatID, text=message, parse_mode='MarkdownV2')
-            except telegram.error.BadRequest as e:
-                cf.log.warn('[TCM] The message could not be sent. Reason: ' + str(e))
-
-        asyncio.set_event_loop(self._loop)
-        asyncio.ensure_future(send_message(self, chatID, message))
-
+        self.outbox.put(chatID, message)
+
+    def sendAlerts(self, messages):
+        """Sends the list of alert messages [(chatID, message), ...] of one polling round to all chats at once. Alerts to the same chat which are waiting together are merged into one message by the outbox."""
+        messages = [(chatID, message) for chatID, message in messages if chatID != None and chatID != '']
+        for chatID, message in messages:
+            recorder.recordMessage(chatID, message)
+        self.outbox.putAll([(chatID, telegram.helpers.escape_markdown(message, version=2)) for chatID, message in messages])
+
+    def sendStatus(self, statuses):
+        """Sets the live status messages [(chatID, key, message, final), ...]. Every chat gets one message per key, which is edited with the following messages of the key until one is final. The status messages are not recorded."""
+        for chatID, key, message, final in statuses:
+            if chatID != None and chatID != '':
+                self.outbox.putStatus(chatID, key, telegram.helpers.escape_markdown(message, version=2), final)
+
+    async def deliver(self, chatID, message):
+        """Sends a single queued message and returns its ID. The errors are handled by the outbox."""
+        return (await self.app.bot.send_message(chat_id=chatID, text=message, parse_mode='MarkdownV2')).message_id
+
+    async def edit(self, chatID, messageID, message):
+        """Changes the text of a sent message. The errors are handled by the outbox."""
+        await self.app.bot.edit_message_text(chat_id=chatID, message_id=messageID, text=message, parse_mode='MarkdownV2')
+
+    async def recordUpdate(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        """Records every incoming update, so it can be posted to the webhook again by tests/benchWebhook.py."""
+        recorder.recordUpdate(update.to_dict())
+
+    def atStartup(self, callback):
+        """Calls the callback from within the event loop, once the bot is running. Used to start tasks which need the running loop."""
+        self.startupCallbacks.append(callback)
+
+    async def postInit(self, app):
+        """Called by the application once it is initialized and its loop is running."""
+        for callback in self.startupCallbacks:
+            callback()
+
+    async def postStop(self, app):
+        """Called by the application once it stopped receiving updates, before its loop is closed."""
+        await self.outbox.stop()
+        await self.loopMonitor.stop()
+        if self.executor != None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+
+    async def runBlocking(self, chatid, function, *args):
+        """Runs a blocking function, e.g. a request to ORS, in the thread pool and waits for its result without blocking the loop. The call belongs to the chat chatid and can be cancelled with cancelBlocking, then asyncio.CancelledError is raised."""
+        if self.executor == None:
+            return function(*args)
+        future = asyncio.get_running_loop().run_in_executor(self.executor, function, *args)
+        self.blocking.setdefault(chatid, set()).add(future)
+        try:
+            return await future
+        finally:
+            futures = self.blocking.get(chatid, set()) # cancelBlocking removed the set already
+            futures.discard(future)
+            if len(futures) == 0:
+                self.blocking.pop(chatid, None)
+
+    def cancelBlocking(self, chatid):
+        """Cancels the blocking calls of a chat. The handlers waiting for them stop, the result of a call already running is dropped. Returns the number of cancelled calls."""
+        futures = self.blocking.pop(chatid, set())
+        for future in futures:
+            future.cancel()
+        return len(futures)
+
+    def proposeRoute(self, coords, alertees, toStr, message):
+        """Asks the owner to confirm a follow process suggested in the passive mode. The process is started, if the owner replies 'yes'. A newer suggestion replaces an unanswered one."""
+        self.proposedRoute = (coords, alertees, toStr)
+        self.sendMessage(cf.MASTER_CHATID, message)
 
     # Define a few command/conversation handlers. These usually take the two arguments update and
     # context.
@@ -213,7 +319,15 @@ class TelegramChatManager:
             chatid = str(update.message.chat_id) 
             addr = update.message.text
             # The acual address is now beeing converted to coordinates
-            coords = self.geocode(addr)
+            try:
+                coords = await self.runBlocking(chatid, self.geocode, addr)
+            except asyncio.CancelledError: # the user sent /quit meanwhile
+                cf.log.debug('[TCM] Geocoding of ' + addr + ' cancelled.')
+                return ConversationHandler.END
+            if coords == None:
+                message = telegram.helpers.escape_markdown('Sorry, I could not find this address. Please try again.', version= 2)
+                await update.message.reply_text(message, parse_mode='MarkdownV2')
+                return GET_ADDR
             context.user_data['ADDR'] = addr
             context.user_data['COORDS'] = coords
             # make the goole maps link to check weather the coordinates are correct
@@ -235,6 +349,7 @@ class TelegramChatManager:
                         'COORDS' : context.user_data['COORDS']}
                 cf.USER_DATA[chatid]['ADDRESSES'].append(temp)
                 cf.saveConfiguration()
+                addressIndex.updateUser(chatid)
                 if chatid != cf.MASTER_CHATID:
                     self.sendMessage(cf.MASTER_CHATID, 'The user ' + cf.USER_DATA[chatid]['NAME'] + ' just added the address ' + temp['ADDR_NAME'])
                 message = telegram.helpers.escape_markdown('Data stored. Thank you.', version= 2)
@@ -279,6 +394,7 @@ class TelegramChatManager:
                     cf.log.info('[TCM] The control chat just removed address ' + cf.USER_DATA[id]['ADDRESSES'][ix]['ADDR_NAME'] + ' from user ' + name)
                     cf.USER_DATA[id]['ADDRESSES'].pop(ix) # actually delete the address
                     cf.saveConfiguration() 
+                    addressIndex.updateUser(id)
                     
                 except:
                     message = telegram.helpers.escape_markdown('Sorry I could not get what you were saying. The Syntax for this command is /rmaddress [USERNAME] [ID] where [ID] is the number of the address you want to remove. To see that number use /show.', version = 2)
@@ -300,6 +416,7 @@ class TelegramChatManager:
                     cf.log.info('[TCM] User ' + cf.USER_DATA[chatid]['NAME'] + ' just deleted address ' + cf.USER_DATA[chatid]['ADDRESSES'][ix]['ADDR_NAME'])
                     cf.USER_DATA[chatid]['ADDRESSES'].pop(ix) # actually delete the address
                     cf.saveConfiguration()
+                    addressIndex.updateUser(chatid)
                 except:
                     message = telegram.helpers.escape_markdown('Sorry I could not get what you were saying. The Syntax for this command is /rmaddress [ID] where [ID] is the number of the address you want to remove. To see that number use /show.', version = 2)
                     await update.message.reply_text(message, parse_mode='MarkdownV2')
@@ -354,11 +471,13 @@ class TelegramChatManager:
                 msg += '\nHere are the special control commands:\n'
                 msg += '/rmuser [NAME] \t- deletes the user\n'
                 msg += '/verify [NAME] \t- verifys the user so they can use this bot\n'
-                msg += '/arrived \t- manually trigers the arrival procedure prematurely\n'
+                msg += '/arrived {CALL} \t- manually trigers the arrival procedure prematurely\n'
+                msg += '/quit {CALL} \t- stops the follow process of another station\n'
                 msg += '\n'
                 msg += 'To start the APRS follow process, use:\n'
-                msg += 'en route to [NAME] {alert [USER-NAME]} \n'
-                msg += '[NAME] can be either a username (if they have only one address defined) or an address name. You can alert multiple users by seperating them by comma. If the \'alert\' tag is specified, the owner of the address is not notified by default.\n'
+                msg += '{follow [CALL]} en route to [NAME] {alert [USER-NAME]} \n'
+                msg += '[NAME] can be either a username (if they have only one address defined) or an address name. You can alert multiple users by seperating them by comma. If the \'alert\' tag is specified, the owner of the address is not notified by default. With \'follow\', the station [CALL] is followed instead of your own, several stations can be followed at once.\n'
+                msg += 'In the passive mode, I suggest the destination myself once I see where you are heading. Reply \'yes\' to start the follow process.\n'
                 cf.log.debug('[TCM] The control chat just requested help.')
             msg += '\nHave fun!'
             message = telegram.helpers.escape_markdown(msg, version= 2)
@@ -376,9 +495,11 @@ class TelegramChatManager:
                     return
                 
                 # first, check if the enroute command is detected
-                pattern = r"(?i)^(en.?route to|enroute to) (.+?)(?: (?:alert|notify) ((?:[^,]+(?:, )?)+))?$"
+                pattern = r"(?i)^(?:follow ([a-z0-9]{1,6}(?:-[a-z0-9]{1,2})?) )?(?:en.?route to|enroute to) (.+?)(?: (?:alert|notify) ((?:[^,]+(?:, )?)+))?$"
                 match = re.match(pattern, update.message.text)
                 if match: # yes, the string matches the regex                    
+                    self.proposedRoute = None # the owner told us where to go
+                    call = match.group(1).upper() if match.group(1) else None # another station than the own one
                     name = match.group(2) # get the nam 
                     # first try to find the user with that name
                     id = self.getIDbyName(name)
@@ -401,6 +522,7 @@ class TelegramChatManager:
                             context.user_data['FOLLOW_USERS'] = users
                             context.user_data['FOLLOW_IXS'] = ix
                             context.user_data['FOLLOW_ALERTEES'] = match.group(3) if match.group(3) else ''
+                            context.user_data['FOLLOW_CALL'] = call
 
                             message = telegram.helpers.escape_markdown(msg,version = 2)
                             await update.message.reply_text(message, parse_mode='MarkdownV2')
@@ -432,6 +554,7 @@ class TelegramChatManager:
                             context.user_data['FOLLOW_USERS'] = [id] * len(cf.USER_DATA[id]['ADDRESSES'])
                             context.user_data['FOLLOW_IXS'] = range(len(cf.USER_DATA[id]['ADDRESSES']))
                             context.user_data['FOLLOW_ALERTEES'] = match.group(3) if match.group(3) else ''
+                            context.user_data['FOLLOW_CALL'] = call
 
                             message = telegram.helpers.escape_markdown(msg,version = 2)
                             await update.message.reply_text(message, parse_mode='MarkdownV2')
@@ -455,8 +578,8 @@ class TelegramChatManager:
                             message = telegram.helpers.escape_markdown('Couldn\'t find all the users you requested! Please try again, I won\'t do anything.',version = 2)
                             await update.message.reply_text(message, parse_mode='MarkdownV2')
                             return
-                    self.newRoute(coords, alertees, toStr) # message parsed successfully
-                    message = telegram.helpers.escape_markdown('Great! The following process started! From now on, your APRS data is beeing tracked.\nType /arrived to manually trigger the arrival messages or type /quit to abort.',version = 2)
+                    self.newRoute(coords, alertees, toStr, call) # message parsed successfully
+                    message = telegram.helpers.escape_markdown('Great! The following process started! From now on, ' + self.trackedStr(call) + ' is beeing tracked.\nType /arrived' + ('' if call == None else ' ' + call) + ' to manually trigger the arrival messages or type /quit' + ('' if call == None else ' ' + call) + ' to abort.',version = 2)
                     await update.message.reply_text(message, parse_mode='MarkdownV2')
                     cf.log.info('[TCM] Successfully parsed message ' + update.message.text)
 
@@ -486,8 +609,9 @@ class TelegramChatManager:
                                 await update.message.reply_text(message, parse_mode='MarkdownV2')
                                 return
                         # route successfully parsed!
-                        self.newRoute(coords, alertees, toStr)
-                        message = telegram.helpers.escape_markdown('Great! The following process started! From now on, your APRS data is beeing tracked.',version = 2)
+                        call = context.user_data.get('FOLLOW_CALL')
+                        self.newRoute(coords, alertees, toStr, call)
+                        message = telegram.helpers.escape_markdown('Great! The following process started! From now on, ' + self.trackedStr(call) + ' is beeing tracked.',version = 2)
                         await update.message.reply_text(message, parse_mode='MarkdownV2')
                         cf.log.info('[TCM] New route started to address  ' + addrName)
                         return
@@ -497,6 +621,18 @@ class TelegramChatManager:
                         await update.message.reply_text(message, parse_mode='MarkdownV2')
                         cf.log.debug('[TCM] Couldn\'t parse response. Reason: ' + str(e))
                         return
+                # the owner answers a suggested destination of the passive mode
+                elif self.proposedRoute != None and update.message.text.strip().lower() in ['yes', 'no']:
+                    coords, alertees, toStr = self.proposedRoute
+                    self.proposedRoute = None
+                    if update.message.text.strip().lower() == 'yes':
+                        self.newRoute(coords, alertees, toStr)
+                        message = telegram.helpers.escape_markdown('Great! The following process started! From now on, your APRS data is beeing tracked.\nType /arrived to manually trigger the arrival messages or type /quit to abort.',version = 2)
+                        cf.log.info('[TCM] Suggested route accepted.')
+                    else:
+                        message = telegram.helpers.escape_markdown('Ok, I won\'t follow you there.',version = 2)
+                        cf.log.debug('[TCM] Suggested route declined.')
+                    await update.message.reply_text(message, parse_mode='MarkdownV2')
                 else: # anything else as a message
                     message = telegram.helpers.escape_markdown('Couldn\'t parese your message. To activate the following process, pleas start your command with \'en route to\' \nSee /help to see all possible commands.',version = 2)
                     await update.message.reply_text(message, parse_mode='MarkdownV2')
@@ -538,8 +674,11 @@ class TelegramChatManager:
             message = telegram.helpers.escape_markdown('Process aborted.', version= 2)
             await update.message.reply_text(message, parse_mode='MarkdownV2')
             chatid = str(update.message.chat_id)
+            self.cancelBlocking(chatid) # e.g. a geocoding still running
             if chatid == cf.MASTER_CHATID:
-                self.newRoute(None, None) # delete the route
+                call = context.args[0].upper() if context.args != None and len(context.args) > 0 else None # /quit CALL ends the follow process of another station
+                self.newRoute(None, None, None, call) # delete the route
+                self.proposedRoute = None
                 context.user_data['FOLLOW_MULTIPLE_USERS'] = False # Fall out of conversation
             cf.log.debug('[TCM] User ' + cf.USER_DATA[chatid]['NAME'] + ' quitted a process/conversation.' )
         # Just to be sure, end convcersation regardless of sanity check
@@ -553,8 +692,13 @@ class TelegramChatManager:
                 message = telegram.helpers.escape_markdown('Sorry this command ís only accessible to the owner.',version = 2)
                 await update.message.reply_text(message, parse_mode='MarkdownV2')
                 return 
-            if self.arrived() == False:
-                message = telegram.helpers.escape_markdown('Sorry, no following process is active.', version= 2)
+            call = context.args[0].upper() if context.args != None and len(context.args) > 0 else None # /arrived CALL for another station
+            try:
+                arrived = await self.runBlocking(chatid, self.arrived, call) # the arrival needs a route
+            except asyncio.CancelledError:
+                return ConversationHandler.END
+            if arrived == False:
+                message = telegram.helpers.escape_markdown('Sorry, no following process is active' + ('' if call == None else ' for ' + call) + '.', version= 2)
                 await update.message.reply_text(message, parse_mode='MarkdownV2')
             cf.log.debug('[TCM] Manually arrived at the destination.' )
 
@@ -641,6 +785,7 @@ class TelegramChatManager:
                 return
             del cf.USER_DATA[id]
             cf.saveConfiguration()
+            addressIndex.removeUser(id)
             message = telegram.helpers.escape_markdown('The user ' + name + ' is deleted.' ,version = 2)
             cf.log.info('[TCM] User ' + name + ' deleted.')
             await update.message.reply_text(message, parse_mode='MarkdownV2')
@@ -678,7 +823,11 @@ class TelegramChatManager:
             msg = msg + cf.USER_DATA[userid]['ADDRESSES'][i]['ADDR'] + '\n'
             msg = msg + str(cf.USER_DATA[userid]['ADDRESSES'][i]['COORDS'][1]) + ', ' + str(cf.USER_DATA[userid]['ADDRESSES'][i]['COORDS'][0]) + '\n\n'
         return msg
-    
+
+    def trackedStr(self, call):
+        """Names the followed station in the replies: the own one or another call"""
+        return 'your APRS data' if call == None else 'the APRS data of ' + call
+
     def getIDbyName(self, name):
         """Function used to find the chatid by the users name"""
         for ci in cf.USER_DATA.keys():
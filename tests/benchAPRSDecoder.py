@@ -0,0 +1,26 @@
+from APRSDecoder import APRSDecoder
+import sys
+import time
+
+
+def benchmark(path='tests/aprsCorpus.txt', size=500000):
+    """ Decodes a corpus of raw packets, repeated to size packets, and prints how many packets per second the decoder handles. Run it from the repository root: python -m tests.benchAPRSDecoder [CORPUS] [SIZE] """
+    with open(path, encoding='latin-1') as f:
+        corpus = [line.rstrip('\r\n') for line in f if line.strip() != '']
+    packets = (corpus * (size // len(corpus) + 1))[:size]
+    now = time.time()
+
+    decoded = 0
+    start = time.perf_counter()
+    for line in packets:
+        if APRSDecoder.decodeWithSource(line, now) != None:
+            decoded += 1
+    elapsed = time.perf_counter() - start
+
+    print('Corpus: ' + path + ' (' + str(len(corpus)) + ' distinct packets)')
+    print('Decoded ' + str(decoded) + ' positions out of ' + str(len(packets)) + ' packets in ' + str(round(elapsed, 2)) + ' sec')
+    print('Throughput: ' + str(round(len(packets) / elapsed)) + ' packets/sec')
+
+
+if __name__ == '__main__':
+    benchmark(*sys.argv[1:2], *[int(a) for a in sys.argv[2:3]])
@@ -0,0 +1,43 @@
+from AddressIndex import AddressIndex
+import random
+import sys
+import time
+
+
+def benchmark(users=1000, queries=20000):
+    """ Indexes random addresses, a few hundred spread over central Europe and a dense cluster in Berlin, checks the index against a linear scan and prints the query times. Returns False, if the index differs from the scan. Run it from the repository root: python -m tests.benchAddressIndex [USERS] [QUERIES] """
+    random.seed(1)
+    userData = {}
+    for u in range(users):
+        if u % 3 == 0:
+            coords = [[random.uniform(13.2, 13.6), random.uniform(52.4, 52.6)] for i in range(3)]
+        else:
+            coords = [[random.uniform(5, 15), random.uniform(47, 55)] for i in range(random.randint(0, 4))]
+        userData[str(u)] = {'NAME' : str(u), 'VALID' : True, 'ADDRESSES' : [{'ADDR_NAME' : 'A', 'ADDR' : '', 'COORDS' : c} for c in coords]}
+    start = time.perf_counter()
+    index = AddressIndex(userData)
+    index.nearest([13.4, 52.5])
+    print('Indexed ' + str(len(index)) + ' addresses of ' + str(users) + ' users in ' + str(round((time.perf_counter() - start) * 1000, 1)) + ' ms')
+
+    points = [[random.uniform(5, 15), random.uniform(47, 55)] if i % 2 == 0 else [random.uniform(13.2, 13.6), random.uniform(52.4, 52.6)] for i in range(queries)]
+    everything = [(c['COORDS'], chatid, ix) for chatid, user in userData.items() for ix, c in enumerate(user['ADDRESSES'])]
+    wrong = 0
+    for point in points[:200]:
+        scan = sorted((index.toKm(sum((a - b) ** 2 for a, b in zip(index.unitVector(*c), index.unitVector(*point))) ** 0.5), chatid, ix) for c, chatid, ix in everything)
+        if [n[1:] for n in index.nearest(point, 3)] != [n[1:] for n in scan[:3]]:
+            wrong += 1
+        if [n[1:] for n in index.within(point, 5)] != [n[1:] for n in scan if n[0] <= 5]:
+            wrong += 1
+    print('Checked 200 positions against a linear scan: ' + str(wrong) + ' differ')
+
+    for name, query in [('nearest address', lambda p: index.nearest(p)), ('3 nearest addresses', lambda p: index.nearest(p, 3)), ('addresses within 5 km', lambda p: index.within(p, 5))]:
+        start = time.perf_counter()
+        for point in points:
+            query(point)
+        print(name + ': ' + str(round((time.perf_counter() - start) / len(points) * 1e6, 1)) + ' us per query')
+    return wrong == 0
+
+
+if __name__ == '__main__':
+    if not benchmark(*[int(a) for a in sys.argv[1:3]]):
+        sys.exit(1)
@@ -0,0 +1,59 @@
+from AddressIndex import AddressIndex
+from DestinationInference import DestinationInference
+from PositionHistory import PositionHistory
+import math
+import random
+import sys
+import time
+import numpy as np
+
+
+def drive(rng, start, dest, step=1.0):
+    """ Simulates the fixes of a drive from start to dest, one every step km. The heading follows the bearing to the destination with a slowly drifting offset (the course of the roads) and noise (the curves). """
+    pos = np.array(start, dtype=float)
+    offset = 0.0
+    while PositionHistory.haversine(pos[0], pos[1], dest[0], dest[1]) > 0.5:
+        offset = 0.8 * offset + rng.normal(0, 6)
+        heading = math.radians(float(PositionHistory.bearing(pos[0], pos[1], dest[0], dest[1])) + offset + rng.normal(0, 25))
+        pos = pos + np.array([math.sin(heading) / math.cos(math.radians(pos[1])), math.cos(heading)]) * step / 111.2
+        yield pos + rng.normal(0, 0.0003, 2) # GPS jitter
+
+
+def benchmark(users=20, trips=100):
+    """ Simulates trips to random saved addresses over central Europe and prints how many destinations were suggested, how many wrong suggestions were made before and the time per packet. Run it from the repository root: python -m tests.benchDestinationInference [USERS] [TRIPS] """
+    found = 0
+    wrong = 0
+    left = []
+    times = []
+    for trip in range(trips):
+        random.seed(trip)
+        rng = np.random.default_rng(trip)
+        userData = {}
+        for u in range(users):
+            userData[str(u)] = {'NAME' : str(u), 'VALID' : True, 'ADDRESSES' : [{'ADDR_NAME' : 'A', 'ADDR' : '', 'COORDS' : [random.uniform(6, 15), random.uniform(47, 55)]} for i in range(random.randint(0, 4))]}
+        dest = [random.uniform(8, 13), random.uniform(49, 53)]
+        userData['dest'] = {'NAME' : 'dest', 'VALID' : True, 'ADDRESSES' : [{'ADDR_NAME' : 'A', 'ADDR' : '', 'COORDS' : dest}]}
+        inference = DestinationInference(AddressIndex(userData))
+        history = PositionHistory()
+        angle = rng.uniform(0, 2 * math.pi)
+        distance = rng.uniform(0.3, 1.2) # degrees
+        start = [dest[0] + distance * math.cos(angle) / math.cos(math.radians(dest[1])), dest[1] + distance * math.sin(angle)]
+        for i, fix in enumerate(drive(rng, start, dest)):
+            history.append(60 * i, fix)
+            begin = time.perf_counter()
+            key = inference.update(history)
+            times.append(time.perf_counter() - begin)
+            if key == ('dest', 0): # the owner confirms, the follow process starts
+                found += 1
+                left.append(float(PositionHistory.haversine(fix[0], fix[1], dest[0], dest[1])))
+                break
+            elif key != None:
+                wrong += 1
+    print(str(users) + ' users, ' + str(trips) + ' trips: ' + str(found) + ' destinations suggested, ' + str(wrong) + ' wrong suggestions')
+    if found > 0:
+        print('Median distance left at the suggestion: ' + str(round(float(np.median(left)), 1)) + ' km')
+    print('Scoring: ' + str(round(float(np.mean(times)) * 1e6)) + ' us per packet')
+
+
+if __name__ == '__main__':
+    benchmark(*[int(a) for a in sys.argv[1:3]])
@@ -0,0 +1,98 @@
+import os
+os.environ.setdefault('OPEN_ROUTE_SERVICE_KEY', 'replay') # the stand-ins do not need real keys
+os.environ.setdefault('APRS_API_KEY', 'replay')
+from APRSFriendAlert import APRSFriendAlert
+from HTTPSessionPool import pool
+from MessageQueue import MessageQueue
+from PositionHistory import PositionHistory
+from tests.benchMessageQueue import fakeTelegram
+from tests.benchSessions import straightORS
+from tests.replay import replayAdapter, replayAPRS
+import asyncio
+import math
+import random
+import sys
+import threading
+import time
+
+
+class queueTCM():
+    """ A stand-in for the TelegramChatManager which sends through a real MessageQueue to the fake Bot API, on an event loop in its own thread. """
+
+    coalesce = True
+
+    def __init__(self, newRouteCallback, geocodeCallback, arrivedCallback):
+        self.bot = fakeTelegram()
+        self.outbox = MessageQueue(self.bot.send)
+        self.loop = asyncio.new_event_loop()
+        threading.Thread(target=self.loop.run_forever, daemon=True).start()
+        asyncio.run_coroutine_threadsafe(self.started(), self.loop).result()
+
+    async def started(self):
+        self.outbox.start()
+
+    def execTCM(self):
+        pass
+
+    def sendMessage(self, chatID, message):
+        self.outbox.put(chatID, message)
+
+    def sendAlerts(self, messages):
+        self.outbox.putAll(messages, self.coalesce)
+
+
+def run(sessions, chats, interval, coalesce):
+    """ Follows the stations to their destinations, 2 km per polling round of interval sec, and waits until all alerts are delivered. Returns the statistics of the queue. """
+    queueTCM.coalesce = coalesce
+    afa = APRSFriendAlert(aprs=replayAPRS, ors=straightORS(), tcm=queueTCM)
+    random.seed(1)
+    positions = {}
+    for i in range(sessions):
+        dest = [random.uniform(6, 15), random.uniform(47, 55)]
+        angle = random.uniform(0, 2 * math.pi)
+        distance = random.uniform(0.3, 0.8) # degrees
+        call = 'BENCH' + str(i) + '-9'
+        positions[call] = [dest[0] + distance * math.cos(angle), dest[1] + distance * math.sin(angle)]
+        afa.routeUpdate(dest, [str(i % chats)], '', call)
+    rounds = 0
+    while len(afa.sessions) > 0 and rounds < 200:
+        rounds += 1
+        data = {}
+        for call, position in list(positions.items()):
+            if call not in afa.sessions:
+                positions.pop(call)
+                continue
+            dest = afa.sessions.get(call).dest
+            d = float(PositionHistory.haversine(position[0], position[1], dest[0], dest[1]))
+            step = min(2.0, d) / max(d, 1e-9)
+            positions[call] = [position[0] + (dest[0] - position[0]) * step, position[1] + (dest[1] - position[1]) * step]
+            data[call] = (positions[call], 60 * rounds)
+        afa.aprs.processPositions(data)
+        time.sleep(interval)
+    while afa.tcm.outbox.pending > 0:
+        time.sleep(0.1)
+    return afa.tcm.outbox.stats()
+
+
+def benchmark(sessions=100, chats=10, interval=0.5):
+    """ Sends the alerts of many stations, followed by a few chats, once merged per chat and once message by message. Prints the Telegram API calls and the fan-out latency of the polling rounds. Returns False, if an alert got lost or merging did not save API calls. Run it from the repository root: python -m tests.benchFanOut [SESSIONS] [CHATS] [INTERVAL] """
+    adapter = replayAdapter(lambda method, url, params, body: (200, '{"result":"ok","entries":[{"name":"' + params['name'] + '","time":"0","lng":"13.4","lat":"52.5"}]}')) # the validation of the poller
+    pool.session.mount('https://api.aprs.fi/', adapter)
+    ok = True
+    sent = {}
+    for coalesce in [False, True]:
+        stats = run(sessions, chats, interval, coalesce)
+        print(('Merged per chat:   ' if coalesce else 'Message by message: ') + str(stats['queued']) + ' alerts, ' + str(stats['sent']) + ' API calls, fan-out of ' + str(stats['fanOuts']) + ' rounds: mean ' + str(stats['fanOutMean']) + ' sec, max ' + str(stats['fanOutMax']) + ' sec')
+        if stats['failed'] > 0 or stats['dropped'] > 0 or stats['sent'] + stats['merged'] != stats['queued']: # every alert is sent on its own or as part of another one
+            print('FAILED: ' + str(stats['failed']) + ' alerts failed, ' + str(stats['dropped']) + ' dropped, ' + str(stats['queued'] - stats['sent'] - stats['merged']) + ' missing')
+            ok = False
+        sent[coalesce] = stats['sent']
+    if sent[True] >= sent[False]:
+        print('FAILED: merging did not save any API calls')
+        ok = False
+    return ok
+
+
+if __name__ == '__main__':
+    if not benchmark(*[int(a) for a in sys.argv[1:3]], *[float(a) for a in sys.argv[3:4]]):
+        sys.exit(1)
@@ -0,0 +1,106 @@
+import os
+import signal
+import socket
+import sys
+import threading
+import time
+import requests
+from http.server import ThreadingHTTPServer
+from tests.benchWebhook import WEBHOOK_PORT, API_PORT, fakeBotAPI, post
+import config as cf
+from TelegramChatManager import TelegramChatManager
+
+
+GEOCODE_DELAY = 1.0 # sec, a slow answer of ORS
+
+
+def geocode(text):
+    """ A stand-in for OpenRouteService.geocode, which blocks like a slow request. """
+    time.sleep(GEOCODE_DELAY)
+    return [13.4, 52.5]
+
+
+def message(chat, text, update=[0]):
+    update[0] += 1
+    result = {'update_id' : update[0], 'message' : {'message_id' : update[0], 'date' : int(time.time()), 'chat' : {'id' : chat, 'type' : 'private'}, 'from' : {'id' : chat, 'is_bot' : False, 'first_name' : 'Bench'}, 'text' : text}}
+    if text.startswith('/'):
+        result['message']['entities'] = [{'type' : 'bot_command', 'offset' : 0, 'length' : len(text.split(' ')[0])}]
+    return result
+
+
+def run(threads, users=5, duration=4):
+    """ Runs the TelegramChatManager with the given blocking threads. users chats add an address (a blocking geocoding each), one of them quits while its geocoding runs, and as many other chats ask for /help again and again. Returns the stall statistics of the loop, the latency of the /help replies and the chats which got an answer to the quit address. """
+    os.environ['TELEGRAM_BLOCKING_THREADS'] = str(threads)
+    fakeBotAPI.chats = {}
+    results = {}
+
+    def client():
+        while True: # until the embedded server is up
+            try:
+                socket.create_connection(('127.0.0.1', WEBHOOK_PORT), timeout=1).close()
+                break
+            except OSError:
+                time.sleep(0.1)
+        session = requests.Session()
+        latencies = []
+
+        def askHelp(chat):
+            own = requests.Session()
+            count = 0
+            end = time.perf_counter() + duration
+            while time.perf_counter() < end:
+                count += 1
+                start = time.perf_counter()
+                post(own, message(chat, '/help'))
+                fakeBotAPI.waitReplies(chat, count)
+                latencies.append(time.perf_counter() - start)
+                time.sleep(0.05)
+
+        for chat in range(1, users + 1):
+            post(session, message(chat, '/addaddress Home'))
+            fakeBotAPI.waitReplies(chat, 1)
+        helpers = [threading.Thread(target=askHelp, args=(100 + chat,)) for chat in range(1, users + 1)]
+        for h in helpers:
+            h.start()
+        time.sleep(0.2)
+        for chat in range(1, users + 1):
+            post(session, message(chat, 'Main street ' + str(chat)))
+        time.sleep(0.1)
+        post(session, message(1, '/quit')) # while its geocoding is running
+        for h in helpers:
+            h.join()
+        time.sleep(GEOCODE_DELAY * users) # until all geocodings are done
+        results['latencies'] = sorted(latencies)
+        results['confirmed'] = [chat for chat in range(1, users + 1) if fakeBotAPI.chats.get(chat, 0) >= (3 if chat == 1 else 2)] # chat 1 also got the reply to /quit
+        os.kill(os.getpid(), signal.SIGINT)
+
+    threading.Thread(target=client, daemon=True).start()
+    tcm = TelegramChatManager(lambda *args: None, geocode, None)
+    tcm.execTCM()
+    results['stalls'] = tcm.loopMonitor.stats()
+    return results
+
+
+def benchmark(users=5):
+    """ Compares the stalls of the event loop and the latency of the other chats, with the geocoding on the loop (0 blocking threads, the behaviour before) and in the thread pool. Returns False, if with the thread pool the address of chat 1 was confirmed although it quit, or an address of the other chats was not. Run it from the repository root: python -m tests.benchHandlerStalls [USERS] """
+    cf.MASTER_CHATID = '1'
+    for chat in list(range(1, users + 1)) + list(range(101, 101 + users)):
+        cf.USER_DATA[str(chat)] = {'NAME' : 'User' + str(chat), 'VALID' : True, 'ADDRESSES' : []}
+    api = ThreadingHTTPServer(('127.0.0.1', API_PORT), fakeBotAPI)
+    threading.Thread(target=api.serve_forever, daemon=True).start()
+    ok = True
+    for threads in [0, 4]:
+        results = run(threads, users)
+        latencies = results['latencies']
+        print(('Geocoding on the loop:      ' if threads == 0 else 'Geocoding in ' + str(threads) + ' threads:   ') + 'stalls ' + str(results['stalls']['histogram']) + ', longest ' + str(results['stalls']['longest']) + ' sec')
+        print('    /help of the other chats: ' + str(len(latencies)) + ' replies, median ' + str(round(latencies[len(latencies) // 2] * 1000)) + ' ms, max ' + str(round(latencies[-1] * 1000)) + ' ms. Addresses confirmed for the chats ' + str(results['confirmed']) + ' (chat 1 quit)')
+        if threads > 0 and results['confirmed'] != list(range(2, users + 1)):
+            print('FAILED: the addresses of the chats ' + str(list(range(2, users + 1))) + ' should be confirmed, chat 1 quit')
+            ok = False
+    api.shutdown()
+    return ok
+
+
+if __name__ == '__main__':
+    if not benchmark(*[int(a) for a in sys.argv[1:2]]):
+        sys.exit(1)
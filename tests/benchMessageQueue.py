@@ -0,0 +1,67 @@
+from MessageQueue import MessageQueue
+import asyncio
+import random
+import sys
+import threading
+import time
+import telegram
+
+
+class fakeTelegram():
+    """ A stand-in for the Bot API. Every request takes 50 ms, Telegram answers with a RetryAfter once the bot sends more than 30 messages within a second and some requests time out. """
+
+    def __init__(self):
+        self.received = {} # chatID -> list of the texts in order of arrival
+        self.recent = []
+        self.flooded = 0
+
+    async def send(self, chatID, text):
+        await asyncio.sleep(0.05)
+        now = time.monotonic()
+        self.recent = [t for t in self.recent if t > now - 1] + [now]
+        if len(self.recent) > 30:
+            self.flooded += 1
+            raise telegram.error.RetryAfter(1)
+        if random.random() < 0.02:
+            raise telegram.error.TimedOut()
+        self.received.setdefault(chatID, []).append(text)
+
+
+def benchmark(messages=300, threads=4):
+    """ Puts messages to 20 chats from several threads, like the poller and the logging hook do, while the consumer runs on the event loop. Prints how long a put blocked, the delivery statistics and checks that every chat got all its messages in order. Returns False, if not. Run it from the repository root: python -m tests.benchMessageQueue [MESSAGES] [THREADS] """
+    random.seed(1)
+    bot = fakeTelegram()
+    outbox = MessageQueue(bot.send)
+    blocked = []
+
+    def produce(n):
+        for i in range(messages // threads):
+            start = time.perf_counter()
+            outbox.put(str(i % 20), str(n) + ':' + str(i))
+            blocked.append(time.perf_counter() - start)
+            time.sleep(0.001)
+
+    async def main():
+        outbox.start()
+        producers = [threading.Thread(target=produce, args=(n,)) for n in range(threads)]
+        for p in producers:
+            p.start()
+        while any(p.is_alive() for p in producers) or outbox.pending > 0:
+            await asyncio.sleep(0.1)
+
+    start = time.perf_counter()
+    asyncio.run(main())
+    elapsed = time.perf_counter() - start
+    ordered = all([int(t.split(':')[1]) for t in texts if t.startswith(str(n) + ':')] == sorted(int(t.split(':')[1]) for t in texts if t.startswith(str(n) + ':')) for texts in bot.received.values() for n in range(threads))
+    print(str(len(blocked)) + ' messages put from ' + str(threads) + ' threads, longest put ' + str(round(max(blocked) * 1000, 3)) + ' ms')
+    print('Delivered in ' + str(round(elapsed, 1)) + ' sec, ' + str(bot.flooded) + ' RetryAfter answers, in order per chat: ' + str(ordered))
+    print(outbox.stats())
+    delivered = sum(len(texts) for texts in bot.received.values())
+    if delivered != len(blocked):
+        print('FAILED: only ' + str(delivered) + ' of ' + str(len(blocked)) + ' messages delivered')
+    return ordered and delivered == len(blocked)
+
+
+if __name__ == '__main__':
+    if not benchmark(*[int(a) for a in sys.argv[1:3]]):
+        sys.exit(1)
@@ -0,0 +1,64 @@
+from OfflineRouter import OfflineRouter
+import heapq
+import math
+import random
+import sys
+import tempfile
+import time
+
+
+def dijkstra(router, source, target):
+    """ Plain one-directional Dijkstra on the forward graph, the reference for the travel times. """
+    dist = {source : 0.0}
+    heap = [(0.0, source)]
+    while len(heap) > 0:
+        d, u = heapq.heappop(heap)
+        if u == target:
+            return d
+        if d > dist[u]:
+            continue
+        for e in range(int(router.offsets[u]), int(router.offsets[u + 1])):
+            v = int(router.targets[e])
+            nd = d + float(router.times[e])
+            if nd < dist.get(v, math.inf):
+                dist[v] = nd
+                heapq.heappush(heap, (nd, v))
+    return math.inf
+
+
+def benchmark(source='tests/roadGraph.txt', queries=2000, checks=200):
+    """ Builds the bundled road graph, checks the bidirectional A* against Dijkstra and prints how many route queries per second the offline router answers. Returns False, if a route differs from Dijkstra. Run it from the repository root: python -m tests.benchOfflineRouter [GRAPH] [QUERIES] """
+    path = tempfile.mkdtemp(prefix='roadGraph')
+    start = time.perf_counter()
+    nodes, edges = OfflineRouter.build(source, path)
+    built = time.perf_counter() - start
+    start = time.perf_counter()
+    router = OfflineRouter(path)
+    loaded = time.perf_counter() - start
+    print('Graph: ' + source + ' (' + str(nodes) + ' nodes, ' + str(edges) + ' edges), built in ' + str(round(built, 3)) + ' sec, loaded in ' + str(round(loaded * 1000, 1)) + ' ms')
+
+    random.seed(1)
+    pairs = [(random.randrange(nodes), random.randrange(nodes)) for i in range(queries)]
+    wrong = 0
+    for s, t in pairs[:checks]:
+        path, edgeList = router.search(s, t)
+        found = math.inf if path == None else sum(float(router.times[e]) for e in edgeList)
+        if abs(found - dijkstra(router, s, t)) > 1e-3:
+            wrong += 1
+    print('Checked ' + str(checks) + ' routes against Dijkstra: ' + str(wrong) + ' differ')
+
+    points = [([float(router.lngs[s]), float(router.lats[s])], [float(router.lngs[t]), float(router.lats[t])]) for s, t in pairs]
+    router.settled = 0
+    router.queries = 0
+    start = time.perf_counter()
+    for a, b in points:
+        router.getRouteSummary(a, b)
+    elapsed = time.perf_counter() - start
+    print('Answered ' + str(queries) + ' queries in ' + str(round(elapsed, 2)) + ' sec, ' + str(round(router.settled / queries)) + ' nodes settled per query')
+    print('Throughput: ' + str(round(queries / elapsed)) + ' queries/sec')
+    return wrong == 0
+
+
+if __name__ == '__main__':
+    if not benchmark(*sys.argv[1:2], *[int(a) for a in sys.argv[2:3]]):
+        sys.exit(1)
@@ -0,0 +1,82 @@
+import os
+os.environ.setdefault('OPEN_ROUTE_SERVICE_KEY', 'replay') # the stand-ins do not need real keys
+os.environ.setdefault('APRS_API_KEY', 'replay')
+from APRSFriendAlert import APRSFriendAlert
+from HTTPSessionPool import pool
+from PositionHistory import PositionHistory
+from tests.replay import replayAdapter, replayAPRS, replayTCM
+import math
+import random
+import sys
+import time
+import tracemalloc
+
+
+class straightORS():
+    """ A stand-in for OpenRouteService. The roads are 30% longer than the great-circle distance and driven at 60 km/h. """
+
+    def __init__(self):
+        self.routes = 0
+
+    def getRouteSummary(self, start, dest, tryAnyway=False, priority=None):
+        self.routes += 1
+        distance = 1.3 * float(PositionHistory.haversine(start[0], start[1], dest[0], dest[1]))
+        return [distance, distance]
+
+    def getRouteSummaries(self, starts, dests, tryAnyway=False, priority=None):
+        return [self.getRouteSummary(s, d) for s, d in zip(starts, dests)]
+
+    def getIsochrones(self, dest, thresholds, tryAnyway=False, priority=None):
+        return None
+
+    def forgetRoute(self, dest):
+        pass
+
+    def geocode(self, text, tryAnyway=False, priority=None):
+        return None
+
+
+def benchmark(sessions=500):
+    """ Follows many stations at once through one APRSFriendAlert, with one shared poller and route batch. Every station drives straight to its destination, 1 km per polling round. Prints the memory per session and the time per round. Run it from the repository root: python -m tests.benchSessions [SESSIONS] """
+    adapter = replayAdapter(lambda method, url, params, body: (200, '{"result":"ok","entries":[{"name":"' + params['name'] + '","time":"0","lng":"13.4","lat":"52.5"}]}')) # the validation of the poller
+    pool.session.mount('https://api.aprs.fi/', adapter)
+    afa = APRSFriendAlert(aprs=replayAPRS, ors=straightORS(), tcm=replayTCM)
+    random.seed(1)
+    trips = []
+    for i in range(sessions):
+        dest = [random.uniform(6, 15), random.uniform(47, 55)]
+        angle = random.uniform(0, 2 * math.pi)
+        distance = random.uniform(0.3, 0.8) # degrees
+        trips.append(('BENCH' + str(i) + '-9', [dest[0] + distance * math.cos(angle), dest[1] + distance * math.sin(angle)], dest))
+
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    for call, start, dest in trips:
+        afa.routeUpdate(dest, [str(i % 20)], '', call)
+    memory = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    print(str(len(afa.sessions)) + ' sessions started, ' + str(round(memory / sessions)) + ' bytes per session (including the position history of the poller)')
+
+    positions = {call : start for call, start, dest in trips}
+    rounds = 0
+    start = time.perf_counter()
+    while len(afa.sessions) > 0 and rounds < 200:
+        rounds += 1
+        data = {}
+        for call, position in list(positions.items()):
+            dest = afa.sessions.get(call).dest if call in afa.sessions else None
+            if dest == None:
+                positions.pop(call)
+                continue
+            d = float(PositionHistory.haversine(position[0], position[1], dest[0], dest[1]))
+            step = min(1.0, d) / max(d, 1e-9)
+            positions[call] = [position[0] + (dest[0] - position[0]) * step, position[1] + (dest[1] - position[1]) * step]
+            data[call] = (positions[call], 60 * rounds)
+        afa.aprs.processPositions(data)
+    elapsed = time.perf_counter() - start
+    print(str(rounds) + ' polling rounds in ' + str(round(elapsed, 2)) + ' sec, ' + str(round(elapsed / rounds * 1000, 1)) + ' ms per round, ' + str(len(afa.tcm.messages)) + ' messages, ' + str(afa.ors.routes) + ' routes')
+    print('Sessions left: ' + str(len(afa.sessions)))
+
+
+if __name__ == '__main__':
+    benchmark(*[int(a) for a in sys.argv[1:2]])
@@ -0,0 +1,57 @@
+from SessionManager import SessionManager
+import sys
+import time
+import numpy as np
+
+
+ALERT_TIMES = [-1, 60, 30, 10, 5, 1]
+
+
+def legacy(alertState, time):
+    """ The threshold evaluation of a single session per packet, as APRSFriendAlert did it before the session matrix. Returns what was found, like SessionManager.evaluate. """
+    if alertState[0] == False:
+        alertState[0] = True
+        alertState[1:] = [round(time) <= alert_time for alert_time in ALERT_TIMES[1:]]
+        return SessionManager.ALREADY_THERE if all(alertState) else SessionManager.STARTED
+    nextAlertIx = np.where(alertState)[0][-1] + 1
+    if nextAlertIx < len(ALERT_TIMES) and round(time) <= ALERT_TIMES[nextAlertIx]:
+        alertState[1:] = [round(time) <= alert_time for alert_time in ALERT_TIMES[1:]]
+        return SessionManager.ARRIVED if all(alertState) else SessionManager.ALERT
+    return SessionManager.QUIET
+
+
+def benchmark(sessions=10000, rounds=50):
+    """ Reports a travel time for every one of many sessions per polling round and evaluates their alert thresholds in one batch, next to the per-session evaluation of before. Checks that both find the same and prints the time per round. Returns False, if they differ. Run it from the repository root: python -m tests.benchThresholds [SESSIONS] [ROUNDS] """
+    rng = np.random.default_rng(1)
+    manager = SessionManager(len(ALERT_TIMES))
+    started = [manager.start('BENCH' + str(i), [0.0, 0.0], []) for i in range(sessions)]
+    etas = rng.uniform(5, 120, sessions) # min
+    speeds = rng.uniform(0.5, 3, sessions) # min of travel time per round
+    states = [[False] * len(ALERT_TIMES) for i in range(sessions)]
+    wrong = 0
+    reporting = 0.0
+    batched = 0.0
+    perSession = 0.0
+    for r in range(rounds):
+        etas = np.maximum(etas - speeds * rng.uniform(0, 2, sessions), 0) # some stations stop, some speed up
+        start = time.perf_counter()
+        for session, eta in zip(started, etas.tolist()):
+            manager.report(session, eta, eta)
+        reporting += time.perf_counter() - start
+        start = time.perf_counter()
+        found, kinds, distances, times, nextAlerts = manager.evaluate(ALERT_TIMES)
+        batched += time.perf_counter() - start
+        start = time.perf_counter()
+        expected = [legacy(state, eta) for state, eta in zip(states, etas.tolist())]
+        perSession += time.perf_counter() - start
+        wrong += int(np.count_nonzero(kinds != np.array(expected)))
+    print(str(sessions) + ' sessions, ' + str(rounds) + ' rounds: ' + str(wrong) + ' results differ from the per-session evaluation')
+    print('Batched evaluation: ' + str(round(batched / rounds * 1000, 2)) + ' ms per round')
+    print('Per-session evaluation: ' + str(round(perSession / rounds * 1000, 2)) + ' ms per round')
+    print('Reporting the travel times: ' + str(round(reporting / rounds * 1000, 2)) + ' ms per round')
+    return wrong == 0
+
+
+if __name__ == '__main__':
+    if not benchmark(*[int(a) for a in sys.argv[1:3]]):
+        sys.exit(1)
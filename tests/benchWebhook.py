@@ -0,0 +1,135 @@
+import os
+import json
+import signal
+import socket
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl
+import requests
+
+
+API_PORT = 18081
+WEBHOOK_PORT = 18443
+SECRET = 'bench-secret'
+os.environ['TELEGRAM_API_URL'] = 'http://127.0.0.1:' + str(API_PORT) + '/bot'
+os.environ['TELEGRAM_MODE'] = 'webhook'
+os.environ['TELEGRAM_WEBHOOK_URL'] = 'http://127.0.0.1:' + str(WEBHOOK_PORT) + '/telegram'
+os.environ['TELEGRAM_WEBHOOK_LISTEN'] = '127.0.0.1'
+os.environ['TELEGRAM_WEBHOOK_PORT'] = str(WEBHOOK_PORT)
+os.environ['TELEGRAM_WEBHOOK_SECRET'] = SECRET
+os.environ.setdefault('TELEGRAM_TOKEN', '123:bench')
+from TelegramChatManager import TelegramChatManager
+
+
+class fakeBotAPI(BaseHTTPRequestHandler):
+    """ A stand-in for the Telegram Bot API. It answers the calls of the bot at startup and counts the replies sent. """
+
+    replies = 0
+    chats = {} # chat ID -> replies
+    webhook = None
+    lock = threading.Condition()
+
+    def do_POST(self):
+        method = self.path.rsplit('/', 1)[-1]
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0))).decode()
+        params = json.loads(body) if self.headers.get('Content-Type', '').startswith('application/json') else dict(parse_qsl(body))
+        if method == 'getMe':
+            result = {'id' : 1, 'is_bot' : True, 'first_name' : 'Bench', 'username' : 'benchbot'}
+        elif method == 'sendMessage':
+            with fakeBotAPI.lock:
+                fakeBotAPI.replies += 1
+                fakeBotAPI.chats[int(params['chat_id'])] = fakeBotAPI.chats.get(int(params['chat_id']), 0) + 1
+                fakeBotAPI.lock.notify_all()
+                result = {'message_id' : fakeBotAPI.replies, 'date' : int(time.time()), 'chat' : {'id' : int(params['chat_id']), 'type' : 'private'}, 'text' : params.get('text', '')}
+        else: # setWebhook, deleteWebhook
+            if method == 'setWebhook':
+                fakeBotAPI.webhook = params.get('url')
+            result = True
+        answer = json.dumps({'ok' : True, 'result' : result}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(answer)))
+        self.end_headers()
+        self.wfile.write(answer)
+
+    def log_message(self, format, *args):
+        pass
+
+    @staticmethod
+    def waitReplies(chat, count, timeout=30):
+        """ Waits until the chat got count replies. """
+        with fakeBotAPI.lock:
+            return fakeBotAPI.lock.wait_for(lambda: fakeBotAPI.chats.get(chat, 0) >= count, timeout)
+
+
+def updates(count, path=None):
+    """ Returns the updates recorded with RECORD_FILE_PATH in the file path, repeated up to count, or else count updates of unknown users with /help and plain messages. Every one gets a single reply. """
+    if path != None:
+        with open(path) as f:
+            recorded = [r['u'] for r in (json.loads(line) for line in f if line.strip() != '') if r['k'] == 'update']
+        return [dict(recorded[i % len(recorded)], update_id=i + 1) for i in range(count)]
+    result = []
+    for i in range(count):
+        text = '/help' if i % 2 == 0 else 'hello'
+        message = {'message_id' : i + 1, 'date' : int(time.time()), 'chat' : {'id' : 1000 + i % 50, 'type' : 'private'}, 'from' : {'id' : 1000 + i % 50, 'is_bot' : False, 'first_name' : 'Bench'}, 'text' : text}
+        if text.startswith('/'):
+            message['entities'] = [{'type' : 'bot_command', 'offset' : 0, 'length' : len(text)}]
+        result.append({'update_id' : i + 1, 'message' : message})
+    return result
+
+
+def post(session, update, secret=SECRET):
+    return session.post(os.environ['TELEGRAM_WEBHOOK_URL'], json=update, headers={'X-Telegram-Bot-Api-Secret-Token' : secret}).status_code
+
+
+def benchmark(count=2000, path=None, results={}):
+    """ Runs the TelegramChatManager in the webhook mode against a local stand-in of the Bot API, posts the updates to the webhook from 8 threads and waits for all replies. Prints the updates per second end-to-end. Returns False, if the wrong secret was accepted or an update was not accepted or answered. Run it from the repository root: python -m tests.benchWebhook [COUNT] [RECORDING] """
+    api = ThreadingHTTPServer(('127.0.0.1', API_PORT), fakeBotAPI)
+    threading.Thread(target=api.serve_forever, daemon=True).start()
+    toPost = updates(count, path)
+
+    def client():
+        while True: # until the embedded server is up
+            try:
+                socket.create_connection(('127.0.0.1', WEBHOOK_PORT), timeout=1).close()
+                break
+            except OSError:
+                time.sleep(0.1)
+        session = requests.Session()
+        results['rejected'] = post(session, toPost[0], 'wrong')
+        pool = ThreadPoolExecutor(8)
+        sessions = threading.local() # a connection per thread
+
+        def send(update):
+            if not hasattr(sessions, 'session'):
+                sessions.session = requests.Session()
+            return post(sessions.session, update)
+        start = time.perf_counter()
+        results['accepted'] = sum(1 for status in pool.map(send, toPost) if status == 200)
+        results['posted'] = time.perf_counter() - start
+        while fakeBotAPI.replies < count and time.perf_counter() - start < 120:
+            time.sleep(0.01)
+        results['handled'] = time.perf_counter() - start
+        results['replies'] = fakeBotAPI.replies
+        os.kill(os.getpid(), signal.SIGINT) # stops the bot like Ctrl+C
+
+    threading.Thread(target=client, daemon=True).start()
+    tcm = TelegramChatManager(None, None, None)
+    tcm.execTCM()
+    api.shutdown()
+    print('Webhook set to ' + str(fakeBotAPI.webhook) + ', an update with a wrong secret got HTTP ' + str(results['rejected']))
+    print(str(results['accepted']) + ' of ' + str(count) + ' updates accepted in ' + str(round(results['posted'], 2)) + ' sec, ' + str(results['replies']) + ' replies after ' + str(round(results['handled'], 2)) + ' sec')
+    print(str(round(results['replies'] / results['handled'])) + ' updates per sec end-to-end')
+    tcm.outbox.logStats()
+    ok = results['rejected'] == 403 and results['accepted'] == count and results['replies'] >= count
+    if not ok:
+        print('FAILED: the wrong secret must get HTTP 403 and all ' + str(count) + ' updates must be accepted and answered')
+    return ok
+
+
+if __name__ == '__main__':
+    if not benchmark(*[int(a) for a in sys.argv[1:2]], *sys.argv[2:3]):
+        sys.exit(1)
@@ -8,13 +8,15 @@ import numpy as np
 
 class dummyAPRS():
 
-    def __init__(self, newDataHandler):
+    def __init__(self, newDataHandler, roundHandler=None):
         """ Constructor for the DUMMY APRS Object. It reads the route.json which is a list of coordinates [[lng, lat],[lng, lat],[lng, lat],[lng, lat]] which are returned one by one """
 
         # As this is a child class, execute the parent constructor
         super().__init__()
 
         self.newDataHandler = newDataHandler
+        self.roundHandler = roundHandler
+        self.handlers = {} # the handlers of further stations, they all get the same dummy data
         self._stop_event = True
         self._running = False
         
@@ -38,6 +40,22 @@ class dummyAPRS():
         self._stop_event = False
         if self._running == False:
             threading.Thread(target=self.run).start()
+
+    def track(self, call, newDataHandler):
+        """Adds a further station, its handler is called with the same dummy data."""
+        self.handlers[call] = newDataHandler
+
+    def untrack(self, call):
+        """Removes a further station."""
+        self.handlers.pop(call, None)
+
+    def getHistory(self, call):
+        """The dummy does not keep a history."""
+        return None
+
+    def updateETA(self, call, eta, nextAlert):
+        """The dummy does not schedule its polls, the ETA is ignored."""
+        pass
         
 
     def run(self): 
@@ -49,6 +67,10 @@ class dummyAPRS():
             cf.log.debug('[APRS] Querring APRS API...')
             data = self.getPosition()
             self.newDataHandler(data)
+            for handler in list(self.handlers.values()):
+                handler(data)
+            if self.roundHandler != None:
+                self.roundHandler()
             time.sleep(15)
         self._running = False
         cf.log.debug('[DUMMY APRS] Thread exit')
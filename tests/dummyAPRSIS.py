@@ -0,0 +1,109 @@
+import config as cf
+import json
+import socket
+import socketserver
+import threading
+import time
+
+class dummyAPRSIS():
+
+    def __init__(self, port=14580, interval=15):
+        """ Constructor for the DUMMY APRS-IS server. It streams the coordinates of the route.json one by one as position packets for every station in the budlist filter of the client. Point APRSIS_SERVER to localhost to use it. """
+        self.port = port
+        self.interval = interval
+        self.server = None
+        try:
+            with open('tests/route.json') as f:
+                self.coords = json.loads(f.read())
+        except:
+            cf.log.critical('[DUMMY APRSIS] Cannot load route.json')
+            self.coords= [[0,0], [1,1] ]
+
+    @staticmethod
+    def encodePosition(call, coord):
+        """ Builds an uncompressed position packet without timestamp from [lng, lat]. """
+        lng, lat = coord
+        latDeg, latMin = divmod(abs(lat) * 60, 60)
+        lngDeg, lngMin = divmod(abs(lng) * 60, 60)
+        latStr = '%02d%05.2f%s' % (latDeg, latMin, 'N' if lat >= 0 else 'S')
+        lngStr = '%03d%05.2f%s' % (lngDeg, lngMin, 'E' if lng >= 0 else 'W')
+        return call + '>APRS,TCPIP*,qAC,DUMMY:!' + latStr + '/' + lngStr + '>dummy'
+
+    def start(self):
+        """ Starts the server in a new thread. """
+        dummy = self
+        class Handler(socketserver.BaseRequestHandler):
+            def handle(self):
+                dummy.handleClient(self.request)
+        socketserver.ThreadingTCPServer.allow_reuse_address = True
+        self.server = socketserver.ThreadingTCPServer(('127.0.0.1', self.port), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        cf.log.warn('[DUMMY APRSIS] The DUMMY APRS-IS server is listening on port ' + str(self.port))
+
+    def stop(self):
+        """ Stops the server. """
+        if self.server != None:
+            self.server.shutdown()
+            self.server.server_close()
+
+    def handleClient(self, connection):
+        """ Handles a single client: login, filter updates and the packet stream. """
+        connection.sendall(b'# dummyAPRSIS 1.0\r\n')
+        connection.settimeout(1)
+        buffer = b''
+        calls = []
+        loggedIn = False
+        ix = 0
+        lastPacket = 0
+        lastComment = time.time()
+        while True:
+            try:
+                data = connection.recv(4096)
+                if data == b'':
+                    return # client disconnected
+                buffer += data
+                *lines, buffer = buffer.split(b'\n')
+                for line in lines:
+                    line = line.decode('latin-1').strip()
+                    if line.startswith('user ') and not loggedIn:
+                        calls = self.parseFilter(line)
+                        connection.sendall(('# logresp ' + line.split(' ')[1] + ' unverified, server DUMMY\r\n').encode('latin-1'))
+                        loggedIn = True
+                        cf.log.debug('[DUMMY APRSIS] Client logged in: ' + line)
+                    elif line.startswith('#filter'):
+                        calls = self.parseFilter(line)
+                        cf.log.debug('[DUMMY APRSIS] New filter: ' + line)
+            except socket.timeout:
+                pass
+            except OSError:
+                return
+            try:
+                if loggedIn and time.time() - lastPacket >= self.interval:
+                    ix = (ix + 1) % len(self.coords)
+                    for c in calls:
+                        connection.sendall((self.encodePosition(c, self.coords[ix]) + '\r\n').encode('latin-1'))
+                    lastPacket = time.time()
+                if time.time() - lastComment >= 20:
+                    connection.sendall(b'# dummyAPRSIS keepalive\r\n')
+                    lastComment = time.time()
+            except OSError:
+                return
+
+    @staticmethod
+    def parseFilter(line):
+        """ Returns the calls of the budlist filter in a login or #filter line. """
+        for part in line.split(' '):
+            if part.startswith('b/'):
+                return [c for c in part[2:].split('/') if c != '']
+        return []
+
+
+if __name__ == '__main__':
+    server = dummyAPRSIS()
+    server.start()
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        server.stop()
@@ -0,0 +1,231 @@
+import os
+os.environ.setdefault('OPEN_ROUTE_SERVICE_KEY', 'replay') # the stand-ins do not need real keys
+os.environ.setdefault('APRS_API_KEY', 'replay')
+import config as cf
+from APRS import APRS
+from APRSDecoder import APRSDecoder
+from APRSFriendAlert import APRSFriendAlert
+from HTTPSessionPool import pool
+from RequestLimiter import limiter
+from Clock import clock
+import json
+import sys
+import time
+import requests
+from requests.adapters import HTTPAdapter
+from urllib.parse import urlsplit, parse_qs
+
+
+class replayAdapter(HTTPAdapter):
+    """ A stand-in for the network. It answers the requests of the shared HTTP pool with a function instead of sending them. """
+
+    def __init__(self, answer):
+        super().__init__()
+        self.answer = answer # function(method, url, params, json) -> (status, text)
+
+    def send(self, request, **kwargs):
+        parts = urlsplit(request.url)
+        params = {k : v[0] for k, v in parse_qs(parts.query).items()}
+        body = json.loads(request.body) if request.body else None
+        status, text = self.answer(request.method, parts.scheme + '://' + parts.netloc + parts.path, params, body)
+        response = requests.Response()
+        response.status_code = status
+        response._content = text.encode('utf-8')
+        response.encoding = 'utf-8'
+        response.url = request.url
+        response.request = request
+        return response
+
+
+class replayAPRS(APRS):
+    """ A stand-in for the APRS poller. It does not poll, the replayer hands it the recorded positions. """
+
+    def start(self):
+        """ The replayer drives the positions, only packets newer than the replay time are seen as new. """
+        self._stop_event = False
+        self.resetTimestamps()
+
+    def stop(self):
+        self._stop_event = True
+
+    def feed(self, call, coord, timestamp):
+        """ Hands a recorded position to the handler of its station, like a poll would. """
+        if self._stop_event == False:
+            self.processPositions({call.upper() : (coord, timestamp)})
+
+
+class replayTCM():
+    """ A stand-in for the TelegramChatManager. It keeps all sent messages with the replay time. """
+
+    def __init__(self, newRouteCallback, geocodeCallback, arrivedCallback):
+        self.newRoute = newRouteCallback
+        self.messages = []
+        self.statuses = {} # (chatID, key) -> text of the live status message
+        self.statusUpdates = 0
+        self.clock = 0 # set by the replayer
+
+    def execTCM(self):
+        pass
+
+    def sendMessage(self, chatID, message):
+        self.messages.append((self.clock, chatID, message))
+
+    def sendAlerts(self, messages):
+        for chatID, message in messages:
+            self.sendMessage(chatID, message)
+
+    def sendStatus(self, statuses):
+        """ Only the latest text of every live status message is kept, like the edited message in the chat. """
+        for chatID, key, message, final in statuses:
+            self.statuses[(chatID, key)] = message
+            self.statusUpdates += 1
+
+    def proposeRoute(self, coords, alertees, toStr, message):
+        """ A suggested destination of the passive mode is accepted right away, as if the owner replied 'yes'. """
+        self.sendMessage(cf.MASTER_CHATID, message)
+        self.newRoute(coords, alertees, toStr)
+
+
+class Replayer():
+    """ Plays a recording back through APRSFriendAlert with local stand-ins for aprs.fi, ORS and Telegram, and compares the API calls and alerts with the recording. """
+
+    def __init__(self, path, speed=0):
+        """ Loads a recording made with RECORD_FILE_PATH. Speed 1 replays in real time, N N-times faster and 0 as fast as possible. """
+        self.speed = speed
+        with open(path) as f:
+            self.records = [json.loads(line) for line in f if line.strip() != '']
+        self.directions = [] # (start, end, status, text) of every recorded directions request
+        self.geocodes = {} # text -> (status, text)
+        self.isochrones = [] # (location, status, text) of every recorded isochrones request
+        self.matrices = {} # json of the locations -> (status, text) of every recorded matrix request
+        self.aprsResponse = None # the first aprs.fi response, used for the validation
+        self.events = [] # (time, kind, data) in replay order
+        self.recordedMessages = []
+        self.recordedCalls = {}
+        seen = set()
+        for r in self.records:
+            if r['k'] == 'http':
+                endpoint = urlsplit(r['u']).netloc + urlsplit(r['u']).path
+                self.recordedCalls[endpoint] = self.recordedCalls.get(endpoint, 0) + 1
+                if 'api.aprs.fi' in r['u'] and r['s'] == 200:
+                    if self.aprsResponse == None:
+                        self.aprsResponse = r['b']
+                    for entry in json.loads(r['b']).get('entries', []):
+                        key = (entry['name'].upper(), int(entry['time']))
+                        if key not in seen: # the packets were seen by many polls
+                            seen.add(key)
+                            self.events.append((key[1], 'position', (key[0], [float(entry['lng']), float(entry['lat'])], key[1])))
+                elif 'directions' in r['u'] and r['p'] != None:
+                    start = [float(v) for v in r['p']['start'].split(',')]
+                    end = [float(v) for v in r['p']['end'].split(',')]
+                    self.directions.append((start, end, r['s'], r['b']))
+                elif 'isochrones' in r['u'] and r['j'] != None:
+                    self.isochrones.append((r['j']['locations'][0], r['s'], r['b']))
+                elif 'matrix' in r['u'] and r['j'] != None:
+                    self.matrices[json.dumps(r['j']['locations'])] = (r['s'], r['b'])
+                elif 'geocode' in r['u'] and r['p'] != None:
+                    self.geocodes[r['p']['text']] = (r['s'], r['b'])
+            elif r['k'] == 'aprsis':
+                result = APRSDecoder.decodeWithSource(r['l'], r['t'])
+                if result != None:
+                    call, (coord, timestamp) = result
+                    self.events.append((r['t'], 'position', (call, coord, timestamp)))
+            elif r['k'] == 'route':
+                self.events.append((r['t'], 'route', (r['d'], r['a'], r['to'], r.get('c'))))
+            elif r['k'] == 'tg':
+                self.recordedMessages.append((r['t'], r['c'], r['x']))
+        self.events.sort(key=lambda e: e[0])
+
+    def answer(self, method, url, params, body):
+        """ Answers a request of the bot from the recording. Directions are answered with the recording of the nearest start to the same destination, isochrones with the recording of the same destination and matrices with the recording of the same locations. """
+        if 'api.aprs.fi' in url:
+            return 200, self.aprsResponse if self.aprsResponse != None else '{"result":"ok","entries":[]}'
+        if 'geocode' in url:
+            if params.get('text') in self.geocodes:
+                return self.geocodes[params['text']]
+            return 200, '{"features":[{"geometry":{"coordinates":[13.38,52.52]}}]}'
+        if 'isochrones' in url:
+            location = body['locations'][0]
+            for recorded, status, text in self.isochrones:
+                if abs(recorded[0] - location[0]) < 1e-4 and abs(recorded[1] - location[1]) < 1e-4:
+                    return status, text
+            return 404, '{"error":"not recorded"}'
+        if 'matrix' in url:
+            return self.matrices.get(json.dumps(body['locations']), (404, '{"error":"not recorded"}'))
+        if 'directions' in url:
+            start = [float(v) for v in params['start'].split(',')]
+            end = [float(v) for v in params['end'].split(',')]
+            candidates = [d for d in self.directions if abs(d[1][0] - end[0]) < 1e-4 and abs(d[1][1] - end[1]) < 1e-4]
+            if len(candidates) == 0:
+                return 404, '{"error":"not recorded"}'
+            best = min(candidates, key=lambda d: (d[0][0] - start[0]) ** 2 + (d[0][1] - start[1]) ** 2)
+            return best[2], best[3]
+        return 404, '{"error":"not recorded"}'
+
+    def run(self):
+        """ Plays the recording back through APRSFriendAlert and returns the summary. """
+        adapter = replayAdapter(self.answer)
+        pool.session.mount('https://api.openrouteservice.org/', adapter)
+        pool.session.mount('https://api.aprs.fi/', adapter)
+        limiter.disable() # the quotas are those of the wall clock, the recording is answered locally
+        if len(self.events) > 0:
+            clock.set(self.events[0][0]) # everything timed runs on the time of the recording
+        afa = APRSFriendAlert(aprs=replayAPRS, tcm=replayTCM)
+        started = None
+        last = None
+        wallStart = time.perf_counter()
+        for t, kind, data in self.events:
+            if last != None and self.speed > 0:
+                time.sleep((t - last) / self.speed)
+            last = t
+            afa.tcm.clock = t
+            clock.set(t)
+            if kind == 'route':
+                if data[0] != None and started == None:
+                    started = t
+                afa.routeUpdate(*data)
+            elif kind == 'position':
+                afa.aprs.feed(*data)
+        clock.set(None)
+        return self.summary(afa, started, time.perf_counter() - wallStart)
+
+    def summary(self, afa, started, wall):
+        """ Builds a summary of the API calls and the alert timing of the replay next to the recording. """
+        offset = lambda t: None if started == None else round(t - started)
+        replayed = {endpoint : stats['requests'] for endpoint, stats in pool.stats().items()}
+        return {
+            'events' : len(self.events),
+            'wallTime' : round(wall, 3),
+            'recordedCalls' : self.recordedCalls,
+            'replayedCalls' : replayed,
+            'estimator' : afa.estimator.stats(),
+            'recordedMessages' : [(offset(t), c, m.split('\n')[0]) for t, c, m in self.recordedMessages],
+            'replayedMessages' : [(offset(t), c, m.split('\n')[0]) for t, c, m in afa.tcm.messages],
+            'statusUpdates' : afa.tcm.statusUpdates
+        }
+
+
+if __name__ == '__main__':
+    # Usage from the repository root: python -m tests.replay RECORDING [SPEED] [SUMMARY.json]
+    # Set ETA_PREFILTER_AUDIT=True to measure the false negatives of the local ETA estimator on the recording
+    if len(sys.argv) < 2:
+        print('Usage: python -m tests.replay RECORDING [SPEED] [SUMMARY.json]')
+        sys.exit(1)
+    replayer = Replayer(sys.argv[1], float(sys.argv[2]) if len(sys.argv) > 2 else 0)
+    result = replayer.run()
+    print('Replayed ' + str(result['events']) + ' events in ' + str(result['wallTime']) + ' sec')
+    print('API calls recorded: ' + str(result['recordedCalls']))
+    print('API calls replayed: ' + str(result['replayedCalls']))
+    print('Local ETA estimator: ' + str(result['estimator']))
+    print('Messages recorded (sec after start, chat, first line):')
+    for m in result['recordedMessages']:
+        print('  ' + str(m))
+    print('Messages replayed:')
+    for m in result['replayedMessages']:
+        print('  ' + str(m))
+    if result['statusUpdates'] > 0:
+        print('Live status updates (LIVE_STATUS=True): ' + str(result['statusUpdates']))
+    if len(sys.argv) > 3:
+        with open(sys.argv[3], 'w') as f:
+            f.write(json.dumps(result, indent=1))
+    cf.log.info('[REPLAY] Replay finished.')
@@ -0,0 +1,49 @@
+import os
+import tempfile
+os.environ.setdefault('CONSOLE_LOGGING_LEVEL', 'WARNING')
+os.environ.setdefault('FILE_LOGGING_LEVEL', 'DEBUG')
+os.environ.setdefault('LOG_FILE_PATH', os.path.join(tempfile.gettempdir(), 'aprsFriendAlertTest.log'))
+import asyncio
+import threading
+from AsyncAPRS import AsyncAPRS
+
+
+async def restart(aprs, fromThread):
+    """ Stops and starts the poller right after each other, like routeUpdate does when a follow process is replaced. Returns the task before, the task after and whether that one was running. """
+    aprs.start()
+    await asyncio.sleep(0.05)
+    before = aprs._task
+    if fromThread: # like a handler running in the thread pool
+        thread = threading.Thread(target=lambda: (aprs.stop(), aprs.start()))
+        thread.start()
+        thread.join()
+    else:
+        aprs.stop()
+        aprs.start()
+    await asyncio.sleep(0.05)
+    after = aprs._task
+    running = after != None and not after.done()
+    aprs.stop()
+    await asyncio.sleep(0.05)
+    return before, after, running
+
+
+def test_stopThenStart():
+    """ A stop directly followed by a start leaves a running poller, on the loop and from another thread. """
+    key = os.environ.pop('APRS_API_KEY', None) # no validation request to aprs.fi, the task just backs off
+    try:
+        for fromThread in [False, True]:
+            aprs = AsyncAPRS(lambda coords: None)
+            before, after, running = asyncio.run(restart(aprs, fromThread))
+            assert before.done()
+            assert after is not before
+            assert running
+    finally:
+        if key != None:
+            os.environ['APRS_API_KEY'] = key
+
+
+if __name__ == '__main__':
+    # Usage from the repository root: python -m tests.test_asyncAPRS
+    test_stopThenStart()
+    print('AsyncAPRS stop then start: ok')
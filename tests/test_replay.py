@@ -0,0 +1,42 @@
+import os
+import json
+import tempfile
+os.environ.setdefault('CONSOLE_LOGGING_LEVEL', 'WARNING')
+os.environ.setdefault('FILE_LOGGING_LEVEL', 'DEBUG')
+os.environ.setdefault('LOG_FILE_PATH', os.path.join(tempfile.gettempdir(), 'aprsFriendAlertTest.log'))
+os.environ['APRS_FOLLOW_CALL'] = 'AB1CD-9'
+from tests.replay import Replayer
+from RequestLimiter import limiter
+
+
+def recordTrip(path, polls=80):
+    """ Writes a recording of a trip of two hours towards [13.4, 52.5]: a poll of aprs.fi every 90 sec, each followed by a directions request, like the bot did before the route was reused. """
+    start = 1760000000
+    records = [{'k' : 'route', 't' : start, 'd' : [13.4, 52.5], 'a' : ['111'], 'to' : ''}]
+    for i in range(polls):
+        t = start + 10 + i * 90
+        lng = 12.8 + i * 0.0076
+        remaining = max(0.0, 13.4 - lng) * 68 # km
+        records.append({'k' : 'http', 't' : t + 5, 'm' : 'GET', 'u' : 'https://api.aprs.fi/api/get', 'p' : {'name' : 'AB1CD-9', 'what' : 'loc', 'format' : 'json'}, 'j' : None, 's' : 200, 'b' : json.dumps({'result' : 'ok', 'entries' : [{'name' : 'AB1CD-9', 'lat' : '52.5', 'lng' : str(lng), 'time' : str(t)}]})})
+        records.append({'k' : 'http', 't' : t + 6, 'm' : 'GET', 'u' : 'https://api.openrouteservice.org/v2/directions/driving-car', 'p' : {'start' : str(lng) + ',52.5', 'end' : '13.4,52.5'}, 'j' : None, 's' : 200, 'b' : json.dumps({'features' : [{'properties' : {'summary' : {'distance' : remaining * 1000, 'duration' : remaining / 50 * 3600}}}]})})
+    with open(path, 'w') as f:
+        f.write('\n'.join(json.dumps(r) for r in records) + '\n')
+
+
+def test_replayCallCounts():
+    """ A recorded trip of two hours replays in seconds, without waiting for the rate limiter, and needs the known number of API calls. """
+    path = os.path.join(tempfile.mkdtemp(prefix='replay'), 'trip.jsonl')
+    recordTrip(path)
+    result = Replayer(path).run()
+    assert result['wallTime'] < 10
+    assert result['recordedCalls']['api.openrouteservice.org/v2/directions/driving-car'] == 80
+    assert result['replayedCalls']['api.openrouteservice.org/v2/directions/driving-car'] == 43 # the local ETA estimate and the reused routes save the rest
+    assert result['replayedCalls']['api.openrouteservice.org/geocode/search'] == 1 # the validation of the key
+    assert sum(stats['refused'] for stats in limiter.stats().values()) == 0
+    assert len(result['replayedMessages']) == 7 # en route, its confirmation, three alerts and the arrival for both
+
+
+if __name__ == '__main__':
+    # Usage from the repository root: python -m tests.test_replay
+    test_replayCallCounts()
+    print('Replay call counts: ok')